@@ -11,39 +11,90 @@ import os.path
 from enum import Enum
 import datetime
 import time
-import spacy
-import matplotlib.pyplot as plt
+import contextlib
 import itertools
 
 # Deep Learning Modules
 from tensorboardX import SummaryWriter
 import torch
 import torch.nn as nn
-from sklearn import metrics
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 
 # User Defined Modules
 from configs.serde import *
 from models.biLSTM import *
 from models.CNN import *
+from models.metrics import MetricsAccumulator
+from models.optimisers import build_optimiser, scaler_step, sparse_parameters
+from data.prefetch import PrefetchLoader
+from data.tokenization import tokenize_corpus, spacy_pipeline
+from data.vocab_index import VocabIndex, numericalize
+from utils.distributed import barrier
+from utils.checkpoint_writer import CheckpointWriter, rng_state, set_rng_state
+from utils.timing import PhaseTimer
+from utils.profiler import build_profiler, NULL_PROFILER
+from utils.inference_bundle import load_bundle, bundle_itos, vocab_index_path, Stoi
 import pdb
 os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
 
 
+def autocast(device, enabled):
+    '''
+    Mixed precision context of the forward pass: bfloat16 on the cpu, float16 on the GPU.
+    The weights (master weights) stay in float32, only the operations run in the lower precision.
+    '''
+    if not enabled:
+        return contextlib.nullcontext()
+    if device.type == 'cpu':
+        return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return torch.autocast(device_type=device.type, dtype=torch.float16)
+
+
+def count_tokens(message, message_lengths=None, pad_idx=None):
+    '''
+    Number of tokens of the batch without the padding, as a tensor:
+    summing it up over the epoch does not synchronize the device at every batch.
+    '''
+    if message_lengths is not None:
+        return message_lengths.sum()
+    if pad_idx is None:
+        return message.numel()
+    return (message != pad_idx).sum()
+
+
 class Training:
     '''
     This class represents training process.
     '''
-    def __init__(self, cfg_path, num_epochs=10, RESUME=False, model_mode='RNN', torch_seed=None):
+    def __init__(self, cfg_path, num_epochs=10, RESUME=False, model_mode='RNN', torch_seed=None, num_prefetch=2,
+                 mixed_precision=False, rank=0, world_size=1, early_stopping=None, distillation=None):
         '''
         :cfg_path (string): path of the experiment config file
         :torch_seed (int): Seed used for random generators in PyTorch functions
+        :num_prefetch (int): number of batches prepared ahead in a background thread (0: no prefetching)
+        :mixed_precision (bool): autocast of the forward pass to bfloat16 (cpu) or float16 (GPU, with loss scaling)
+        :rank, world_size (int): distributed data parallel training (see utils/distributed.py);
+            only the process of rank 0 writes the config, the checkpoints and the tensorboard logs.
+        :early_stopping (EarlyStopping): stops the training before num_epochs when the monitored metric
+            stops improving (see utils/early_stopping.py); None: always trains num_epochs epochs
+        :distillation (DistillationLoss): trains the model on a blend of the hard labels and of the soft targets
+            of a teacher (see models/distillation.py); the training batches need the example index (batch.index)
         '''
         self.params = read_config(cfg_path)
         self.cfg_path = cfg_path
         self.RESUME = RESUME
         self.model_mode = model_mode
         self.num_epochs = num_epochs
+        self.num_prefetch = num_prefetch
+        self.mixed_precision = mixed_precision
+        self.rank = rank
+        self.world_size = world_size
+        self.early_stopping = early_stopping
+        self.distillation = distillation
+        # state of the interrupted epoch to continue from (see load_checkpoint)
+        self.resume_state = None
 
         if RESUME == False:
             self.model_info = self.params['Network']
@@ -51,10 +102,12 @@ class Training:
             self.epoch = 0
             self.num_epochs = num_epochs
             self.best_loss = float('inf')
+            self.epoch_losses = {}
             if 'trained_time' in self.model_info:
                 self.raise_training_complete_exception()
-            self.setup_cuda()
-            self.writer = SummaryWriter(log_dir=os.path.join(self.params['tb_logs_path']))
+            self.setup_cuda(cuda_device_id=self.rank % max(torch.cuda.device_count(), 1))
+            if self.rank == 0:
+                self.writer = SummaryWriter(log_dir=os.path.join(self.params['tb_logs_path']))
 
 
     def setup_cuda(self, cuda_device_id=0):
@@ -71,42 +124,111 @@ class Training:
     def setup_model(self, model, optimiser, optimiser_params, loss_function, weight):
 
         total_param_num = sum(p.numel() for p in model.parameters() if p.requires_grad)
-        print(f'Total # of model\'s trainable parameters: {total_param_num:,}')
-        print('----------------------------------------------------\n')
+        if self.rank == 0:
+            print(f'Total # of model\'s trainable parameters: {total_param_num:,}')
+            print('----------------------------------------------------\n')
 
         self.model = model.to(self.device)
-        self.optimiser = optimiser(self.model.parameters(), **optimiser_params)
+        # SparseAdam for a sparse embedding table, `optimiser` for the rest of the model
+        self.optimiser = build_optimiser(self.model, optimiser, optimiser_params)
         # self.loss_function = loss_function()
         self.loss_function = loss_function(weight=weight.to(self.device))
+        if self.distillation:
+            self.distillation = self.distillation.to(self.device)
+        self.setup_mixed_precision()
 
         if 'retrain' in self.model_info and self.model_info['retrain']==True:
             self.load_pretrained_model()
+        self.setup_distributed()
 
         # Saves the model, optimiser,loss function name for writing to config file
         self.model_info['total_param_num'] = total_param_num
         self.model_info['optimiser'] = optimiser.__name__
         self.model_info['loss_function'] = loss_function.__name__
         self.model_info['optimiser_params'] = optimiser_params
+        self.model_info['sparse_embedding'] = len(sparse_parameters(self.model)) > 0
+        self.model_info['mixed_precision'] = self.mixed_precision
+        self.model_info['world_size'] = self.world_size
+        if self.distillation:
+            self.model_info['distillation'] = {'alpha': self.distillation.alpha,
+                                               'temperature': self.distillation.temperature}
         self.params['Network']=self.model_info
-        write_config(self.params, self.cfg_path,sort_keys=True)
+        if self.rank == 0:
+            write_config(self.params, self.cfg_path,sort_keys=True)
+        # the other processes read the config only once it is written
+        barrier()
 
 
     def load_checkpoint(self, model, optimiser, optimiser_params, loss_function, weight):
+        '''
+        Resumes the training from the checkpoint: from the start of the next epoch,
+        or from the batch where it stopped when the checkpoint was written within an epoch (see save_step_checkpoint).
+        '''
 
-        checkpoint = torch.load(self.params['network_output_path'] + '/' + self.params['checkpoint_name'])
+        # every process loads the checkpoint written by the process of rank 0, onto its own device
+        checkpoint = torch.load(self.params['network_output_path'] + '/' + self.params['checkpoint_name'],
+                                map_location='cpu')
         self.device = None
         self.model_info = checkpoint['model_info']
-        self.setup_cuda()
+        self.setup_cuda(cuda_device_id=self.rank % max(torch.cuda.device_count(), 1))
         self.model = model.to(self.device)
-        self.optimiser = optimiser(self.model.parameters(), **optimiser_params)
+        self.optimiser = build_optimiser(self.model, optimiser, optimiser_params)
         self.loss_function = loss_function(weight=weight.to(self.device))
+        if self.distillation:
+            self.distillation = self.distillation.to(self.device)
 
         self.model.load_state_dict(checkpoint['model_state_dict'])
         self.optimiser.load_state_dict(checkpoint['optimizer_state_dict'])
         self.epoch = checkpoint['epoch']
-        self.loss_function = checkpoint['loss']
         self.best_loss = checkpoint['best_loss']
-        self.writer = SummaryWriter(log_dir=os.path.join(self.params['tb_logs_path']), purge_step=self.epoch + 1)
+        # losses of the kept epoch{N}_ model files, for the retention policy of the checkpoint writer
+        self.epoch_losses = checkpoint.get('epoch_losses') or {}
+        self.setup_mixed_precision()
+        if self.scaler and checkpoint.get('scaler_state_dict'):
+            self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        if self.early_stopping and checkpoint.get('early_stopping'):
+            self.early_stopping.load_state_dict(checkpoint['early_stopping'])
+        self.setup_distributed()
+
+        # one state per process; with a different number of processes the interrupted epoch starts over
+        step_states = checkpoint.get('step_states')
+        if step_states and len(step_states) == self.world_size:
+            self.resume_state = step_states[self.rank]
+        if self.rank == 0:
+            self.writer = SummaryWriter(log_dir=os.path.join(self.params['tb_logs_path']), purge_step=self.epoch + 1)
+
+
+    def setup_mixed_precision(self):
+        '''
+        bfloat16 has the range of float32, so no loss scaling is needed on the cpu.
+        float16 on the GPU needs a gradient scaler against underflow of the gradients.
+        '''
+        self.scaler = None
+        if self.mixed_precision and self.device.type == 'cuda':
+            self.scaler = torch.cuda.amp.GradScaler()
+
+
+    def setup_distributed(self):
+        '''
+        Distributed data parallel training: every process trains an identical copy of the model on its shard
+        of the training set, and the gradients are averaged over the processes (all-reduce) during the backward pass.
+        self.model stays the plain model, so the saved state dicts are the same as in a single process training;
+        self.parallel_model is the one used for the forward pass of the training.
+        '''
+        self.parallel_model = self.model
+        if self.world_size > 1:
+            device_ids = [torch.cuda.current_device()] if self.device.type == 'cuda' else None
+            self.parallel_model = DistributedDataParallel(self.model, device_ids=device_ids)
+
+
+    def join(self):
+        '''
+        Uneven number of batches over the processes (token-budget batching, streaming):
+        the processes which run out of batches keep answering the all-reduce of the others.
+        '''
+        if self.world_size > 1:
+            return self.parallel_model.join()
+        return contextlib.nullcontext()
 
 
     def add_tensorboard_graph(self, model):
@@ -126,6 +248,7 @@ class Training:
     def execute_training(self, train_loader, valid_loader=None, batch_size=1):
         '''
         Executes training by running training and validation at each epoch
+        Returns a summary of the training: metrics of the last epoch, best loss, number of epochs and total time
         '''
         self.params = read_config(self.cfg_path)
 
@@ -139,60 +262,117 @@ class Training:
             self.model_info = self.params['Network']
             self.model_info['num_epoch'] = self.num_epochs or self.model_info['num_epoch']
 
-        print('Starting time:' + str(datetime.datetime.now()) +'\n')
-
+        # per-phase timing of the epochs (see utils/timing.py), disabled with "timing": false in the config
+        self.timer = PhaseTimer(enabled=self.params.get('timing', True), device=self.device)
+        self.pad_idx = getattr(self.model.embedding, 'padding_idx', None)
+        # opt-in torch.profiler window over the training steps (the "profiler" section of the config)
+        self.profiler = build_profiler(self.params, 'train', self.device) if self.rank == 0 else NULL_PROFILER
+        self.profiler.start()
+
+        if self.rank == 0:
+            print('Starting time:' + str(datetime.datetime.now()) +'\n')
+            # the checkpoints are written in the background, see utils/checkpoint_writer.py
+            self.checkpoint_writer = CheckpointWriter(keep_last=self.params.get('checkpoint_keep_last'),
+                                                      keep_best=self.params.get('checkpoint_keep_best', True),
+                                                      asynchronous=self.params.get('checkpoint_async', True),
+                                                      output_path=self.params['network_output_path'],
+                                                      model_name=self.params['trained_model_name'],
+                                                      last_epoch=self.epoch, epoch_losses=self.epoch_losses)
+
+        summary = {'epoch': self.epoch}
         for epoch in range(self.num_epochs - self.epoch):
             self.epoch += 1
             start_time = time.time()
+            self.timer.reset()
 
-            print('Training (intermediate metrics):')
-            train_loss, train_acc, train_F1, train_recall, train_precision = self.train_epoch(train_loader, batch_size)
+            if self.rank == 0:
+                print('Training (intermediate metrics):')
+            train_loss, train_acc, train_F1, train_precision, train_recall = self.train_epoch(train_loader, batch_size)
 
             if valid_loader:
-                print('\nValidation (intermediate metrics):')
-                valid_loss, valid_acc, valid_F1, valid_recall, valid_precision = self.valid_epoch(valid_loader, batch_size)
+                if self.rank == 0:
+                    print('\nValidation (intermediate metrics):')
+                valid_loss, valid_acc, valid_F1, valid_precision, valid_recall = self.valid_epoch(valid_loader, batch_size)
 
             end_time = time.time()
             epoch_mins, epoch_secs = self.epoch_time(start_time, end_time)
             total_mins, total_secs = self.epoch_time(total_start_time, end_time)
 
+            summary = {'epoch': self.epoch, 'train_loss': train_loss, 'train_acc': train_acc, 'train_F1': train_F1}
+            if valid_loader:
+                summary.update({'valid_loss': valid_loss, 'valid_acc': valid_acc, 'valid_F1': valid_F1})
+            # the same decision in every process, the metrics are reduced over the processes
+            stop = self.early_stopping is not None and self.early_stopping.step(summary)
+
+            # the metrics are already reduced over the processes, only the process of rank 0 writes them
+            if self.rank != 0:
+                if stop:
+                    break
+                continue
+
             # Writes to the tensorboard after number of steps specified.
             if valid_loader:
                 self.calculate_tb_stats(train_loss, train_F1, train_recall, train_precision, train_acc,
                                         valid_loss, valid_F1, valid_recall, valid_precision, valid_acc)
             else:
                 self.calculate_tb_stats(train_loss, train_F1, train_recall, train_precision, train_acc)
-
-            # Saving the model
+            # time the loop waited for the data pipeline
+            self.writer.add_scalar('Training_DataWait', self.train_data_wait, self.epoch)
             if valid_loader:
-                if valid_loss < self.best_loss:
-                    self.best_loss = valid_loss
-                    torch.save(self.model.state_dict(), self.params['network_output_path'] + '/' +
-                               self.params['trained_model_name'])
-            else:
-                if train_loss < self.best_loss:
-                    self.best_loss = train_loss
-                    torch.save(self.model.state_dict(), self.params['network_output_path'] + '/' +
-                               self.params['trained_model_name'])
+                self.writer.add_scalar('Validation_DataWait', self.valid_data_wait, self.epoch)
 
-            # saving the model based on epoch, checkpoint
-            self.savings()
+            # Saving the model
+            blocked_time = self.checkpoint_writer.blocked_time
+            epoch_loss = valid_loss if valid_loader else train_loss
+            # the writes of the epoch are one job of the checkpoint writer, the model is copied once for all of them
+            with self.timer.phase('savings'), self.checkpoint_writer.group():
+                if epoch_loss < self.best_loss:
+                    self.best_loss = epoch_loss
+                    self.checkpoint_writer.save(self.model.state_dict(), self.params['network_output_path'] + '/' +
+                                                self.params['trained_model_name'])
+
+                # saving the model based on epoch, checkpoint
+                self.savings(epoch_loss)
+            # time the loop was blocked by the checkpointing
+            checkpoint_wait = self.checkpoint_writer.blocked_time - blocked_time
+            self.writer.add_scalar('Checkpoint_BlockedTime', checkpoint_wait, self.epoch)
+            # milliseconds per batch of each phase and tokens/sec, to tensorboard and output_data_path/timing.jsonl
+            self.timer.write(self.writer, os.path.join(self.params['output_data_path'], 'timing.jsonl'), self.epoch)
 
             # Print accuracy, F1, and loss after each epoch
             print('\n---------------------------------------------------------------')
             print(f'Epoch: {self.epoch:02} | Epoch Time: {epoch_mins}m {epoch_secs}s | '
                   f'Total Time so far: {total_mins}m {total_secs}s')
-            print(f'\tTrain Loss: {train_loss:.3f} | Train Acc: {train_acc * 100:.2f}% | Train F1: {train_F1:.3f}')
+            print(f'\tTrain Loss: {train_loss:.3f} | Train Acc: {train_acc * 100:.2f}% | Train F1: {train_F1:.3f} | '
+                  f'Data wait: {self.train_data_wait:.1f}s | Checkpoint wait: {checkpoint_wait:.2f}s')
             if valid_loader:
                 print(f'\t Val. Loss: {valid_loss:.3f} |  Val. Acc: {valid_acc * 100:.2f}% |  Val. F1: {valid_F1:.3f}')
             print('---------------------------------------------------------------\n')
 
+            if stop:
+                print(f'Early stopping: no improvement of {self.early_stopping.monitor} for '
+                      f'{self.early_stopping.patience} epochs (best: {self.early_stopping.best:.4f} '
+                      f'at epoch {self.early_stopping.best_epoch})\n')
+                break
+
+        self.profiler.stop()
+        if self.rank == 0:
+            # waits for the last checkpoints
+            self.checkpoint_writer.close()
+
+        summary['best_loss'] = self.best_loss
+        summary['stopped_early'] = self.early_stopping is not None and \
+                                   self.early_stopping.num_bad_epochs >= self.early_stopping.patience
+        summary['total_time'] = time.time() - total_start_time
+        return summary
+
 
     def train_epoch(self, train_loader, batch_size):
         '''
         Train using one single iteration of all messages (epoch) in dataset
         '''
-        print("Epoch [{}/{}]".format(self.epoch, self.model_info['num_epoch']))
+        if self.rank == 0:
+            print("Epoch [{}/{}]".format(self.epoch, self.model_info['num_epoch']))
         self.model.train()
         previous_idx = 0
 
@@ -200,85 +380,118 @@ class Training:
         batch_loss = 0
         batch_count = 0
 
-        # initializing the caches
-        logits_cache = torch.from_numpy(np.zeros((len(train_loader) * batch_size, 3)))
-        max_preds_cache = torch.from_numpy(np.zeros((len(train_loader) * batch_size, 1)))
-        labels_cache = torch.from_numpy(np.zeros(len(train_loader) * batch_size))
-
-        for idx, batch in enumerate(train_loader):
-            if self.model_mode == "RNN":
-                message, message_lengths = batch.text
-            if self.model_mode == "CNN":
-                message = batch.text
-            label = batch.label
-            message = message.long()
-            label = label.long()
-            message = message.to(self.device)
-            label = label.to(self.device)
-
-            self.optimiser.zero_grad()
-
-            with torch.set_grad_enabled(True):
+        # metrics of the whole epoch, accumulated on the device
+        epoch_metrics = MetricsAccumulator(weight=getattr(self.loss_function, 'weight', None), device=self.device)
+
+        # continues an interrupted epoch from the batch where it stopped
+        start_idx = 0
+        if self.resume_state:
+            train_loader.load_state_dict(self.resume_state['loader'])
+            epoch_metrics.load_state_dict(self.resume_state['metrics'])
+            set_rng_state(self.resume_state['rng'])
+            start_idx = self.resume_state['loader']['iterations_this_epoch']
+            previous_idx = start_idx
+            self.resume_state = None
+
+        # checkpoint every `checkpoint_step_freq` batches, within the number of batches of every process
+        step_freq = self.params.get('checkpoint_step_freq')
+        num_step_batches = len(train_loader)
+        if step_freq and self.world_size > 1:
+            num_step_batches = torch.tensor(num_step_batches)
+            dist.all_reduce(num_step_batches, op=dist.ReduceOp.MIN)
+
+        num_batches = start_idx
+        iterator = train_loader
+        train_loader = PrefetchLoader(iterator, self.device, self.num_prefetch)
+        with self.join():
+            for idx, batch in enumerate(train_loader, start=start_idx):
                 if self.model_mode == "RNN":
-                    output = self.model(message, message_lengths).squeeze(1)
+                    message, message_lengths = batch.text
                 if self.model_mode == "CNN":
-                    output = self.model(message).squeeze(1)
-
-                # Loss
-                loss = self.loss_function(output, label)
-                batch_loss += loss.item()
-                batch_count += 1
-                max_preds = output.argmax(dim=1, keepdim=True)  # get the index of the max probability
-
-                # saving the logits and labels of this batch
-                for i, batch_vector in enumerate(max_preds):
-                    max_preds_cache[idx * batch_size + i] = batch_vector
-                for i, batch_vector in enumerate(output):
-                    logits_cache[idx * batch_size + i] = batch_vector
-                for i, value in enumerate(label):
-                    labels_cache[idx * batch_size + i] = value
-
-                loss.backward()
-                self.optimiser.step()
-
-                # Prints loss statistics after number of steps specified.
-                if (idx + 1)%self.params['display_stats_freq'] == 0:
-                    print('Epoch {:02} | Batch {:03}-{:03} | Train loss: {:.3f}'.
-                          format(self.epoch, previous_idx, idx, batch_loss / batch_count))
-                    previous_idx = idx + 1
-                    batch_loss = 0
-                    batch_count = 0
+                    message = batch.text
+                label = batch.label
+                message = message.long()
+                label = label.long()
+                message = message.to(self.device)
+                label = label.to(self.device)
+                self.timer.add_tokens('train', count_tokens(message, message_lengths if self.model_mode == "RNN" else None,
+                                                            self.pad_idx))
+
+                with self.timer.phase('train/zero_grad'):
+                    self.optimiser.zero_grad()
+
+                with torch.set_grad_enabled(True):
+                    with self.timer.phase('train/forward'):
+                        with autocast(self.device, self.mixed_precision):
+                            if self.model_mode == "RNN":
+                                output = self.parallel_model(message, message_lengths).squeeze(1)
+                            if self.model_mode == "CNN":
+                                output = self.parallel_model(message).squeeze(1)
+                        # the loss is always computed in float32
+                        output = output.float()
+
+                        # Loss
+                        loss = self.loss_function(output, label)
+                        if self.distillation:
+                            # blend with the loss on the soft targets of the teacher
+                            loss = self.distillation(output, loss, batch.index.to(self.device))
+
+                    with self.timer.phase('train/metrics'):
+                        batch_loss += loss.item()
+                        batch_count += 1
+                        epoch_metrics.update(output, label)
+
+                    if self.scaler:
+                        with self.timer.phase('train/backward'):
+                            self.scaler.scale(loss).backward()
+                        with self.timer.phase('train/optimiser'):
+                            scaler_step(self.scaler, self.optimiser)
+                            self.scaler.update()
+                    else:
+                        with self.timer.phase('train/backward'):
+                            loss.backward()
+                        with self.timer.phase('train/optimiser'):
+                            self.optimiser.step()
+
+                    # Prints loss statistics after number of steps specified.
+                    if (idx + 1)%self.params['display_stats_freq'] == 0:
+                        if self.rank == 0:
+                            print('Epoch {:02} | Batch {:03}-{:03} | Train loss: {:.3f}'.
+                                  format(self.epoch, previous_idx, idx, batch_loss / batch_count))
+                        previous_idx = idx + 1
+                        batch_loss = 0
+                        batch_count = 0
+
+                self.profiler.step()
+                num_batches = idx + 1
+                if step_freq and num_batches % step_freq == 0 and num_batches < num_step_batches:
+                    with self.timer.phase('train/checkpoint'):
+                        self.save_step_checkpoint(iterator, epoch_metrics, num_batches)
+
+        self.train_data_wait = train_loader.data_wait_time
+        self.timer.add('train/data', self.train_data_wait, calls=max(num_batches - start_idx, 1))
+        if step_freq:
+            # a preemption during the validation continues with the validation
+            with self.timer.phase('train/checkpoint'):
+                self.save_step_checkpoint(iterator, epoch_metrics, num_batches)
+        if self.world_size > 1:
+            epoch_metrics.all_reduce()
 
         '''Metrics calculation over the whole set'''
-        max_preds_cache = max_preds_cache.cpu()
-        labels_cache = labels_cache.cpu()
-
-        # average=None gives individual scores for each class
         # here we only care about the average of positive class and negative class
-        epoch_accuracy = metrics.accuracy_score(labels_cache, max_preds_cache)
-        # epoch_f1_score = metrics.f1_score(labels_cache, max_preds_cache, average='macro')
-        # epoch_precision = metrics.precision_score(labels_cache, max_preds_cache, average='macro')
-        # epoch_recall = metrics.recall_score(labels_cache, max_preds_cache, average='macro')
-
-        epoch_f1_score = metrics.f1_score(labels_cache, max_preds_cache, average=None)
-        epoch_precision = metrics.precision_score(labels_cache, max_preds_cache, average=None)
-        epoch_recall = metrics.recall_score(labels_cache, max_preds_cache, average=None)
-        epoch_f1_score = (epoch_f1_score[1] + epoch_f1_score[2]) / 2
-        epoch_precision = (epoch_precision[1] + epoch_precision[2]) / 2
-        epoch_recall = (epoch_recall[1] + epoch_recall[2]) / 2
-        labels_cache = labels_cache.long()
-        logits_cache = logits_cache.float()
-
-        # Loss
-        loss = self.loss_function(logits_cache.to(self.device), labels_cache.to(self.device))
-        epoch_loss = loss.item()
+        epoch_loss, epoch_accuracy, epoch_f1_score, epoch_precision, epoch_recall = epoch_metrics.compute()
 
         return epoch_loss, epoch_accuracy, epoch_f1_score, epoch_precision, epoch_recall
 
 
     def valid_epoch(self, valid_loader, batch_size):
-        '''Test (validation) model after an epoch and calculate loss on valid dataset'''
-        print("Epoch [{}/{}]".format(self.epoch, self.model_info['num_epoch']))
+        '''
+        Test (validation) model after an epoch and calculate loss on valid dataset
+        In a distributed training every process validates its shard with the plain model (no synchronization
+        in the forward pass), and the metrics are then summed over the processes.
+        '''
+        if self.rank == 0:
+            print("Epoch [{}/{}]".format(self.epoch, self.model_info['num_epoch']))
         self.model.eval()
         previous_idx = 0
 
@@ -287,11 +500,10 @@ class Training:
             batch_loss = 0
             batch_count = 0
 
-            # initializing the caches
-            logits_cache = torch.from_numpy(np.zeros((len(valid_loader) * batch_size, 3)))
-            max_preds_cache = torch.from_numpy(np.zeros((len(valid_loader) * batch_size, 1)))
-            labels_cache = torch.from_numpy(np.zeros(len(valid_loader) * batch_size))
+            # metrics of the whole epoch, accumulated on the device
+            epoch_metrics = MetricsAccumulator(weight=getattr(self.loss_function, 'weight', None), device=self.device)
 
+            valid_loader = PrefetchLoader(valid_loader, self.device, self.num_prefetch)
             for idx, batch in enumerate(valid_loader):
                 if self.model_mode == "RNN":
                     message, message_lengths = batch.text
@@ -302,78 +514,103 @@ class Training:
                 label = label.long()
                 message = message.to(self.device)
                 label = label.to(self.device)
-                if self.model_mode == "RNN":
-                    output = self.model(message, message_lengths).squeeze(1)
-                if self.model_mode == "CNN":
-                    output = self.model(message).squeeze(1)
-
-                # Loss
-                loss = self.loss_function(output, label)
-                batch_loss += loss.item()
-                batch_count += 1
-                max_preds = output.argmax(dim=1, keepdim=True)  # get the index of the max probability
-
-                # saving the logits and labels of this batch
-                for i, batch_vector in enumerate(max_preds):
-                    max_preds_cache[idx * batch_size + i] = batch_vector
-                for i, batch_vector in enumerate(output):
-                    logits_cache[idx * batch_size + i] = batch_vector
-                for i, value in enumerate(label):
-                    labels_cache[idx * batch_size + i] = value
+                self.timer.add_tokens('valid', count_tokens(message, message_lengths if self.model_mode == "RNN" else None,
+                                                            self.pad_idx))
+                with self.timer.phase('valid/forward'):
+                    with autocast(self.device, self.mixed_precision):
+                        if self.model_mode == "RNN":
+                            output = self.model(message, message_lengths).squeeze(1)
+                        if self.model_mode == "CNN":
+                            output = self.model(message).squeeze(1)
+                    output = output.float()
+
+                    # Loss
+                    loss = self.loss_function(output, label)
+
+                with self.timer.phase('valid/metrics'):
+                    batch_loss += loss.item()
+                    batch_count += 1
+                    epoch_metrics.update(output, label)
 
                 # Prints loss statistics after number of steps specified.
                 if (idx + 1)%self.params['display_stats_freq'] == 0:
-                    print('Epoch {:02} | Batch {:03}-{:03} | Val. loss: {:.3f}'.
-                          format(self.epoch, previous_idx, idx, batch_loss / batch_count))
+                    if self.rank == 0:
+                        print('Epoch {:02} | Batch {:03}-{:03} | Val. loss: {:.3f}'.
+                              format(self.epoch, previous_idx, idx, batch_loss / batch_count))
                     previous_idx = idx + 1
                     batch_loss = 0
                     batch_count = 0
 
+        self.valid_data_wait = valid_loader.data_wait_time
+        self.timer.add('valid/data', self.valid_data_wait, calls=max(len(valid_loader), 1))
+        if self.world_size > 1:
+            epoch_metrics.all_reduce()
+
         '''Metrics calculation over the whole set'''
-        max_preds_cache = max_preds_cache.cpu()
-        labels_cache = labels_cache.cpu()
-
-        epoch_accuracy = metrics.accuracy_score(labels_cache, max_preds_cache)
-        # epoch_f1_score = metrics.f1_score(labels_cache, max_preds_cache, average='macro')
-        # epoch_precision = metrics.precision_score(labels_cache, max_preds_cache, average='macro')
-        # epoch_recall = metrics.recall_score(labels_cache, max_preds_cache, average='macro')
-
-        epoch_f1_score = metrics.f1_score(labels_cache, max_preds_cache, average=None)
-        epoch_precision = metrics.precision_score(labels_cache, max_preds_cache, average=None)
-        epoch_recall = metrics.recall_score(labels_cache, max_preds_cache, average=None)
-        epoch_f1_score = (epoch_f1_score[1] + epoch_f1_score[2]) / 2
-        epoch_precision = (epoch_precision[1] + epoch_precision[2]) / 2
-        epoch_recall = (epoch_recall[1] + epoch_recall[2]) / 2
-        labels_cache = labels_cache.long()
-        logits_cache = logits_cache.float()
-
-        # Loss
-        loss = self.loss_function(logits_cache.to(self.device), labels_cache.to(self.device))
-        epoch_loss = loss.item()
+        epoch_loss, epoch_accuracy, epoch_f1_score, epoch_precision, epoch_recall = epoch_metrics.compute()
 
         self.model.train()
         return epoch_loss, epoch_accuracy, epoch_f1_score, epoch_precision, epoch_recall
 
 
-    def savings(self):
+    def checkpoint(self, step_states=None):
+        '''
+        Everything needed to resume the training.
+        :step_states: state of the current epoch in every process, for a checkpoint within the epoch;
+            `epoch` is then the number of the completed epochs.
+        '''
+        return {'epoch': self.epoch if step_states is None else self.epoch - 1,
+                'model_state_dict': self.model.state_dict(),
+                'optimizer_state_dict': self.optimiser.state_dict(),
+                'scaler_state_dict': self.scaler.state_dict() if self.scaler else None,
+                'num_epoch': self.num_epochs,
+                'model_info': self.model_info, 'best_loss': self.best_loss,
+                'epoch_losses': self.checkpoint_writer.epoch_losses(),
+                'early_stopping': self.early_stopping.state_dict() if self.early_stopping else None,
+                'step_states': step_states}
+
+
+    def save_step_checkpoint(self, train_loader, epoch_metrics, num_batches):
+        '''
+        Checkpoint within an epoch, after `num_batches` batches: besides the model and the optimiser,
+        the position of the training iterator, the random generators and the metrics accumulated so far,
+        so that the resumed training continues with the next batch of the same epoch.
+        In a distributed training the states of all the processes are gathered into the checkpoint of rank 0.
+        '''
+        loader_state = train_loader.state_dict()
+        # the prefetching thread is ahead of the training loop
+        loader_state['iterations_this_epoch'] = num_batches
+        step_state = {'loader': loader_state, 'metrics': epoch_metrics.state_dict(), 'rng': rng_state()}
+        step_states = [step_state]
+        if self.world_size > 1:
+            step_states = [None] * self.world_size
+            dist.all_gather_object(step_states, step_state)
+        if self.rank == 0:
+            self.checkpoint_writer.save(self.checkpoint(step_states),
+                                        self.params['network_output_path'] + '/' + self.params['checkpoint_name'])
+
+
+    def savings(self, epoch_loss):
+        '''
+        Writes the config, the model of the epoch and the checkpoint through the checkpoint writer
+        (in the background, atomically); the epoch{N}_ model files beyond the retention policy of the config
+        (checkpoint_keep_last, checkpoint_keep_best) are deleted.
+        '''
         # Saves information about training to config file
         self.model_info['num_steps'] = self.epoch
         self.model_info['trained_time'] = "{:%B %d, %Y, %H:%M:%S}".format(datetime.datetime.now())
         self.params['Network'] = self.model_info
-        write_config(self.params, self.cfg_path, sort_keys=True)
+        self.checkpoint_writer.write_config(self.params, self.cfg_path)
 
         # Saving every 5 epochs
         if (self.epoch) % self.params['network_save_freq'] == 0:
-            torch.save(self.model.state_dict(), self.params['network_output_path'] + '/' +
-                       'epoch{}_'.format(self.epoch) + self.params['trained_model_name'])
+            self.checkpoint_writer.save_epoch_model(self.model.state_dict(), self.params['network_output_path'] + '/' +
+                                                    'epoch{}_'.format(self.epoch) + self.params['trained_model_name'],
+                                                    self.epoch, epoch_loss)
 
         # Save a checkpoint every epoch
-        torch.save({'epoch': self.epoch,
-                    'model_state_dict': self.model.state_dict(),
-                    'optimizer_state_dict': self.optimiser.state_dict(),
-                    'loss': self.loss_function, 'num_epoch': self.num_epochs,
-                    'model_info': self.model_info, 'best_loss': self.best_loss},
-                   self.params['network_output_path'] + '/' + self.params['checkpoint_name'])
+        self.checkpoint_writer.save(self.checkpoint(),
+                                    self.params['network_output_path'] + '/' + self.params['checkpoint_name'])
 
 
     def calculate_tb_stats(self, train_loss, train_F1, train_recall, train_precision, train_accuracy,
@@ -411,8 +648,16 @@ class Prediction:
     '''
     This class represents prediction (testing) process similar to the Training class.
     '''
-    def __init__(self, cfg_path, classes, model_mode='RNN', cfg_path_RNN=None, cfg_path_CNN=None):
-        self.params = read_config(cfg_path)
+    def __init__(self, cfg_path, classes, model_mode='RNN', cfg_path_RNN=None, cfg_path_CNN=None, num_prefetch=2,
+                 mixed_precision=False):
+        '''
+        :cfg_path (string): path of the experiment config file; None for a predictor without experiment (see from_bundle)
+        :num_prefetch (int): number of batches prepared ahead in a background thread (0: no prefetching)
+        :mixed_precision (bool): autocast of the forward pass to bfloat16 (cpu) or float16 (GPU)
+        '''
+        self.params = read_config(cfg_path) if cfg_path else {}
+        self.num_prefetch = num_prefetch
+        self.mixed_precision = mixed_precision
         if cfg_path_CNN:
             self.params_RNN = read_config(cfg_path_RNN)
             self.params_CNN = read_config(cfg_path_CNN)
@@ -420,6 +665,41 @@ class Prediction:
         self.setup_cuda()
         self.model_mode = model_mode
         self.classes = classes
+        # stoi of the vocabulary, set by from_bundle
+        self.vocab_idx = None
+
+    @classmethod
+    def from_bundle(cls, bundle_path, num_prefetch=2, mixed_precision=False):
+        '''
+        Predictor of the model of an inference bundle (see utils/inference_bundle.py), ready for
+        manual_predict and predict_texts (predictor.classes, predictor.vocab_idx), without any experiment config.
+        '''
+        bundle = load_bundle(bundle_path)
+        predictor = cls(None, classes=bundle['labels'], model_mode=bundle['model_mode'],
+                        num_prefetch=num_prefetch, mixed_precision=mixed_precision)
+        hyperparameters = bundle['hyperparameters']
+        vocab_size = bundle['vocab_size']
+        # the weights of the bundle replace the initial embeddings
+        embeddings = torch.zeros((vocab_size, hyperparameters['embedding_dim']))
+        model = biLSTM if bundle['model_mode'] == "RNN" else CNN1d
+        predictor.model_p = model(vocab_size=vocab_size, embeddings=embeddings, pad_idx=bundle['PAD_IDX'],
+                                  unk_idx=bundle['UNK_IDX'], **hyperparameters)
+        predictor.model_p.load_state_dict(bundle['model_state_dict'])
+        predictor.model_p = predictor.model_p.to(predictor.device)
+        predictor.model_p.eval()
+        predictor.pad_idx = bundle['PAD_IDX']
+        # the memory-mapped vocabulary index exported with the bundle (the tokens are not decoded),
+        # otherwise a dictionary
+        if os.path.isdir(vocab_index_path(bundle_path)):
+            predictor.vocab_idx = VocabIndex.load(vocab_index_path(bundle_path))
+        else:
+            predictor.vocab_idx = Stoi(bundle_itos(bundle), bundle['UNK_IDX'])
+        return predictor
+
+    def read_params(self):
+        '''Reads the params again, to check if any params have been changed by user'''
+        if self.cfg_path:
+            self.params = read_config(self.cfg_path)
 
     def setup_cuda(self, cuda_device_id=0):
         if torch.cuda.is_available():
@@ -439,18 +719,24 @@ class Prediction:
 
     def setup_model(self, model, vocab_size, embeddings, embedding_dim,
                     hidden_dim, pad_idx, unk_idx, model_file_name=None, epoch=19,
-                    conv_out_ch=200, filter_sizes=[3,4,5], model_c =CNN1d, model_r=biLSTM):
+                    conv_out_ch=200, filter_sizes=[3,4,5], model_c =CNN1d, model_r=biLSTM,
+                    embedding_backend='dense', num_buckets=None):
+        '''
+        :epoch: the model file of this epoch (epoch{N}_), None: the best model of the training
+        :embedding_backend, num_buckets: the embedding table of the trained model, see models/embeddings.py
+        '''
         if model_file_name == None:
             model_file_name = self.params['trained_model_name']
+        self.pad_idx = pad_idx
         if self.model_mode == "RNN":
             self.model_p = model(vocab_size=vocab_size, embeddings=embeddings, embedding_dim=embedding_dim,
-                                 hidden_dim=hidden_dim, pad_idx=pad_idx, unk_idx=unk_idx).to(self.device)
+                                 hidden_dim=hidden_dim, pad_idx=pad_idx, unk_idx=unk_idx,
+                                 embedding_backend=embedding_backend, num_buckets=num_buckets).to(self.device)
         elif self.model_mode == "CNN":
             self.model_p = model(vocab_size=vocab_size, embeddings=embeddings, embedding_dim=embedding_dim,
-                                 conv_out_ch=conv_out_ch, filter_sizes=filter_sizes, pad_idx=pad_idx, unk_idx=unk_idx).to(self.device)
+                                 conv_out_ch=conv_out_ch, filter_sizes=filter_sizes, pad_idx=pad_idx, unk_idx=unk_idx,
+                                 embedding_backend=embedding_backend, num_buckets=num_buckets).to(self.device)
         elif self.model_mode == "ensemble":
-            model_file_name_c = self.params_CNN['trained_model_name']
-            model_file_name_r = self.params_RNN['trained_model_name']
             self.model_cnn = model_c(vocab_size=vocab_size, embeddings=embeddings, embedding_dim=embedding_dim,
                                  conv_out_ch=conv_out_ch, filter_sizes=filter_sizes, pad_idx=pad_idx, unk_idx=unk_idx).to(self.device)
             self.model_rnn = model_r(vocab_size=vocab_size, embeddings=embeddings, embedding_dim=embedding_dim,
@@ -458,29 +744,38 @@ class Prediction:
 
         # Loads model from model_file_name and default network_output_path
         if self.model_mode == "ensemble":
+            model_file_c, model_file_r = self.ensemble_model_files()
             # self.model_cnn.load_state_dict(torch.load(self.params_CNN['network_output_path'] + "/" + model_file_name_c))
-            self.model_cnn.load_state_dict(
-                torch.load(self.params_CNN['network_output_path'] + "/epoch" + str(19) + "_" + model_file_name_c))
+            self.model_cnn.load_state_dict(torch.load(model_file_c))
             # self.model_rnn.load_state_dict(torch.load(self.params_RNN['network_output_path'] + "/" + model_file_name_r))
-            self.model_rnn.load_state_dict(
-                torch.load(self.params_RNN['network_output_path'] + "/epoch" + str(43) + "_" + model_file_name_r))
+            self.model_rnn.load_state_dict(torch.load(model_file_r))
         else:
-            # self.model_p.load_state_dict(torch.load(self.params['network_output_path'] + "/" + model_file_name))
-            self.model_p.load_state_dict(torch.load(self.params['network_output_path'] + "/epoch" + str(epoch) + "_" + model_file_name))
+            if epoch is None:
+                # the best model of the training
+                self.model_p.load_state_dict(torch.load(self.params['network_output_path'] + "/" + model_file_name))
+            else:
+                self.model_p.load_state_dict(torch.load(self.params['network_output_path'] + "/epoch" + str(epoch) + "_" + model_file_name))
+
+
+    def ensemble_model_files(self, epoch_c=19, epoch_r=43):
+        '''Model files of the CNN and of the biLSTM of the ensemble'''
+        return (self.params_CNN['network_output_path'] + "/epoch" + str(epoch_c) + "_" + self.params_CNN['trained_model_name'],
+                self.params_RNN['network_output_path'] + "/epoch" + str(epoch_r) + "_" + self.params_RNN['trained_model_name'])
 
 
     def predict(self, test_loader, batch_size):
         # Reads params to check if any params have been changed by user
-        self.params = read_config(self.cfg_path)
+        self.read_params()
         self.model_p.eval()
 
         start_time = time.time()
-        with torch.no_grad():
-            # initializing the caches
-            logits_cache = torch.from_numpy(np.zeros((len(test_loader) * batch_size, 3)))
-            max_preds_cache = torch.from_numpy(np.zeros((len(test_loader) * batch_size, 1)))
-            labels_cache = torch.from_numpy(np.zeros(len(test_loader) * batch_size))
+        # opt-in torch.profiler window over the prediction steps (the "profiler" section of the config)
+        profiler = build_profiler(self.params, 'predict', self.device)
+        with torch.no_grad(), profiler:
+            # metrics of the whole set, accumulated on the device
+            test_metrics = MetricsAccumulator(device=self.device)
 
+            test_loader = PrefetchLoader(test_loader, self.device, self.num_prefetch)
             for idx, batch in enumerate(test_loader):
                 if self.model_mode == "RNN":
                     message, message_lengths = batch.text
@@ -491,45 +786,28 @@ class Prediction:
                 label = label.long()
                 message = message.to(self.device)
                 label = label.to(self.device)
-                if self.model_mode == "RNN":
-                    output = self.model_p(message, message_lengths).squeeze(1)
-                if self.model_mode == "CNN":
-                    output = self.model_p(message).squeeze(1)
-                max_preds = output.argmax(dim=1, keepdim=True)  # get the index of the max probability
+                with autocast(self.device, self.mixed_precision):
+                    if self.model_mode == "RNN":
+                        output = self.model_p(message, message_lengths).squeeze(1)
+                    if self.model_mode == "CNN":
+                        output = self.model_p(message).squeeze(1)
+                output = output.float()
+                test_metrics.update(output, label)
+                profiler.step()
 
-                # saving the logits and labels of this batch
-                for i, batch_vector in enumerate(max_preds):
-                    max_preds_cache[idx * batch_size + i] = batch_vector
-                for i, batch_vector in enumerate(output):
-                    logits_cache[idx * batch_size + i] = batch_vector
-                for i, value in enumerate(label):
-                    labels_cache[idx * batch_size + i] = value
+        data_wait_time = test_loader.data_wait_time
 
         '''Metrics calculation over the whole set'''
-        max_preds_cache = max_preds_cache.cpu()
-        labels_cache = labels_cache.cpu()
-
-        # average=None gives individual scores for each class
         # here we only care about the average of positive class and negative class
-        final_accuracy = metrics.accuracy_score(labels_cache, max_preds_cache)
-        # final_f1_score = metrics.f1_score(labels_cache, max_preds_cache, average='macro')
-        # final_precision = metrics.precision_score(labels_cache, max_preds_cache, average='macro')
-        # final_recall = metrics.recall_score(labels_cache, max_preds_cache, average='macro')
-
-        final_f1_score = metrics.f1_score(labels_cache, max_preds_cache, average=None)
-        final_precision = metrics.precision_score(labels_cache, max_preds_cache, average=None)
-        final_recall = metrics.recall_score(labels_cache, max_preds_cache, average=None)
-        final_f1_score = (final_f1_score[1] + final_f1_score[2]) / 2
-        final_precision = (final_precision[1] + final_precision[2]) / 2
-        final_recall = (final_recall[1] + final_recall[2]) / 2
-        confusion_matrix = metrics.confusion_matrix(labels_cache, max_preds_cache, labels=[0,1,2])
+        _, final_accuracy, final_f1_score, final_precision, final_recall = test_metrics.compute()
+        confusion_matrix = test_metrics.confusion_matrix.cpu().numpy()
 
         end_time = time.time()
         test_mins, test_secs = self.epoch_time(start_time, end_time)
 
         # Print the final evaluation metrics
         print('\n----------------------------------------------------------------------')
-        print(f'Testing | Testing Time: {test_mins}m {test_secs}s')
+        print(f'Testing | Testing Time: {test_mins}m {test_secs}s | Data wait: {data_wait_time:.1f}s')
         print(f'\tAcc: {final_accuracy * 100:.2f}% | F1 score: {final_f1_score:.3f} | '
               f'Recall: {final_recall:.3f} | Precision: {final_precision:.3f}')
         print('----------------------------------------------------------------------\n')
@@ -539,76 +817,51 @@ class Prediction:
         return final_accuracy, final_f1_score
 
 
-    def predict_ensemble(self, test_iterator_RNN, test_iterator_CNN, batch_size):
-        "prediction with ensembling CNN and RNN outputs by normal averaging"
+    def predict_ensemble(self, test_iterator, batch_size):
+        '''
+        prediction with ensembling CNN and RNN outputs by normal averaging
+        :test_iterator: iterator of the 'ensemble' model_mode of the data handler (time-major with lengths);
+            the batch-first input of the CNN is the transpose of the same batch.
+        '''
 
         # Reads params to check if any params have been changed by user
-        self.params = read_config(self.cfg_path)
+        self.read_params()
         self.model_cnn.eval()
         self.model_rnn.eval()
 
         start_time = time.time()
-        with torch.no_grad():
-            # initializing the caches
-            logits_cache = torch.from_numpy(np.zeros((len(test_iterator_RNN) * batch_size, 3)))
-            max_preds_cache = torch.from_numpy(np.zeros((len(test_iterator_RNN) * batch_size, 1)))
-            labels_cache = torch.from_numpy(np.zeros(len(test_iterator_RNN) * batch_size))
-
-            for idx, (batch_RNN, batch_CNN) in enumerate(zip(test_iterator_RNN, test_iterator_CNN)):
-
-                # RNN part
-                message, message_lengths = batch_RNN.text
-                label = batch_RNN.label
+        # opt-in torch.profiler window over the prediction steps (the "profiler" section of the config)
+        profiler = build_profiler(self.params, 'predict', self.device)
+        with torch.no_grad(), profiler:
+            # metrics of the whole set, accumulated on the device
+            test_metrics = MetricsAccumulator(device=self.device)
+
+            test_iterator = PrefetchLoader(test_iterator, self.device, self.num_prefetch)
+            for idx, batch in enumerate(test_iterator):
+                message, message_lengths = batch.text
+                label = batch.label
                 message = message.long()
                 label = label.long()
                 message = message.to(self.device)
                 label = label.to(self.device)
-                output_RNN = self.model_rnn(message, message_lengths).squeeze(1)
 
-                #CNN part
-                message = batch_CNN.text
-                label = batch_CNN.label
-                message = message.long()
-                label = label.long()
-                message = message.to(self.device)
-                label = label.to(self.device)
-                output_CNN = self.model_cnn(message).squeeze(1)
-
-                output = (output_CNN + output_RNN) / 2
-                max_preds = output.argmax(dim=1, keepdim=True)  # get the index of the max probability
-                # saving the logits and labels of this batch
-                for i, batch_vector in enumerate(max_preds):
-                    max_preds_cache[idx * batch_size + i] = batch_vector
-                for i, batch_vector in enumerate(output):
-                    logits_cache[idx * batch_size + i] = batch_vector
-                for i, value in enumerate(label):
-                    labels_cache[idx * batch_size + i] = value
+                output = self.ensemble_forward(message, message_lengths)
+                test_metrics.update(output, label)
+                profiler.step()
 
-        '''Metrics calculation over the whole set'''
-        max_preds_cache = max_preds_cache.cpu()
-        labels_cache = labels_cache.cpu()
+        data_wait_time = test_iterator.data_wait_time
 
-        # average=None gives individual scores for each class
+        '''Metrics calculation over the whole set'''
         # here we only care about the average of positive class and negative class
-        final_accuracy = metrics.accuracy_score(labels_cache, max_preds_cache)
-        # final_f1_score = metrics.f1_score(labels_cache, max_preds_cache, average='macro')
-        # final_precision = metrics.precision_score(labels_cache, max_preds_cache, average='macro')
-        # final_recall = metrics.recall_score(labels_cache, max_preds_cache, average='macro')
-
-        final_f1_score = metrics.f1_score(labels_cache, max_preds_cache, average=None)
-        final_precision = metrics.precision_score(labels_cache, max_preds_cache, average=None)
-        final_recall = metrics.recall_score(labels_cache, max_preds_cache, average=None)
-        final_f1_score = (final_f1_score[1] + final_f1_score[2]) / 2
-        final_precision = (final_precision[1] + final_precision[2]) / 2
-        final_recall = (final_recall[1] + final_recall[2]) / 2
-        confusion_matrix = metrics.confusion_matrix(labels_cache, max_preds_cache, labels=[0,1,2])
+        _, final_accuracy, final_f1_score, final_precision, final_recall = test_metrics.compute()
+        confusion_matrix = test_metrics.confusion_matrix.cpu().numpy()
 
         end_time = time.time()
         test_mins, test_secs = self.epoch_time(start_time, end_time)
 
         # Print the final evaluation metrics
         print('\n----------------------------------------------------------------------')
-        print(f'Testing | Testing Time: {test_mins}m {test_secs}s')
+        print(f'Testing | Testing Time: {test_mins}m {test_secs}s | Data wait: {data_wait_time:.1f}s')
         print(f'\tAcc: {final_accuracy * 100:.2f}% | F1 score: {final_f1_score:.3f} | '
               f'Recall: {final_recall:.3f} | Precision: {final_precision:.3f}')
         print('----------------------------------------------------------------------\n')
@@ -618,6 +871,45 @@ class Prediction:
         return final_accuracy, final_f1_score
 
 
+    def ensemble_forward(self, message, message_lengths):
+        '''
+        Average of the logits of the CNN and of the RNN
+        :message: [sent len, batch size] (the layout of the RNN); the CNN gets its transpose
+        '''
+        with autocast(self.device, self.mixed_precision):
+            # RNN part
+            output_RNN = self.model_rnn(message, message_lengths).squeeze(1)
+
+            #CNN part: message = [sent len, batch size] -> [batch size, sent len]
+            output_CNN = self.model_cnn(message.t()).squeeze(1)
+
+        return (output_CNN.float() + output_RNN.float()) / 2
+
+
+    def ensemble_logits(self, iterator):
+        '''
+        Logits of the ensemble for every example of the iterator, the soft targets of the distillation
+        (see models/distillation.py).
+        :iterator: iterator of the 'ensemble' model_mode whose batches carry the example index (with_index of the data handler)
+        Returns a [number of examples, number of classes] cpu tensor, row i for the example of index i
+        '''
+        self.model_cnn.eval()
+        self.model_rnn.eval()
+
+        start_time = time.time()
+        logits = torch.zeros((len(iterator.dataset), len(self.classes)))
+        with torch.no_grad():
+            iterator = PrefetchLoader(iterator, self.device, self.num_prefetch)
+            for batch in iterator:
+                message, message_lengths = batch.text
+                output = self.ensemble_forward(message.long().to(self.device), message_lengths)
+                logits[batch.index.cpu()] = output.cpu()
+
+        test_mins, test_secs = self.epoch_time(start_time, time.time())
+        print(f'Soft targets of {len(logits):,} examples | Time: {test_mins}m {test_secs}s')
+        return logits
+
+
     def plot_confusion_matrix(self, cm, target_names,
                               title='Confusion matrix', cmap=None, normalize=False):
         """
@@ -631,6 +923,9 @@ class Prediction:
         normalize:    If False, plot the raw numbers
                       If True, plot the proportions
         """
+        # only imported for plotting, it slows down the import of this module
+        import matplotlib.pyplot as plt
+
         accuracy = np.trace(cm) / np.sum(cm).astype('float')
         misclass = 1 - accuracy
 
@@ -666,19 +961,64 @@ class Prediction:
         plt.show()
 
 
+    def predict_texts(self, texts, vocab_idx=None, batch_size=256, min_len=4, n_process=1):
+        '''
+        Predicts the polarity of many texts at once, in batches:
+        the texts are tokenized in bulk (tokenize_corpus), sorted by length (little padding,
+        and the order needed by the packed padded sequences of the RNN) and padded per batch.
+        The texts shorter than min_len tokens are padded to min_len tokens, like in manual_predict.
+        :texts: list of strings
+        :vocab_idx: stoi or VocabIndex of the vocabulary of the model (unknown tokens map to <unk>);
+            default: the one of the bundle
+        :n_process: number of worker processes of the spaCy tokenization
+        Returns the labels (list) and the probabilities of the classes [number of texts, number of classes] (numpy),
+        in the order of texts
+        '''
+        if vocab_idx is None:
+            vocab_idx = self.vocab_idx
+        self.model_p.eval()
+
+        tokenized = tokenize_corpus([str(text) for text in texts], n_process=n_process)
+        indexed = [ids + [self.pad_idx] * (min_len - len(ids)) for ids in numericalize(vocab_idx, tokenized)]
+        order = sorted(range(len(indexed)), key=lambda i: len(indexed[i]), reverse=True)
+
+        probabilities = torch.zeros((len(indexed), len(self.classes)))
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                batch_order = order[start:start + batch_size]
+                lengths = torch.LongTensor([len(indexed[i]) for i in batch_order])
+                # message = [batch size, sent len]
+                message = torch.full((len(batch_order), int(lengths[0])), self.pad_idx, dtype=torch.long)
+                for row, i in enumerate(batch_order):
+                    message[row, :lengths[row]] = torch.LongTensor(indexed[i])
+                message = message.to(self.device)
+                with autocast(self.device, self.mixed_precision):
+                    if self.model_mode == "RNN":
+                        output = self.model_p(message.t(), lengths)
+                    if self.model_mode == "CNN":
+                        output = self.model_p(message)
+                probabilities[batch_order] = F.softmax(output.float(), dim=1).cpu()
+
+        labels = [self.classes[i] for i in probabilities.argmax(dim=1).tolist()]
+        return labels, probabilities.numpy()
+
+
     def manual_predict(self, labels, vocab_idx, phrase, min_len=4,
-                       tokenizer=spacy.load('en'), mode=None, prediction_mode='Manualpart1'):
+                       tokenizer=None, mode=None, prediction_mode='Manualpart1'):
         '''
         Manually predicts the polarity of the given sentence.
         Possible polarities: 1.neutral, 2.positive, 3.negative
+        :tokenizer: spaCy pipeline; default: the English pipeline, loaded once per process (see spacy_pipeline)
         '''
-        self.params = read_config(self.cfg_path)
+        if tokenizer is None:
+            tokenizer = spacy_pipeline()
+        self.read_params()
         self.model_p.eval()
 
         tokenized = [tok.text for tok in tokenizer.tokenizer(phrase)]
         if len(tokenized) < min_len:
             tokenized += ['<pad>'] * (min_len - len(tokenized))
-        indexed = [vocab_idx[t] for t in tokenized]
+        indexed = numericalize(vocab_idx, [tokenized])[0]
         tensor = torch.LongTensor(indexed).to(self.device)
         tensor = tensor.unsqueeze(1)
         preds = self.model_p(tensor, torch.Tensor([tensor.shape[0]]))
@@ -0,0 +1,437 @@
+'''
+Benchmarks of the data and training pipeline.
+The data directories are read from the config file, like in main.py.
+'''
+
+# Deep Learning Modules
+try:
+    # torchtext 0.9 - 0.11: the Field/Dataset/Iterator API is in torchtext.legacy
+    from torchtext.legacy import data
+except ImportError:
+    from torchtext import data
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+
+# User Defined Modules
+from configs.serde import *
+from Train_Test_Valid import Mode, autocast
+from data.data_handler import data_provider_PostReply
+from data.tokenization import read_rows, tokenize_corpus
+from models.biLSTM import biLSTM
+from models.CNN import CNN1d
+from models.metrics import MetricsAccumulator
+from models.optimisers import build_optimiser
+from models.embeddings import embedding_size
+from utils.distributed import launch, barrier
+from utils.inference_bundle import bundle_path, bundle_itos, load_bundle
+from data.vocab_index import VocabIndex
+from utils.checkpoint_writer import CheckpointWriter
+
+#System Modules
+import time
+import os
+import io
+import subprocess
+import sys
+import statistics
+import pickle
+import random
+import tracemalloc
+import tempfile
+import contextlib
+
+
+
+def build_model(MODEL_MODE, vocab_size, pretrained_embeddings, PAD_IDX, UNK_IDX, EMBEDDING_DIM=200, HIDDEN_DIM=300,
+                sparse=False, embedding_backend='dense', num_buckets=None):
+    if MODEL_MODE == 'RNN':
+        return biLSTM(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=EMBEDDING_DIM,
+                      hidden_dim=HIDDEN_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX, sparse=sparse,
+                      embedding_backend=embedding_backend, num_buckets=num_buckets)
+    return CNN1d(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=EMBEDDING_DIM,
+                 pad_idx=PAD_IDX, unk_idx=UNK_IDX, sparse=sparse,
+                 embedding_backend=embedding_backend, num_buckets=num_buckets)
+
+
+def forward(model, MODEL_MODE, batch):
+    '''Returns the padded message tensor of the batch and the logits'''
+    if MODEL_MODE == 'RNN':
+        message, message_lengths = batch.text
+        return message, model(message, message_lengths)
+    return batch.text, model(batch.text)
+
+
+
+def benchmark_tokenization(n_process=4, batch_size=1000):
+    '''
+    Throughput (docs/sec) of the torchtext Field tokenizer (one document at a time)
+    and of the multi-process nlp.pipe tokenization, on the SemEval and the post-reply training sets.
+    '''
+    params = read_config(CONFIG_PATH)
+    corpora = {'SemEval': (os.path.join(params['input_data_path'], params['train_file_name']),
+                           params['data_format'], False, 3),
+               'post-reply': (os.path.join(params['postreply_data_path'], params['training_post_reply_file_name']),
+                              params['reply_data_format'], True, 2)}
+    field_tokenizer = data.get_tokenizer('spacy')
+
+    print(f'\n{"corpus":<12}{"docs":>10}{"Field (docs/s)":>18}{"nlp.pipe (docs/s)":>20}{"speed-up":>10}')
+    for name, (file_path, data_format, skip_header, text_column) in corpora.items():
+        texts = [row[text_column] for row in read_rows(file_path, data_format, skip_header)]
+
+        start_time = time.time()
+        reference = [field_tokenizer(text.rstrip('\n')) for text in texts]
+        field_rate = len(texts) / (time.time() - start_time)
+
+        start_time = time.time()
+        tokens = tokenize_corpus(texts, n_process=n_process, batch_size=batch_size)
+        pipe_rate = len(texts) / (time.time() - start_time)
+
+        assert tokens == reference, 'the parallel tokenization does not match the Field tokenizer'
+        print(f'{name:<12}{len(texts):>10,}{field_rate:>18,.0f}{pipe_rate:>20,.0f}{pipe_rate / field_rate:>9.1f}x')
+
+
+
+def benchmark_batching(EXPERIMENT_NAME='new_october_CNN', BATCH_SIZE=256, MAX_TOKENS=8192, MAX_VOCAB_SIZE=750000,
+                       num_batches=200):
+    '''
+    Fixed BATCH_SIZE buckets vs token-budget batching on the post-reply training set, for both model families:
+    padding ratio, largest padded batch (bounds the peak memory) and training throughput (real tokens/sec).
+    '''
+    cfg_path = open_experiment(EXPERIMENT_NAME)['cfg_path']
+    torch.manual_seed(1)
+
+    print(f'\n{"model":<6}{"batching":<14}{"padding":>10}{"max batch tokens":>18}{"tokens/s":>12}')
+    for MODEL_MODE in ['RNN', 'CNN']:
+        for batching, max_tokens in [('fixed', None), ('token-budget', MAX_TOKENS)]:
+            data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=0.9,
+                                                   max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN,
+                                                   model_mode=MODEL_MODE, max_tokens=max_tokens)
+            train_iterator, _, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, _ = data_handler.data_loader()
+            model = build_model(MODEL_MODE, vocab_size, pretrained_embeddings, PAD_IDX, UNK_IDX)
+            optimiser = optim.Adam(model.parameters(), lr=1e-4)
+            loss_function = nn.CrossEntropyLoss(weight=weights)
+
+            num_tokens = 0
+            num_padded_tokens = 0
+            max_batch_tokens = 0
+            start_time = time.time()
+            for idx, batch in enumerate(train_iterator):
+                if idx == num_batches:
+                    break
+                message, output = forward(model, MODEL_MODE, batch)
+                loss = loss_function(output, batch.label)
+                optimiser.zero_grad()
+                loss.backward()
+                optimiser.step()
+                num_tokens += int((message != PAD_IDX).sum())
+                num_padded_tokens += message.numel()
+                max_batch_tokens = max(max_batch_tokens, message.numel())
+            elapsed_time = time.time() - start_time
+
+            padding = 1 - num_tokens / num_padded_tokens
+            print(f'{MODEL_MODE:<6}{batching:<14}{padding * 100:>9.2f}%{max_batch_tokens:>18,}'
+                  f'{num_tokens / elapsed_time:>12,.0f}')
+
+
+
+
+def benchmark_mixed_precision(EXPERIMENT_NAME='new_october_CNN', BATCH_SIZE=256, MAX_VOCAB_SIZE=750000,
+                              num_batches=500):
+    '''
+    float32 vs bfloat16 autocast on the cpu, for both model families:
+    mean training step time, and accuracy / F1 on the validation set after `num_batches` training steps.
+    '''
+    cfg_path = open_experiment(EXPERIMENT_NAME)['cfg_path']
+    device = torch.device('cpu')
+
+    print(f'\n{"model":<6}{"precision":<11}{"step (ms)":>11}{"Val. Acc":>10}{"Val. F1":>9}')
+    for MODEL_MODE in ['RNN', 'CNN']:
+        data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=0.9,
+                                               max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode=MODEL_MODE)
+        train_iterator, valid_iterator, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, _ = data_handler.data_loader()
+        for precision, mixed_precision in [('float32', False), ('bfloat16', True)]:
+            torch.manual_seed(1)
+            model = build_model(MODEL_MODE, vocab_size, pretrained_embeddings, PAD_IDX, UNK_IDX)
+            optimiser = optim.Adam(model.parameters(), lr=1e-4)
+            loss_function = nn.CrossEntropyLoss(weight=weights)
+
+            model.train()
+            step_time = 0.
+            num_steps = 0
+            while num_steps < num_batches:
+                for batch in train_iterator:
+                    if num_steps == num_batches:
+                        break
+                    start_time = time.perf_counter()
+                    with autocast(device, mixed_precision):
+                        _, output = forward(model, MODEL_MODE, batch)
+                    loss = loss_function(output.float(), batch.label)
+                    optimiser.zero_grad()
+                    loss.backward()
+                    optimiser.step()
+                    step_time += time.perf_counter() - start_time
+                    num_steps += 1
+
+            model.eval()
+            valid_metrics = MetricsAccumulator(weight=weights)
+            with torch.no_grad():
+                for batch in valid_iterator:
+                    with autocast(device, mixed_precision):
+                        _, output = forward(model, MODEL_MODE, batch)
+                    valid_metrics.update(output.float(), batch.label)
+            _, valid_acc, valid_F1, _, _ = valid_metrics.compute()
+            print(f'{MODEL_MODE:<6}{precision:<11}{step_time / num_steps * 1000:>11.1f}'
+                  f'{valid_acc * 100:>9.2f}%{valid_F1:>9.3f}')
+
+
+
+
+def optimiser_state_size(optimiser):
+    '''Bytes of the tensors of the optimiser state (moment buffers)'''
+    state_dicts = optimiser.state_dict().get('optimisers', [optimiser.state_dict()])
+    return sum(value.numel() * value.element_size() for state_dict in state_dicts
+               for param_state in state_dict['state'].values()
+               for value in param_state.values() if torch.is_tensor(value))
+
+
+
+def benchmark_sparse_embedding(EXPERIMENT_NAME='new_october_CNN', BATCH_SIZE=256, MAX_VOCAB_SIZE=750000,
+                               num_batches=200):
+    '''
+    Dense embedding + Adam vs sparse embedding + SparseAdam (and Adam for the rest), for both model families:
+    mean time of the optimiser step, mean time of the whole training step and memory of the optimiser state.
+    '''
+    cfg_path = open_experiment(EXPERIMENT_NAME)['cfg_path']
+
+    print(f'\n{"model":<6}{"embedding":<11}{"optimiser step (ms)":>21}{"train step (ms)":>17}{"optimiser state (MB)":>22}')
+    for MODEL_MODE in ['RNN', 'CNN']:
+        data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=0.9,
+                                               max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode=MODEL_MODE)
+        train_iterator, _, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, _ = data_handler.data_loader()
+        for embedding, sparse in [('dense', False), ('sparse', True)]:
+            torch.manual_seed(1)
+            model = build_model(MODEL_MODE, vocab_size, pretrained_embeddings, PAD_IDX, UNK_IDX, sparse=sparse)
+            optimiser = build_optimiser(model, optim.Adam, {'lr': 1e-4, 'weight_decay': 1e-4})
+            loss_function = nn.CrossEntropyLoss(weight=weights)
+
+            step_time = 0.
+            optimiser_time = 0.
+            for idx, batch in enumerate(train_iterator):
+                if idx == num_batches:
+                    break
+                start_time = time.perf_counter()
+                _, output = forward(model, MODEL_MODE, batch)
+                loss = loss_function(output, batch.label)
+                optimiser.zero_grad()
+                loss.backward()
+                optimiser_start_time = time.perf_counter()
+                optimiser.step()
+                optimiser_time += time.perf_counter() - optimiser_start_time
+                step_time += time.perf_counter() - start_time
+            num_steps = min(num_batches, len(train_iterator))
+
+            print(f'{MODEL_MODE:<6}{embedding:<11}{optimiser_time / num_steps * 1000:>21.1f}'
+                  f'{step_time / num_steps * 1000:>17.1f}{optimiser_state_size(optimiser) / 2 ** 20:>22,.1f}')
+
+
+
+def benchmark_embedding_backends(EXPERIMENT_NAME='new_october_CNN', BATCH_SIZE=256, MAX_VOCAB_SIZE=750000,
+                                 NUM_BUCKETS=100000, num_epochs=1):
+    '''
+    Dense float32 embedding vs the hashed (NUM_BUCKETS rows) and the int8 / float16 quantized embeddings,
+    for both model families: memory of the embedding table, size of the saved state dict (trained_model.pth)
+    and F1 on the validation set after `num_epochs` epochs of training.
+    '''
+    cfg_path = open_experiment(EXPERIMENT_NAME)['cfg_path']
+
+    print(f'\n{"model":<6}{"embedding":<11}{"table (MB)":>12}{"checkpoint (MB)":>17}{"Val. F1":>9}')
+    for MODEL_MODE in ['RNN', 'CNN']:
+        data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=0.9,
+                                               max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode=MODEL_MODE)
+        train_iterator, valid_iterator, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, _ = data_handler.data_loader()
+        for embedding_backend in ['dense', 'hashed', 'int8', 'float16']:
+            torch.manual_seed(1)
+            model = build_model(MODEL_MODE, vocab_size, pretrained_embeddings, PAD_IDX, UNK_IDX,
+                                embedding_backend=embedding_backend, num_buckets=NUM_BUCKETS)
+            optimiser = optim.Adam(model.parameters(), lr=1e-4)
+            loss_function = nn.CrossEntropyLoss(weight=weights)
+
+            model.train()
+            for epoch in range(num_epochs):
+                for batch in train_iterator:
+                    _, output = forward(model, MODEL_MODE, batch)
+                    loss = loss_function(output, batch.label)
+                    optimiser.zero_grad()
+                    loss.backward()
+                    optimiser.step()
+
+            model.eval()
+            valid_metrics = MetricsAccumulator(weight=weights)
+            with torch.no_grad():
+                for batch in valid_iterator:
+                    _, output = forward(model, MODEL_MODE, batch)
+                    valid_metrics.update(output, batch.label)
+            _, _, valid_F1, _, _ = valid_metrics.compute()
+
+            checkpoint = io.BytesIO()
+            torch.save(model.state_dict(), checkpoint)
+            print(f'{MODEL_MODE:<6}{embedding_backend:<11}{embedding_size(model.embedding) / 2 ** 20:>12,.1f}'
+                  f'{checkpoint.getbuffer().nbytes / 2 ** 20:>17,.1f}{valid_F1:>9.3f}')
+
+
+
+def distributed_training_worker(rank, world_size, cfg_path, MODEL_MODE, BATCH_SIZE, MAX_VOCAB_SIZE, num_batches):
+    '''One process of benchmark_distributed: times `num_batches` data parallel training steps'''
+    data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=0.9,
+                                           max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode=MODEL_MODE,
+                                           rank=rank, world_size=world_size)
+    train_iterator, _, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, _ = data_handler.data_loader()
+    model = build_model(MODEL_MODE, vocab_size, pretrained_embeddings, PAD_IDX, UNK_IDX)
+    parallel_model = DistributedDataParallel(model)
+    optimiser = optim.Adam(model.parameters(), lr=1e-4)
+    loss_function = nn.CrossEntropyLoss(weight=weights)
+
+    barrier()
+    start_time = time.time()
+    for idx, batch in enumerate(train_iterator):
+        if idx == num_batches:
+            break
+        _, output = forward(parallel_model, MODEL_MODE, batch)
+        loss = loss_function(output, batch.label)
+        optimiser.zero_grad()
+        loss.backward()
+        optimiser.step()
+    barrier()
+    elapsed_time = time.time() - start_time
+
+    if rank == 0:
+        throughput = world_size * num_batches * BATCH_SIZE / elapsed_time
+        print(f'{MODEL_MODE:<6}{world_size:>10}{torch.get_num_threads():>9}{throughput:>16,.0f}')
+
+
+
+def benchmark_distributed(EXPERIMENT_NAME='new_october_CNN', BATCH_SIZE=256, MAX_VOCAB_SIZE=750000,
+                          num_batches=100, num_processes=[1, 2, 4]):
+    '''
+    Scaling of the distributed data parallel training (gloo) on this machine, for both model families:
+    training throughput (tweets/sec over all the processes) with 1, 2, 4, ... processes sharing the cores.
+    The dataset cache should be built before (e.g. by benchmark_batching), so that the processes only load it.
+    '''
+    cfg_path = open_experiment(EXPERIMENT_NAME)['cfg_path']
+
+    print(f'\n{"model":<6}{"processes":>10}{"threads":>9}{"tweets/s":>16}')
+    for MODEL_MODE in ['RNN', 'CNN']:
+        for world_size in num_processes:
+            launch(distributed_training_worker, world_size, cfg_path, MODEL_MODE, BATCH_SIZE, MAX_VOCAB_SIZE,
+                   num_batches)
+
+
+def benchmark_import_time(modules=['data.data_processing', 'Train_Test_Valid', 'main'], repeats=5,
+                          heavy_modules=['torch', 'torchtext', 'spacy', 'matplotlib']):
+    '''
+    Cold-start cost of the modules: median wall time of `import module` in a fresh interpreter (without the
+    start-up of the interpreter itself), and which of the heavy libraries the import pulls in.
+    The data-processing tools should not import the training stack, and no module should load a spaCy model.
+    For the details of a module: python -X importtime -c "import module"
+    '''
+    script = ('import sys, time\n'
+              'start_time = time.perf_counter()\n'
+              'import {module}\n'
+              'print(time.perf_counter() - start_time)\n'
+              'print(",".join(name for name in {heavy_modules} if name in sys.modules))\n'
+              'print("spacy.lang.en" in sys.modules)\n')
+    repo_path = os.path.dirname(os.path.abspath(__file__))
+
+    print(f'\n{"module":<24}{"import (s)":>12}  {"spaCy model loaded":<20}heavy modules imported')
+    for module in modules:
+        times = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', script.format(module=module, heavy_modules=heavy_modules)],
+                                    cwd=repo_path, capture_output=True, text=True, check=True).stdout.splitlines()
+            times.append(float(output[0]))
+        print(f'{module:<24}{statistics.median(times):>12.2f}  {output[2]:<20}{output[1] or "-"}')
+
+
+def benchmark_vocab_index(EXPERIMENT_NAME='Adam_lr0.0001_max_vocab_size50000', num_tokens=1000000):
+    '''
+    Memory and lookup throughput of the stoi dictionary and of the VocabIndex (data/vocab_index.py),
+    for the vocabulary of the inference bundle of the experiment (see main_export_bundle).
+    The tokens looked up are half in the vocabulary and half unknown.
+    '''
+    itos = bundle_itos(load_bundle(bundle_path(open_experiment(EXPERIMENT_NAME))))
+    rng = random.Random(1)
+    tokens = [rng.choice(itos) if i % 2 else 'unknown' + str(i) for i in range(num_tokens)]
+
+    tracemalloc.start()
+    stoi = {token: idx for idx, token in enumerate(itos)}
+    stoi_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    index = VocabIndex.build(itos, unk_idx=0)
+
+    start_time = time.perf_counter()
+    stoi_ids = [stoi.get(token, 0) for token in tokens]
+    stoi_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    index_ids = index.lookup(tokens)
+    index_time = time.perf_counter() - start_time
+    assert stoi_ids == index_ids.tolist()
+
+    print(f'\nvocabulary: {len(itos):,} tokens')
+    print(f'{"":<14}{"memory (MB)":>13}{"pickled (MB)":>14}{"tokens/s":>14}')
+    print(f'{"stoi dict":<14}{stoi_bytes / 2**20:>13.1f}{len(pickle.dumps(stoi)) / 2**20:>14.1f}'
+          f'{num_tokens / stoi_time:>14,.0f}')
+    print(f'{"VocabIndex":<14}{index.nbytes / 2**20:>13.1f}{len(pickle.dumps(index)) / 2**20:>14.1f}'
+          f'{num_tokens / index_time:>14,.0f}')
+    print('(memory-mapped with VocabIndex.load, the index is shared by the processes and pickled as its path)')
+
+
+
+def benchmark_checkpointing(vocab_size=300000, EMBEDDING_DIM=200, BATCH_SIZE=256, num_epochs=6, steps_per_epoch=20):
+    '''
+    Checkpoint_BlockedTime: seconds per epoch the training loop is blocked by the writes of an epoch
+    (best model, epoch model, config and the checkpoint with the optimiser) of the CheckpointWriter:
+    synchronous, asynchronous save by save (a slot each, max_pending=1) and asynchronous with the writes
+    of an epoch grouped into one job (the model copied once).
+    A CNN1d with a random vocab_size x EMBEDDING_DIM table trained by Adam on random batches, into a temporary directory.
+    '''
+    print(f'\n{"writer":<22}{"blocked/epoch (s)":>19}{"epoch (s)":>11}')
+    for name, asynchronous, max_pending, grouped in [('sync', False, 1, False), ('async, save by save', True, 1, False),
+                                                    ('async, grouped', True, 2, True)]:
+        torch.manual_seed(1)
+        model = build_model('CNN', vocab_size, torch.randn(vocab_size, EMBEDDING_DIM), 1, 0, EMBEDDING_DIM=EMBEDDING_DIM)
+        optimiser = optim.Adam(model.parameters(), lr=1e-4)
+        with tempfile.TemporaryDirectory() as output_path:
+            writer = CheckpointWriter(asynchronous=asynchronous, max_pending=max_pending)
+            start_time = time.perf_counter()
+            for epoch in range(1, num_epochs + 1):
+                for _ in range(steps_per_epoch):
+                    text = torch.randint(vocab_size, (BATCH_SIZE, 50))
+                    loss = nn.functional.cross_entropy(model(text), torch.randint(3, (BATCH_SIZE,)))
+                    optimiser.zero_grad()
+                    loss.backward()
+                    optimiser.step()
+                with writer.group() if grouped else contextlib.nullcontext():
+                    writer.save(model.state_dict(), os.path.join(output_path, 'model.pt'))
+                    writer.write_config({'epoch': epoch}, os.path.join(output_path, 'config.json'))
+                    writer.save_epoch_model(model.state_dict(), os.path.join(output_path, f'epoch{epoch}_model.pt'),
+                                            epoch, 0.)
+                    writer.save({'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimiser.state_dict()},
+                                os.path.join(output_path, 'checkpoint.tar'))
+            writer.close()
+            total_time = time.perf_counter() - start_time
+        print(f'{name:<22}{writer.blocked_time / num_epochs:>19.2f}{total_time / num_epochs:>11.2f}')
+
+
+
+if __name__ == '__main__':
+    benchmark_tokenization()
+    # benchmark_batching()
+    # benchmark_mixed_precision()
+    # benchmark_distributed()
+    # benchmark_sparse_embedding()
+    # benchmark_embedding_backends()
+    # benchmark_import_time()
+    # benchmark_vocab_index()
+    # benchmark_checkpointing()
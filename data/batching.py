@@ -0,0 +1,83 @@
+"""
+Token-budget (dynamic) batching: instead of a fixed number of examples per batch,
+the batches are packed up to a maximum number of (padded) tokens.
+"""
+
+import random
+try:
+    # torchtext 0.9 - 0.11: the Field/Dataset/Iterator API is in torchtext.legacy
+    from torchtext.legacy import data
+except ImportError:
+    from torchtext import data
+
+
+class TokenBudgetIterator():
+    '''
+    Iterator over a torchtext Dataset, yielding torchtext Batches of at most `max_tokens` padded tokens
+    (number of examples * length of the longest example of the batch).
+    The examples are sorted by length and cut into batches once (the bucket index);
+    the index is reused every epoch and only the order of the batches is shuffled.
+    Within a batch the examples are sorted by decreasing length, as needed for packed padded sequences.
+    state_dict / load_state_dict: position within the epoch, like the torchtext Iterator,
+    so an interrupted epoch can be continued from the same batch.
+    '''
+    def __init__(self, dataset, max_tokens, max_batch_size=None, shuffle=True, seed=1, device=None):
+        '''
+        :max_batch_size: upper limit of the number of examples per batch, also for the very short ones
+        :shuffle: shuffles the order of the batches every epoch (training)
+        '''
+        self.dataset = dataset
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.device = device
+        self.random = random.Random(seed)
+        self.iterations_this_epoch = 0
+        self._random_state_this_epoch = self.random.getstate()
+        self._restored_from_state = False
+
+        lengths = [max(len(example.text), 1) for example in dataset.examples]
+        self.batches = []
+        batch = []
+        longest = 0
+        for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            longest = max(longest, lengths[idx])
+            if batch and (longest * (len(batch) + 1) > max_tokens or len(batch) == max_batch_size):
+                self.batches.append(batch)
+                batch = []
+                longest = lengths[idx]
+            batch.append(idx)
+        if batch:
+            self.batches.append(batch)
+
+        self.num_tokens = sum(lengths)
+        self.num_padded_tokens = sum(len(batch) * lengths[batch[-1]] for batch in self.batches)
+        # fraction of the padded tensors which are <pad>
+        self.padding_ratio = 1 - self.num_tokens / max(self.num_padded_tokens, 1)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def state_dict(self):
+        return {'iterations_this_epoch': self.iterations_this_epoch,
+                'random_state_this_epoch': self._random_state_this_epoch}
+
+    def load_state_dict(self, state_dict):
+        self.iterations_this_epoch = state_dict['iterations_this_epoch']
+        self._random_state_this_epoch = state_dict['random_state_this_epoch']
+        self._restored_from_state = True
+
+    def __iter__(self):
+        if self._restored_from_state:
+            # same order of the batches as in the interrupted epoch, skipping the batches already done
+            self.random.setstate(self._random_state_this_epoch)
+            self._restored_from_state = False
+        else:
+            self._random_state_this_epoch = self.random.getstate()
+            self.iterations_this_epoch = 0
+        order = list(range(len(self.batches)))
+        if self.shuffle:
+            self.random.shuffle(order)
+        for batch_idx in order[self.iterations_this_epoch:]:
+            self.iterations_this_epoch += 1
+            examples = [self.dataset.examples[idx] for idx in reversed(self.batches[batch_idx])]
+            yield data.Batch(examples, self.dataset, self.device)
@@ -7,26 +7,77 @@ https://tayebiarasteh.com/
 """
 
 import numpy as np
+import math
 import random
 import torch
-from torchtext import data
+try:
+    # torchtext 0.9 - 0.11: the Field/Dataset/Iterator API is in torchtext.legacy
+    from torchtext.legacy import data
+except ImportError:
+    from torchtext import data
 from Train_Test_Valid import Mode
 from configs.serde import read_config
 import os
-import pandas as pd
+from collections import Counter
 from configs.serde import *
+from data.dataset_cache import dataset_cache_key, load_dataset_cache, save_dataset_cache, \
+    embedding_cache_file, load_embedding_cache, save_embedding_cache
+from data.tokenization import tokenized_dataset
+from data.batching import TokenBudgetIterator
+from data.streaming import ShardedTextDataset, StreamingIterator, build_shards, load_shards
+from utils.distributed import barrier
 import pdb
 
 epsilon = 1e-15
 
 
-class data_provider_V2():
+def class_weights(label_counts, labels):
     '''
-    Data handler class for the Standard Twitter sentiment classifier
-    Packed padded sequences
-    Tokenizer: spacy
+    Weight of each class for the loss function: overall count / count of the class
+    :label_counts: dictionary of the number of examples of each label
+    :labels: labels in the order of the label vocabulary (LABEL.vocab.itos)
+    '''
+    overall = sum(label_counts.values())
+    return torch.Tensor([overall / label_counts[label] for label in labels])
+
+
+
+def shard_dataset(dataset, rank, world_size, seed=1, pad=True):
+    '''
+    Shard of one process of the distributed training (like the DistributedSampler):
+    the examples are shuffled with the same seed in every process and dealt out round-robin.
+    :pad: repeats the first examples so that all the shards have the same size (the training set);
+        without it the shards together hold every example exactly once (the validation set).
+    '''
+    examples = list(dataset.examples)
+    random.Random(seed).shuffle(examples)
+    if pad:
+        examples += examples[:math.ceil(len(examples) / world_size) * world_size - len(examples)]
+    return data.Dataset(examples[rank::world_size], fields=dataset.fields)
+
+
+
+def add_example_index(dataset):
+    '''
+    Adds the field `index` to the examples of the dataset: the position of the example in the dataset,
+    so that every batch carries the indices of its examples (batch.index), e.g. the keys of the soft targets of the distillation.
+    The index is assigned before any shuffling or sharding, hence is the same in every process and every run.
+    '''
+    for index, example in enumerate(dataset.examples):
+        example.index = index
+    dataset.fields['index'] = data.Field(sequential=False, use_vocab=False)
+    return dataset
+
+
+
+class data_provider_base():
+    '''
+    Shared parts of the data handler classes.
+    The subclasses set the paths, the file names and the data format in their constructor.
     '''
-    def __init__(self, cfg_path, batch_size=1, split_ratio=0.8, max_vocab_size=25000, mode=Mode.TRAIN, model_mode='RNN', seed=1):
+    def __init__(self, cfg_path, batch_size=1, split_ratio=0.8, max_vocab_size=25000, mode=Mode.TRAIN, model_mode='RNN', seed=1,
+                 streaming=False, streaming_workers=0, max_tokens=None, rank=0, world_size=1, embedding_cache_path=None,
+                 with_index=False):
         '''
         Args:
             cfg_path (string):
@@ -41,21 +92,246 @@ class data_provider_V2():
                 Nature of operation to be done with the data.
                 Possible inputs are Mode.PREDICTION, Mode.TRAIN, Mode.VALID, Mode.TEST
                 Default value: Mode.TRAIN
+            model_mode (string):
+                'RNN': time-major text with lengths, 'CNN': batch-first text,
+                'ensemble': the RNN layout, from which the batch-first layout of the CNN is a transpose
+            streaming (bool):
+                Out-of-core mode for corpora larger than the memory: the iterators read the numericalized
+                corpus lazily from shards on disk, see build_streaming_iterators.
+            streaming_workers (int):
+                number of DataLoader worker processes reading the training shards in streaming mode
+            max_tokens (int):
+                Token-budget batching: batches of a variable number of examples with at most max_tokens padded tokens,
+                instead of batch_size examples. Not used in streaming mode.
+            rank, world_size (int):
+                Distributed training: the process of this data handler and the number of processes,
+                see shard_dataset.
+            embedding_cache_path (string):
+                directory of the cached pretrained vectors of the vocabulary (default: the experiment directory);
+                a shared directory lets several experiments (e.g. the trials of a sweep) use the same cache.
+            with_index (bool):
+                the training batches carry the index of their examples in the training set (batch.index),
+                see add_example_index. Not available in streaming mode.
         '''
-        params = read_config(cfg_path)
+        self.params = read_config(cfg_path)
         self.cfg_path = cfg_path
         self.mode = mode
         self.seed = seed
         self.split_ratio = split_ratio
         self.max_vocab_size = max_vocab_size
-        self.dataset_path = params['input_data_path']
-        self.train_file_name = params['train_file_name']
-        self.test_file_name = params['test_file_name']
-        self.data_format = params['data_format']
-        self.pretrained_embedding = params['pretrained_embedding']
-        self.tokenizer = params['tokenizer']
+        self.pretrained_embedding = self.params['pretrained_embedding']
+        self.tokenizer = self.params['tokenizer']
+        self.tokenizer_processes = self.params.get('tokenizer_processes', 1)
+        self.tokenizer_batch_size = self.params.get('tokenizer_batch_size', 1000)
+        self.cache_path = self.params.get('dataset_cache_path', './data/cache/')
+        self.embedding_cache_path = embedding_cache_path or os.path.dirname(cfg_path)
         self.batch_size = batch_size
         self.model_mode = model_mode
+        self.streaming = streaming
+        self.streaming_workers = streaming_workers
+        self.max_tokens = max_tokens
+        self.rank = rank
+        self.world_size = world_size
+        self.with_index = with_index
+
+
+    def cache_key(self, mode='memory'):
+        return dataset_cache_key([os.path.join(self.dataset_path, self.train_file_name),
+                                  os.path.join(self.dataset_path, self.test_file_name)],
+                                 self.tokenizer + '-' + mode, self.max_vocab_size, self.split_ratio, self.seed)
+
+
+    def build_iterators(self, TEXT, LABEL, fields, skip_header):
+        '''
+        Returns train_iterator, valid_iterator, test_iterator, label_counts
+        label_counts: number of examples of each label in the whole training file (before the train-valid split)
+        In a distributed training the train and valid iterators only cover the shard of this process;
+        the first process builds (or loads) the caches, the others wait for it and then load them.
+        '''
+        if self.with_index and self.streaming:
+            raise ValueError('the example index (with_index) is only available for the in-memory datasets')
+        if self.rank != 0:
+            barrier()
+        if self.streaming:
+            iterators = self.build_streaming_iterators(TEXT, LABEL, fields, skip_header)
+        else:
+            iterators = self.build_memory_iterators(TEXT, LABEL, fields, skip_header)
+        if self.rank == 0:
+            barrier()
+        return iterators
+
+
+    def build_memory_iterators(self, TEXT, LABEL, fields, skip_header):
+        train_data, valid_data, test_data, label_counts = self.build_datasets(TEXT, LABEL, fields, skip_header)
+        if self.with_index:
+            train_data = add_example_index(train_data)
+        if self.world_size > 1:
+            train_data = shard_dataset(train_data, self.rank, self.world_size, seed=self.seed)
+            if valid_data:
+                valid_data = shard_dataset(valid_data, self.rank, self.world_size, pad=False)
+
+        if self.max_tokens:
+            train_iterator = TokenBudgetIterator(train_data, self.max_tokens, seed=self.seed)
+            test_iterator = TokenBudgetIterator(test_data, self.max_tokens, shuffle=False)
+            if self.split_ratio == 1:
+                valid_iterator = None
+            else:
+                valid_iterator = TokenBudgetIterator(valid_data, self.max_tokens, shuffle=False)
+            print(f'Token-budget batching: {len(train_iterator):,} training batches of at most {self.max_tokens:,} tokens '
+                  f'| padding ratio: {train_iterator.padding_ratio * 100:.2f}%')
+            return train_iterator, valid_iterator, test_iterator, label_counts
+
+        # for packed padded sequences all of the tensors within a batch need to be sorted by their lengths
+        if self.split_ratio == 1:
+            valid_iterator = None
+            train_iterator, test_iterator = data.BucketIterator.splits((
+                train_data, test_data), batch_size=self.batch_size,
+                sort_within_batch=True, sort_key=lambda x: len(x.text))
+        else:
+            train_iterator, valid_iterator, test_iterator = data.BucketIterator.splits((
+                train_data, valid_data, test_data), batch_size=self.batch_size,
+                sort_within_batch=True, sort_key=lambda x: len(x.text))
+        return train_iterator, valid_iterator, test_iterator, label_counts
+
+
+    def build_streaming_iterators(self, TEXT, LABEL, fields, skip_header):
+        '''
+        Streaming mode: the numericalized corpus is stored in shards under dataset_cache_path
+        and read lazily during the iteration, so the corpus is never held in memory.
+        The train-valid split is drawn per example while streaming (seeded), hence differs from the in-memory split.
+        '''
+        key = self.cache_key(mode='streaming')
+        cache_dir = os.path.join(self.cache_path, 'shards_' + key)
+        label_counts = load_shards(cache_dir, TEXT, LABEL)
+        if label_counts is None:
+            names = [name for name, _ in fields]
+            build_shards(cache_dir, os.path.join(self.dataset_path, self.train_file_name),
+                         os.path.join(self.dataset_path, self.test_file_name), self.data_format,
+                         text_column=names.index('text'), label_column=names.index('label'), skip_header=skip_header,
+                         TEXT=TEXT, LABEL=LABEL, max_vocab_size=self.max_vocab_size,
+                         split_ratio=self.split_ratio, seed=self.seed,
+                         n_process=self.tokenizer_processes, batch_size=self.tokenizer_batch_size)
+            label_counts = load_shards(cache_dir, TEXT, LABEL)
+        self.load_vectors(TEXT, key)
+
+        PAD_IDX = TEXT.vocab.stoi[TEXT.pad_token]
+        train_iterator = StreamingIterator(ShardedTextDataset(os.path.join(cache_dir, 'train'), seed=self.seed,
+                                                              rank=self.rank, world_size=self.world_size),
+                                           self.batch_size, PAD_IDX, self.model_mode, self.streaming_workers)
+        test_iterator = StreamingIterator(ShardedTextDataset(os.path.join(cache_dir, 'test'), shuffle=False),
+                                          self.batch_size, PAD_IDX, self.model_mode)
+        if self.split_ratio == 1:
+            valid_iterator = None
+        else:
+            valid_iterator = StreamingIterator(ShardedTextDataset(os.path.join(cache_dir, 'valid'), shuffle=False,
+                                                                  rank=self.rank, world_size=self.world_size),
+                                               self.batch_size, PAD_IDX, self.model_mode)
+        return train_iterator, valid_iterator, test_iterator, label_counts
+
+
+    def build_datasets(self, TEXT, LABEL, fields, skip_header):
+        '''
+        Reads, tokenizes and splits the data and builds the vocabularies of TEXT and LABEL.
+        The tokenized examples and the vocabularies are cached on disk (dataset_cache_path of the config),
+        the pretrained vectors of the vocabulary next to the experiment config (see load_vectors),
+        keyed on the content of the input files, the tokenizer, max_vocab_size and the split,
+        so a second run of the same experiment skips the tokenization.
+        The label histogram of the training file is counted from the same parse and cached as well.
+        Returns train_data, valid_data, test_data (valid_data is None when split_ratio == 1), label_counts
+        '''
+        key = self.cache_key()
+        cache = load_dataset_cache(self.cache_path, key)
+
+        if cache:
+            dataset_fields = [('label', LABEL), ('text', TEXT)]
+            train_data = data.Dataset(cache['train'], fields=dataset_fields)
+            test_data = data.Dataset(cache['test'], fields=dataset_fields)
+            if cache['valid'] is None:
+                valid_data = None
+            else:
+                valid_data = data.Dataset(cache['valid'], fields=dataset_fields)
+            TEXT.vocab = cache['text_vocab']
+            LABEL.vocab = cache['label_vocab']
+            self.load_vectors(TEXT, key)
+            return train_data, valid_data, test_data, cache['label_counts']
+
+        if self.tokenizer == 'spacy':
+            # parallel tokenization with nlp.pipe
+            train_data, test_data = [tokenized_dataset(os.path.join(self.dataset_path, file_name), self.data_format,
+                                                       fields, skip_header=skip_header,
+                                                       n_process=self.tokenizer_processes,
+                                                       batch_size=self.tokenizer_batch_size)
+                                     for file_name in [self.train_file_name, self.test_file_name]]
+        else:
+            train_data, test_data = data.TabularDataset.splits(
+                path=self.dataset_path,
+                train=self.train_file_name,
+                test=self.test_file_name,
+                format=self.data_format,
+                fields=fields,
+                skip_header=skip_header)
+
+        # the histogram of the whole training file, before the train-valid split
+        label_counts = dict(Counter(example.label for example in train_data.examples))
+
+        # validation data
+        if self.split_ratio == 1:
+            valid_data = None
+        else:
+            train_data, valid_data = train_data.split(random_state=random.seed(self.seed), split_ratio=self.split_ratio)
+
+        # create the vocabulary only on the training set!!!
+        TEXT.build_vocab(train_data, max_size=self.max_vocab_size)
+        LABEL.build_vocab(train_data)
+
+        save_dataset_cache(self.cache_path, key, {
+            'train': train_data.examples,
+            'valid': valid_data.examples if valid_data else None,
+            'test': test_data.examples,
+            'text_vocab': TEXT.vocab,
+            'label_vocab': LABEL.vocab,
+            'label_counts': label_counts})
+        self.load_vectors(TEXT, key)
+        return train_data, valid_data, test_data, label_counts
+
+
+    def load_vectors(self, TEXT, key):
+        '''
+        Sets TEXT.vocab.vectors.
+        vectors: instead of having our word embeddings initialized randomly, they are initialized with these pre-trained vectors.
+        Only the first time the whole pretrained embedding is loaded; the rows of our vocabulary are then stored
+        as a .npy file next to the experiment config, which is memory-mapped in the next runs.
+        '''
+        file_path = embedding_cache_file(self.embedding_cache_path, self.pretrained_embedding, key)
+        vectors = load_embedding_cache(file_path)
+        if vectors is not None:
+            TEXT.vocab.vectors = vectors
+            return
+        # initialize words in your vocabulary but not in your pre-trained embeddings to Gaussian
+        TEXT.vocab.load_vectors(self.pretrained_embedding, unk_init=torch.Tensor.normal_)
+        save_embedding_cache(file_path, TEXT.vocab.vectors)
+
+
+
+class data_provider_V2(data_provider_base):
+    '''
+    Data handler class for the Standard Twitter sentiment classifier
+    Packed padded sequences
+    Tokenizer: spacy
+    '''
+    def __init__(self, cfg_path, batch_size=1, split_ratio=0.8, max_vocab_size=25000, mode=Mode.TRAIN, model_mode='RNN', seed=1,
+                 streaming=False, streaming_workers=0, max_tokens=None, rank=0, world_size=1, embedding_cache_path=None,
+                 with_index=False):
+        '''
+        Data files: the tweets of input_data_path (train_file_name, test_file_name, data_format) of the config.
+        Args: see data_provider_base
+        '''
+        super().__init__(cfg_path, batch_size, split_ratio, max_vocab_size, mode, model_mode, seed,
+                         streaming, streaming_workers, max_tokens, rank, world_size, embedding_cache_path, with_index)
+        self.dataset_path = self.params['input_data_path']
+        self.train_file_name = self.params['train_file_name']
+        self.test_file_name = self.params['test_file_name']
+        self.data_format = self.params['data_format']
 
 
     def data_loader(self):
@@ -65,34 +341,17 @@ class data_provider_V2():
             Note: padding is done by adding <pad> (not zero!)
         :tokenize: the "tokenization" (the act of splitting the string into discrete "tokens") should be done using the spaCy tokenizer.
         '''
-        if self.model_mode == 'RNN':
+        if self.model_mode in ['RNN', 'ensemble']:
             #Packed padded sequences
+            # 'ensemble': the CNN uses the transpose (batch-first view) of the same batch
             TEXT = data.Field(tokenize=self.tokenizer, include_lengths=True)  # For saving the length of sentences
         if self.model_mode == 'CNN':
             TEXT = data.Field(tokenize=self.tokenizer, batch_first=True)  # batch dimension is the firs dimension here.
         LABEL = data.LabelField()
 
         fields = [('id', None), ('user_id', None),  ('label', LABEL), ('text', TEXT)]
-        train_data, test_data = data.TabularDataset.splits(
-            path=self.dataset_path,
-            train=self.train_file_name,
-            test=self.test_file_name,
-            format=self.data_format,
-            fields=fields,
-            skip_header=False)
-
-        # validation data
-        if self.split_ratio == 1:
-            valid_data = None
-        else:
-            train_data, valid_data = train_data.split(random_state=random.seed(self.seed), split_ratio=self.split_ratio)
-
-        # create the vocabulary only on the training set!!!
-        # vectors: instead of having our word embeddings initialized randomly, they are initialized with these pre-trained vectors.
-        # initialize words in your vocabulary but not in your pre-trained embeddings to Gaussian
-        TEXT.build_vocab(train_data, max_size=self.max_vocab_size,
-                         vectors=self.pretrained_embedding, unk_init=torch.Tensor.normal_)
-        LABEL.build_vocab(train_data)
+        train_iterator, valid_iterator, test_iterator, label_counts = self.build_iterators(
+            TEXT, LABEL, fields, skip_header=False)
 
         labels = LABEL.vocab.itos
         vocab_idx = TEXT.vocab.stoi
@@ -106,46 +365,8 @@ class data_provider_V2():
         # What do we do with words that appear in examples but we have cut from the vocabulary?
         # We replace them with a special unknown or <unk> token.
 
-        # for packed padded sequences all of the tensors within a batch need to be sorted by their lengths
-        if self.split_ratio == 1:
-            valid_iterator = None
-            train_iterator, test_iterator = data.BucketIterator.splits((
-                train_data, test_data), batch_size=self.batch_size,
-                sort_within_batch=True, sort_key=lambda x: len(x.text))
-        else:
-            train_iterator, valid_iterator, test_iterator = data.BucketIterator.splits((
-                train_data, valid_data, test_data), batch_size=self.batch_size,
-                sort_within_batch=True, sort_key=lambda x: len(x.text))
-
-        # finding the weights of each label
-        data_for_weight = pd.read_csv(os.path.join(self.dataset_path, self.train_file_name), sep='\t',
-                                      names=['id1', 'id2', 'label', 'tweet'])
-        pos_counter = 0
-        neg_counter = 0
-        neut_counter = 0
-        for i in range(len(data_for_weight['label'])):
-            if (data_for_weight['label'][i] == 'positive'):
-                pos_counter += 1
-            if (data_for_weight['label'][i] == 'negative'):
-                neg_counter += 1
-            if (data_for_weight['label'][i] == 'neutral'):
-                neut_counter += 1
-        overall = neut_counter + pos_counter + neg_counter
-        neut_weight = overall/neut_counter
-        neg_weight = overall/neg_counter
-        pos_weight = overall/pos_counter
-        if labels == ['neutral', 'negative', 'positive']:
-            weights = torch.Tensor([neut_weight, neg_weight, pos_weight])
-        elif labels == ['neutral', 'positive', 'negative']:
-            weights = torch.Tensor([neut_weight, pos_weight, neg_weight])
-        elif labels == ['negative', 'neutral', 'positive']:
-            weights = torch.Tensor([neg_weight, neut_weight, pos_weight])
-        elif labels == ['negative', 'positive', 'neutral']:
-            weights = torch.Tensor([neg_weight, pos_weight, neut_weight])
-        elif labels == ['positive', 'negative', 'neutral']:
-            weights = torch.Tensor([pos_weight, neg_weight, neut_weight])
-        elif labels == ['positive', 'neutral', 'negative']:
-            weights = torch.Tensor([pos_weight, neut_weight, neg_weight])
+        # finding the weights of each label, in the order of the label vocabulary
+        weights = class_weights(label_counts, labels)
 
         if self.mode == Mode.TEST:
             return test_iterator, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, labels
@@ -156,41 +377,25 @@ class data_provider_V2():
 
 
 
-class data_provider_PostReply():
+class data_provider_PostReply(data_provider_base):
     '''
     Packed padded sequences
     Tokenizer: spacy
     '''
-    def __init__(self, cfg_path, batch_size=1, split_ratio=0.8, max_vocab_size=25000, mode=Mode.TRAIN, model_mode='RNN', seed=1):
+    def __init__(self, cfg_path, batch_size=1, split_ratio=0.8, max_vocab_size=25000, mode=Mode.TRAIN, model_mode='RNN', seed=1,
+                 streaming=False, streaming_workers=0, max_tokens=None, rank=0, world_size=1, embedding_cache_path=None,
+                 with_index=False):
         '''
-        Args:
-            cfg_path (string):
-                Config file path of the experiment
-            max_vocab_size (int):
-                The number of unique words in our training set is usually over 100,000,
-                which means that our one-hot vectors will have over 100,000 dimensions! SLOW TRAINIG!
-                We only take the top max_vocab_size most common words.
-            split_ratio (float):
-                train-valid splitting
-            mode (enumeration Mode):
-                Nature of operation to be done with the data.
-                Possible inputs are Mode.PREDICTION, Mode.TRAIN, Mode.VALID, Mode.TEST
-                Default value: Mode.TRAIN
+        Data files: the post-reply pairs of postreply_data_path (training_post_reply_file_name,
+        final_test_post_reply_file_name, reply_data_format) of the config.
+        Args: see data_provider_base
         '''
-        params = read_config(cfg_path)
-        self.cfg_path = cfg_path
-        self.mode = mode
-        self.seed = seed
-        self.split_ratio = split_ratio
-        self.max_vocab_size = max_vocab_size
-        self.dataset_path = params['postreply_data_path']
-        self.train_file_name = params['training_post_reply_file_name']
-        self.test_file_name = params['final_test_post_reply_file_name']
-        self.data_format = params['reply_data_format']
-        self.pretrained_embedding = params['pretrained_embedding']
-        self.tokenizer = params['tokenizer']
-        self.batch_size = batch_size
-        self.model_mode = model_mode
+        super().__init__(cfg_path, batch_size, split_ratio, max_vocab_size, mode, model_mode, seed,
+                         streaming, streaming_workers, max_tokens, rank, world_size, embedding_cache_path, with_index)
+        self.dataset_path = self.params['postreply_data_path']
+        self.train_file_name = self.params['training_post_reply_file_name']
+        self.test_file_name = self.params['final_test_post_reply_file_name']
+        self.data_format = self.params['reply_data_format']
 
 
     def data_loader(self):
@@ -200,37 +405,17 @@ class data_provider_PostReply():
             Note: padding is done by adding <pad> (not zero!)
         :tokenize: the "tokenization" (the act of splitting the string into discrete "tokens") should be done using the spaCy tokenizer.
         '''
-        if self.model_mode == 'RNN':
+        if self.model_mode in ['RNN', 'ensemble']:
             #Packed padded sequences
+            # 'ensemble': the CNN uses the transpose (batch-first view) of the same batch
             TEXT = data.Field(tokenize=self.tokenizer, include_lengths=True)  # For saving the length of sentences
         if self.model_mode == 'CNN':
             TEXT = data.Field(tokenize=self.tokenizer, batch_first=True)  # batch dimension is the firs dimension here.
         LABEL = data.LabelField()
 
         fields = [('label', LABEL), ('id', None), ('text', TEXT)]
-
-        train_data, test_data = data.TabularDataset.splits(
-            path=self.dataset_path,
-            train=self.train_file_name,
-            test=self.test_file_name,
-            format=self.data_format,
-            fields=fields,
-            skip_header=True)
-
-        # validation data
-        if self.split_ratio == 1:
-            valid_data = None
-        else:
-            train_data, valid_data = train_data.split(random_state=random.seed(self.seed), split_ratio=self.split_ratio)
-
-        # create the vocabulary only on the training set!!!
-        # vectors: instead of having our word embeddings initialized randomly, they are initialized with these pre-trained vectors.
-        # initialize words in your vocabulary but not in your pre-trained embeddings to Gaussian
-        TEXT.build_vocab(train_data, max_size=self.max_vocab_size,
-                         vectors=self.pretrained_embedding, unk_init=torch.Tensor.normal_)
-        # TEXT.build_vocab(train_data, max_size=self.max_vocab_size)
-
-        LABEL.build_vocab(train_data)
+        train_iterator, valid_iterator, test_iterator, label_counts = self.build_iterators(
+            TEXT, LABEL, fields, skip_header=True)
 
         labels = LABEL.vocab.itos
         vocab_idx = TEXT.vocab.stoi
@@ -245,45 +430,8 @@ class data_provider_PostReply():
         # We replace them with a special unknown or <unk> token.
 
 
-        # for packed padded sequences all of the tensors within a batch need to be sorted by their lengths
-        if self.split_ratio == 1:
-            valid_iterator = None
-            train_iterator, test_iterator = data.BucketIterator.splits((
-                train_data, test_data), batch_size=self.batch_size,
-                sort_within_batch=True, sort_key=lambda x: len(x.text))
-        else:
-            train_iterator, valid_iterator, test_iterator = data.BucketIterator.splits((
-                train_data, valid_data, test_data), batch_size=self.batch_size,
-                sort_within_batch=True, sort_key=lambda x: len(x.text))
-
-        # finding the weights of each label
-        data_for_weight = pd.read_csv(os.path.join(self.dataset_path, self.train_file_name))
-        pos_counter = 0
-        neg_counter = 0
-        neut_counter = 0
-        for i in range(len(data_for_weight['label'])):
-            if (data_for_weight['label'][i] == 'positive'):
-                pos_counter += 1
-            if (data_for_weight['label'][i] == 'negative'):
-                neg_counter += 1
-            if (data_for_weight['label'][i] == 'neutral'):
-                neut_counter += 1
-        overall = neut_counter + pos_counter + neg_counter
-        neut_weight = overall/neut_counter
-        neg_weight = overall/neg_counter
-        pos_weight = overall/pos_counter
-        if labels == ['neutral', 'negative', 'positive']:
-            weights = torch.Tensor([neut_weight, neg_weight, pos_weight])
-        elif labels == ['neutral', 'positive', 'negative']:
-            weights = torch.Tensor([neut_weight, pos_weight, neg_weight])
-        elif labels == ['negative', 'neutral', 'positive']:
-            weights = torch.Tensor([neg_weight, neut_weight, pos_weight])
-        elif labels == ['negative', 'positive', 'neutral']:
-            weights = torch.Tensor([neg_weight, pos_weight, neut_weight])
-        elif labels == ['positive', 'negative', 'neutral']:
-            weights = torch.Tensor([pos_weight, neg_weight, neut_weight])
-        elif labels == ['positive', 'neutral', 'negative']:
-            weights = torch.Tensor([pos_weight, neut_weight, neg_weight])
+        # finding the weights of each label, in the order of the label vocabulary
+        weights = class_weights(label_counts, labels)
 
         if self.mode == Mode.TEST:
             return test_iterator
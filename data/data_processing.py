@@ -12,13 +12,20 @@ import pandas as pd
 from configs.serde import *
 import pdb
 import time
-from main import *
 from tqdm import tqdm
 
 epsilon = 1e-15
 
 
 
+def prediction_time(start_time, end_time):
+    elapsed_time = end_time - start_time
+    elapsed_mins = int(elapsed_time / 60)
+    elapsed_secs = int(elapsed_time - (elapsed_mins * 60))
+    return elapsed_mins, elapsed_secs
+
+
+
 def summarizer(data_path, input_file_name, output_file_name):
     '''
     Chooses a final label for each tweet from the list of reply-labels it gets
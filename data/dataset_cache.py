@@ -0,0 +1,123 @@
+"""
+On-disk cache of the tokenized datasets and their vocabularies,
+so that repeated runs of the same experiment skip the tokenization.
+"""
+
+import hashlib
+import numpy as np
+import os
+import torch
+
+
+# version of the content of the cached datasets, part of their key: bump it when the format changes,
+# so that the caches of the previous format are never read
+DATASET_CACHE_VERSION = 2
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    '''
+    sha1 of the content of the given file.
+    :chunk_size: the file is read in chunks of this many bytes.
+    '''
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def dataset_cache_key(file_paths, tokenizer, max_vocab_size, split_ratio, seed):
+    '''
+    Key of a cached dataset: content of the input files + everything which changes
+    the tokens, the train-valid split or the vocabulary + the version of the cache format.
+    '''
+    sha = hashlib.sha1('v{}'.format(DATASET_CACHE_VERSION).encode())
+    for file_path in file_paths:
+        sha.update(file_hash(file_path).encode())
+    sha.update('|{}|{}|{}|{}'.format(tokenizer, max_vocab_size, split_ratio, seed).encode())
+    return sha.hexdigest()
+
+
+def dataset_cache_file(cache_path, key):
+    return os.path.join(cache_path, 'dataset_' + key + '.pt')
+
+
+def load_dataset_cache(cache_path, key):
+    '''
+    Returns the cached dictionary of the given key, or None if it does not exist.
+    The dictionary contains:
+        :train, valid, test: lists of the tokenized torchtext Examples (valid is None if not split)
+        :text_vocab, label_vocab: the vocabularies built on the training set (without the vectors)
+        :label_counts: number of examples of each label in the whole training file (before the train-valid split)
+    '''
+    file_path = dataset_cache_file(cache_path, key)
+    if not os.path.isfile(file_path):
+        return None
+    return torch.load(file_path)
+
+
+def save_dataset_cache(cache_path, key, cache):
+    '''
+    Writes the cache atomically, so that a killed job never leaves a broken cache behind.
+    '''
+    os.makedirs(cache_path, exist_ok=True)
+    file_path = dataset_cache_file(cache_path, key)
+    temp_path = file_path + '.tmp'
+    torch.save(cache, temp_path)
+    os.replace(temp_path, file_path)
+
+
+def embedding_cache_file(embedding_path, pretrained_embedding, key):
+    return os.path.join(embedding_path, pretrained_embedding + '_' + key[:16] + '.npy')
+
+
+def load_embedding_cache(file_path):
+    '''
+    Memory-maps the vocab-aligned embedding matrix.
+    Copy-on-write mode: the rows are only read from disk when they are used,
+    and writing to the tensor never changes the file.
+    Returns None if the file does not exist.
+    '''
+    if not os.path.isfile(file_path):
+        return None
+    return torch.from_numpy(np.load(file_path, mmap_mode='c'))
+
+
+def save_embedding_cache(file_path, vectors):
+    '''
+    Stores only the rows of the pretrained embedding which belong to our vocabulary
+    :vectors: [vocab size, emb dim] tensor
+    '''
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = file_path + '.tmp.npy'
+    np.save(temp_path, vectors.numpy())
+    os.replace(temp_path, file_path)
+
+
+def soft_targets_file(cache_path, key, teacher_files):
+    '''
+    Soft targets of the distillation: depend on the dataset (key) and on the teacher models
+    :teacher_files: model files of the teachers; their path (hence the experiment and the epoch),
+        modification time and size are part of the key, so a retrained teacher gets new soft targets
+    '''
+    sha = hashlib.sha1(key.encode())
+    for file_path in teacher_files:
+        stat = os.stat(file_path)
+        sha.update('|{}|{}|{}'.format(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size).encode())
+    return os.path.join(cache_path, 'soft_targets_' + sha.hexdigest()[:16] + '.npy')
+
+
+def load_soft_targets(file_path):
+    '''
+    Returns the cached logits of the teacher [number of training examples, output dim], or None if not cached.
+    '''
+    if not os.path.isfile(file_path):
+        return None
+    return torch.from_numpy(np.load(file_path))
+
+
+def save_soft_targets(file_path, soft_targets):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = file_path + '.tmp.npy'
+    np.save(temp_path, soft_targets.numpy())
+    os.replace(temp_path, file_path)
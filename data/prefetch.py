@@ -0,0 +1,101 @@
+"""
+Background prefetching of the batches, overlapping the batch construction
+(padding, numericalization) and the transfer to the device with the forward/backward pass.
+"""
+
+import threading
+import time
+from queue import Queue, Empty
+import torch
+
+
+_END = object()
+
+
+class PrefetchedBatch():
+    '''Copy of a torchtext (or streaming) Batch with its tensors already on the device'''
+    pass
+
+
+class PrefetchLoader():
+    '''
+    Wraps an iterator (torchtext Iterator, TokenBudgetIterator, StreamingIterator) and builds its batches
+    `num_prefetch` batches ahead in a worker thread.
+    The tensors are moved to the device in the worker thread (from pinned memory when the device is a GPU).
+    The lengths of packed padded sequences stay on the cpu, as needed by pack_padded_sequence.
+    data_wait_time: seconds the training loop waited for a batch during the last epoch;
+        close to zero when the data pipeline keeps up with the model.
+    '''
+    def __init__(self, loader, device, num_prefetch=2):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = device
+        self.num_prefetch = num_prefetch
+        self.pin_memory = device is not None and torch.device(device).type == 'cuda'
+        self.data_wait_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def transfer(self, tensor):
+        if self.pin_memory:
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=self.pin_memory)
+
+    def prefetch(self, batch):
+        prefetched = PrefetchedBatch()
+        for name, value in vars(batch).items():
+            if torch.is_tensor(value):
+                value = self.transfer(value)
+            elif name == 'text' and isinstance(value, tuple):
+                # (text, lengths) of packed padded sequences
+                value = (self.transfer(value[0]), value[1])
+            setattr(prefetched, name, value)
+        return prefetched
+
+    def __iter__(self):
+        self.data_wait_time = 0.
+        if self.num_prefetch == 0:
+            # synchronous, the whole batch construction is data wait
+            iterator = iter(self.loader)
+            while True:
+                start_time = time.perf_counter()
+                batch = next(iterator, _END)
+                self.data_wait_time += time.perf_counter() - start_time
+                if batch is _END:
+                    return
+                yield batch
+
+        queue = Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+
+        def producer():
+            try:
+                for batch in self.loader:
+                    if stop.is_set():
+                        return
+                    queue.put(self.prefetch(batch))
+            except Exception as error:
+                queue.put(error)
+            queue.put(_END)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start_time = time.perf_counter()
+                item = queue.get()
+                self.data_wait_time += time.perf_counter() - start_time
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # the consumer stopped early: unblock the producer and let it finish
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    thread.join(0.01)
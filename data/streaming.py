@@ -0,0 +1,272 @@
+"""
+Out-of-core (streaming) datasets for corpora larger than the memory.
+The numericalized corpus is stored in shards of numpy files which are memory-mapped
+and read one example at a time; the examples are shuffled within a bounded buffer.
+"""
+
+import itertools
+import json
+import math
+import os
+import pickle
+import random
+from collections import Counter
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+try:
+    # torchtext 0.9 - 0.11: the Vocab of the Field API is in torchtext.legacy
+    from torchtext.legacy.vocab import Vocab
+except ImportError:
+    from torchtext.vocab import Vocab
+
+from data.tokenization import tokenize_corpus, iterate_rows
+
+
+META_FILE_NAME = 'meta.json'
+VOCAB_FILE_NAME = 'vocab.pt'
+
+
+class ShardWriter():
+    '''
+    Writes numericalized examples to shards of `shard_size` examples:
+        tokens.npy: token ids of all the examples of the shard, concatenated (int32)
+        offsets.npy: start of each example in tokens.npy, plus the end of the last one (int64)
+        labels.npy: label ids (int64)
+    '''
+    def __init__(self, shard_dir, shard_size=100000):
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        self.num_shards = 0
+        self.num_examples = 0
+        self.num_tokens = 0
+        self._tokens = []
+        self._labels = []
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def add(self, token_ids, label_id):
+        self._tokens.append(token_ids)
+        self._labels.append(label_id)
+        if len(self._labels) == self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._labels:
+            return
+        path = os.path.join(self.shard_dir, 'shard{:05d}'.format(self.num_shards))
+        os.makedirs(path, exist_ok=True)
+        lengths = [len(ids) for ids in self._tokens]
+        np.save(os.path.join(path, 'tokens.npy'), np.fromiter(
+            (idx for ids in self._tokens for idx in ids), dtype=np.int32, count=sum(lengths)))
+        np.save(os.path.join(path, 'offsets.npy'), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+        np.save(os.path.join(path, 'labels.npy'), np.asarray(self._labels, dtype=np.int64))
+        self.num_shards += 1
+        self.num_examples += len(self._labels)
+        self.num_tokens += sum(lengths)
+        self._tokens = []
+        self._labels = []
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.shard_dir, META_FILE_NAME), 'w') as f:
+            json.dump({'num_shards': self.num_shards, 'num_examples': self.num_examples,
+                       'num_tokens': self.num_tokens}, f, indent=2)
+
+
+class ShardedTextDataset(IterableDataset):
+    '''
+    Iterable dataset over the shards of one split.
+    Yields (token ids, label id); the shard order changes every epoch (see set_epoch)
+    and the examples are shuffled within a buffer of `shuffle_buffer` examples.
+    With several DataLoader workers each worker reads its own shards.
+    In a distributed training each process reads its own shards as well (rank, world_size),
+    so the split should have at least world_size shards.
+    '''
+    def __init__(self, shard_dir, shuffle=True, shuffle_buffer=10000, seed=1, rank=0, world_size=1):
+        with open(os.path.join(shard_dir, META_FILE_NAME), 'r') as f:
+            meta = json.load(f)
+        self.shard_paths = [os.path.join(shard_dir, 'shard{:05d}'.format(i)) for i in range(meta['num_shards'])]
+        self.num_examples = meta['num_examples']
+        if world_size > 1:
+            self.shard_paths = self.shard_paths[rank::world_size]
+            self.num_examples = sum(len(np.load(os.path.join(shard_path, 'labels.npy'), mmap_mode='r'))
+                                    for shard_path in self.shard_paths)
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return self.num_examples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def read_shard(self, shard_path):
+        tokens = np.load(os.path.join(shard_path, 'tokens.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(shard_path, 'offsets.npy'), mmap_mode='r')
+        labels = np.load(os.path.join(shard_path, 'labels.npy'), mmap_mode='r')
+        for i in range(len(labels)):
+            yield np.array(tokens[offsets[i]:offsets[i + 1]], dtype=np.int64), int(labels[i])
+
+    def __iter__(self):
+        shard_paths = list(self.shard_paths)
+        rng = random.Random(self.seed + self.epoch)
+        if self.shuffle:
+            rng.shuffle(shard_paths)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shard_paths = shard_paths[worker_info.id::worker_info.num_workers]
+
+        buffer = []
+        for shard_path in shard_paths:
+            for example in self.read_shard(shard_path):
+                if not self.shuffle:
+                    yield example
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(example)
+                    continue
+                idx = rng.randrange(self.shuffle_buffer)
+                yield buffer[idx]
+                buffer[idx] = example
+        rng.shuffle(buffer)
+        for example in buffer:
+            yield example
+
+
+class StreamingBatch():
+    '''Same attributes as the torchtext Batch, so it can be used by Training and Prediction'''
+    def __init__(self, text, label):
+        self.text = text
+        self.label = label
+        self.batch_size = len(label)
+
+
+class StreamingIterator():
+    '''
+    Batches of a ShardedTextDataset, padded like the torchtext Field:
+        model_mode 'RNN' or 'ensemble': text = ([sent len, batch size], lengths), sorted by decreasing length (packed padded sequences)
+        model_mode 'CNN': text = [batch size, sent len]
+    state_dict / load_state_dict: position within the epoch; an interrupted epoch is continued by
+    streaming the same epoch again and skipping the batches already done.
+    '''
+    def __init__(self, dataset, batch_size, pad_idx, model_mode='RNN', num_workers=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.pad_idx = pad_idx
+        self.model_mode = model_mode
+        self.num_workers = num_workers
+        self.epoch = 0
+        self.iterations_this_epoch = 0
+        self._restored_from_state = False
+
+    def __len__(self):
+        # each worker may end with one partial batch
+        return math.ceil(len(self.dataset) / self.batch_size) + max(self.num_workers - 1, 0)
+
+    def collate(self, examples):
+        examples.sort(key=lambda example: len(example[0]), reverse=True)
+        lengths = torch.LongTensor([len(ids) for ids, _ in examples])
+        text = torch.full((len(examples), int(lengths.max())), self.pad_idx, dtype=torch.long)
+        for i, (ids, _) in enumerate(examples):
+            text[i, :len(ids)] = torch.from_numpy(ids)
+        label = torch.LongTensor([label for _, label in examples])
+        if self.model_mode == 'CNN':
+            return StreamingBatch(text, label)
+        return StreamingBatch((text.t().contiguous(), lengths), label)
+
+    def state_dict(self):
+        return {'epoch': self.epoch - 1, 'iterations_this_epoch': self.iterations_this_epoch}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.iterations_this_epoch = state_dict['iterations_this_epoch']
+        self._restored_from_state = True
+
+    def __iter__(self):
+        if self._restored_from_state:
+            self._restored_from_state = False
+        else:
+            self.iterations_this_epoch = 0
+        self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        loader = DataLoader(self.dataset, batch_size=self.batch_size, collate_fn=self.collate,
+                            num_workers=self.num_workers)
+        for batch in itertools.islice(loader, self.iterations_this_epoch, None):
+            self.iterations_this_epoch += 1
+            yield batch
+
+
+def build_shards(cache_dir, train_file_path, test_file_path, data_format, text_column, label_column,
+                 skip_header, TEXT, LABEL, max_vocab_size, split_ratio=0.8, seed=1,
+                 chunk_size=100000, shard_size=100000, n_process=1, batch_size=1000):
+    '''
+    Builds the shards of the train, valid and test splits without holding the corpus in memory:
+        1. the files are read and tokenized in chunks of `chunk_size` rows; each training row goes to the
+           valid split with probability 1 - split_ratio; the token counts of the train split are accumulated
+           and the tokenized chunks are written to temporary files.
+        2. the vocabularies are built from the counts (like Field.build_vocab),
+           and the temporary chunks are numericalized into shards.
+    The vocabularies and the label counts of the whole training file are saved in `cache_dir`.
+    '''
+    rng = random.Random(seed)
+    token_counter = Counter()
+    label_counter = Counter()
+    all_label_counter = Counter()
+    temp_files = {'train': [], 'valid': [], 'test': []}
+
+    for split, file_path in [('train', train_file_path), ('test', test_file_path)]:
+        for chunk_idx, rows in enumerate(iterate_rows(file_path, data_format, skip_header, chunk_size)):
+            tokens = tokenize_corpus([row[text_column] for row in rows], n_process=n_process, batch_size=batch_size)
+            chunks = {'train': [], 'valid': [], 'test': []}
+            for row, row_tokens in zip(rows, tokens):
+                label = row[label_column]
+                if split == 'test':
+                    chunks['test'].append((row_tokens, label))
+                    continue
+                all_label_counter[label] += 1
+                if split_ratio == 1 or rng.random() < split_ratio:
+                    chunks['train'].append((row_tokens, label))
+                    token_counter.update(row_tokens)
+                    label_counter[label] += 1
+                else:
+                    chunks['valid'].append((row_tokens, label))
+            for chunk_split, examples in chunks.items():
+                if not examples:
+                    continue
+                temp_file = os.path.join(cache_dir, '{}_{}_{:05d}.tmp.pkl'.format(split, chunk_split, chunk_idx))
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(temp_file, 'wb') as f:
+                    pickle.dump(examples, f)
+                temp_files[chunk_split].append(temp_file)
+
+    TEXT.vocab = Vocab(token_counter, max_size=max_vocab_size, specials=[TEXT.unk_token, TEXT.pad_token])
+    LABEL.vocab = Vocab(label_counter, specials=[])
+
+    for split, files in temp_files.items():
+        writer = ShardWriter(os.path.join(cache_dir, split), shard_size=shard_size)
+        for temp_file in files:
+            with open(temp_file, 'rb') as f:
+                examples = pickle.load(f)
+            for row_tokens, label in examples:
+                writer.add([TEXT.vocab.stoi[tok] for tok in row_tokens], LABEL.vocab.stoi[label])
+            os.remove(temp_file)
+        writer.close()
+
+    torch.save({'text_vocab': TEXT.vocab, 'label_vocab': LABEL.vocab, 'label_counts': dict(all_label_counter)},
+               os.path.join(cache_dir, VOCAB_FILE_NAME))
+
+
+def load_shards(cache_dir, TEXT, LABEL):
+    '''
+    Sets the vocabularies of TEXT and LABEL from the shards of build_shards.
+    Returns the label counts of the whole training file, or None if the shards do not exist.
+    '''
+    file_path = os.path.join(cache_dir, VOCAB_FILE_NAME)
+    if not os.path.isfile(file_path):
+        return None
+    vocabs = torch.load(file_path)
+    TEXT.vocab = vocabs['text_vocab']
+    LABEL.vocab = vocabs['label_vocab']
+    return vocabs['label_counts']
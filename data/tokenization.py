@@ -0,0 +1,91 @@
+"""
+Batched, multi-process spaCy tokenization of whole corpora.
+Gives the same tokens as tokenize='spacy' of the torchtext Field.
+"""
+
+import csv
+import io
+import sys
+try:
+    # torchtext 0.9 - 0.11: the Field/Dataset/Iterator API is in torchtext.legacy
+    from torchtext.legacy import data
+except ImportError:
+    from torchtext import data
+
+
+# only the tokenizer is needed, the statistical components are never used
+DISABLED_PIPES = ['tagger', 'parser', 'ner', 'textcat']
+
+_nlp = None
+
+
+def spacy_pipeline():
+    '''
+    Loads the English spaCy model only once per process, at its first use:
+    importing this module (or the modules importing it) does not load spaCy.
+    '''
+    global _nlp
+    if _nlp is None:
+        import spacy
+        _nlp = spacy.load('en', disable=DISABLED_PIPES)
+    return _nlp
+
+
+def tokenize_corpus(texts, n_process=1, batch_size=1000):
+    '''
+    Tokenizes a list of strings with nlp.pipe
+    :n_process: number of worker processes of spaCy
+    :batch_size: number of texts sent to a worker at once
+    :return: list of token lists, in the order of texts
+    '''
+    nlp = spacy_pipeline()
+    texts = (text.rstrip('\n') for text in texts)
+    return [[tok.text for tok in doc] for doc in nlp.pipe(texts, n_process=n_process, batch_size=batch_size)]
+
+
+def read_rows(file_path, data_format, skip_header=False):
+    '''Reads a csv/tsv file the same way as the torchtext TabularDataset'''
+    csv.field_size_limit(sys.maxsize)
+    with io.open(file_path, encoding='utf8') as f:
+        if data_format == 'tsv':
+            reader = csv.reader(f, delimiter='\t')
+        else:
+            reader = csv.reader(f)
+        if skip_header:
+            next(reader)
+        return list(reader)
+
+
+def iterate_rows(file_path, data_format, skip_header=False, chunk_size=100000):
+    '''Reads a csv/tsv file lazily, in lists of `chunk_size` rows'''
+    csv.field_size_limit(sys.maxsize)
+    with io.open(file_path, encoding='utf8') as f:
+        if data_format == 'tsv':
+            reader = csv.reader(f, delimiter='\t')
+        else:
+            reader = csv.reader(f)
+        if skip_header:
+            next(reader)
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+
+def tokenized_dataset(file_path, data_format, fields, skip_header=False, n_process=1, batch_size=1000):
+    '''
+    Equivalent of the torchtext TabularDataset, but the 'text' column is tokenized with tokenize_corpus.
+    The torchtext Field does not tokenize again what is already a list of tokens.
+    :fields: list of (name, Field) of the columns, exactly as for the TabularDataset
+    '''
+    rows = read_rows(file_path, data_format, skip_header)
+    text_column = [name for name, _ in fields].index('text')
+    tokens = tokenize_corpus([row[text_column] for row in rows], n_process=n_process, batch_size=batch_size)
+    for row, row_tokens in zip(rows, tokens):
+        row[text_column] = row_tokens
+    examples = [data.Example.fromlist(row, fields) for row in rows]
+    return data.Dataset(examples, fields)
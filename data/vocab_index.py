@@ -0,0 +1,160 @@
+"""
+Compact, memory-mappable vocabulary index: token -> id without a Python dictionary.
+For a vocabulary of 750k tokens the stoi dictionary of torchtext takes ~70 MB in every process
+(and is pickled into every worker); the index takes ~16 bytes per token plus the UTF-8 bytes of the tokens,
+in numpy files which are memory-mapped, so the processes of a machine share the same pages.
+"""
+
+import os
+import numpy as np
+
+
+HASHES_FILE_NAME = 'hashes.npy'
+IDS_FILE_NAME = 'ids.npy'
+ARENA_FILE_NAME = 'arena.npy'
+OFFSETS_FILE_NAME = 'offsets.npy'
+META_FILE_NAME = 'meta.npy'
+# version of the hash function and of the files, stored in META_FILE_NAME
+INDEX_VERSION = 2
+
+FNV_OFFSET_BASIS = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def token_hashes(tokens):
+    '''
+    64-bit FNV-1a hashes of the UTF-8 bytes of the tokens (uint64 array), computed for all the tokens at once:
+    the tokens are sorted by length and the i-th byte of all the tokens longer than i is hashed in one numpy step,
+    so the Python work per token is only its encoding.
+    '''
+    encoded = list(map(str.encode, tokens))
+    num_tokens = len(encoded)
+    if num_tokens == 0:
+        return np.zeros(0, dtype=np.uint64)
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=num_tokens)
+    arena = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.uint64)
+    starts = np.zeros(num_tokens, dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    # the longest tokens first: the tokens still hashed at byte i are a prefix
+    order = np.argsort(-lengths, kind='stable')
+    starts = starts[order]
+    num_active = num_tokens - np.searchsorted(lengths[order][::-1], np.arange(lengths[order[0]]), side='right')
+    hashes = np.full(num_tokens, FNV_OFFSET_BASIS, dtype=np.uint64)
+    for i, active in enumerate(num_active):
+        hashes[:active] = (hashes[:active] ^ arena[starts[:active] + i]) * FNV_PRIME
+    unsorted = np.empty_like(hashes)
+    unsorted[order] = hashes
+    return unsorted
+
+
+class VocabIndex():
+    '''
+    hashes: sorted 64-bit hashes of the tokens, ids: the id of the token of each hash;
+    a batch of tokens is hashed and looked up at once with a binary search (np.searchsorted),
+    the tokens which are not in the vocabulary map to unk_idx.
+    arena, offsets: the UTF-8 bytes of all the tokens, concatenated in the order of the ids, for id -> token.
+    With 64-bit hashes, the probability that an unknown token collides with one of 750k tokens is ~4e-14;
+    the collisions within the vocabulary are checked when the index is built.
+    Can be used in place of the stoi dictionary: index[token], index.lookup(tokens).
+    This is a memory trade-off, not a speed-up: with the per-token encoding in Python, a batch lookup costs
+    about twice the dictionary lookups (~0.55 us per token against ~0.25-0.3 us, 750k tokens), while the index
+    takes about a quarter of the memory of the dictionary with its strings and ids (18 MB against ~70 MB)
+    and is shared by the processes of the machine.
+    '''
+    def __init__(self, hashes, ids, arena, offsets, unk_idx, path=None):
+        self.hashes = hashes
+        self.ids = ids
+        self.arena = arena
+        self.offsets = offsets
+        self.unk_idx = unk_idx
+        # directory of the memory-mapped files; the index is pickled as its path
+        self.path = path
+
+    @classmethod
+    def build(cls, itos, unk_idx):
+        '''
+        :itos: tokens of the vocabulary, in the order of their ids
+        '''
+        hashes = token_hashes(itos)
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        if len(hashes) > 1 and (hashes[1:] == hashes[:-1]).any():
+            raise ValueError('hash collision in the vocabulary')
+        encoded = [token.encode('utf8') for token in itos]
+        arena = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        offsets = np.concatenate([[0], np.cumsum([len(token) for token in encoded])]).astype(np.int64)
+        return cls(hashes, order.astype(np.int64), arena, offsets, unk_idx)
+
+    def save(self, path):
+        '''Writes the index to the directory `path` (atomically: the files are renamed into place)'''
+        os.makedirs(path, exist_ok=True)
+        for file_name, array in [(HASHES_FILE_NAME, self.hashes), (IDS_FILE_NAME, self.ids),
+                                 (ARENA_FILE_NAME, self.arena), (OFFSETS_FILE_NAME, self.offsets),
+                                 (META_FILE_NAME, np.array([self.unk_idx, INDEX_VERSION], dtype=np.int64))]:
+            temp_path = os.path.join(path, file_name + '.tmp.npy')
+            np.save(temp_path, array)
+            os.replace(temp_path, os.path.join(path, file_name))
+
+    @classmethod
+    def load(cls, path):
+        '''Memory-maps the index saved in the directory `path`'''
+        arrays = [np.load(os.path.join(path, file_name), mmap_mode='r')
+                  for file_name in [HASHES_FILE_NAME, IDS_FILE_NAME, ARENA_FILE_NAME, OFFSETS_FILE_NAME]]
+        meta = np.load(os.path.join(path, META_FILE_NAME))
+        if len(meta) < 2 or meta[1] != INDEX_VERSION:
+            raise ValueError(f'the vocabulary index {path} has another version (hash function), it needs to be built again')
+        return cls(*arrays, unk_idx=int(meta[0]), path=path)
+
+    def __reduce__(self):
+        # a memory-mapped index is sent to other processes as its path, which they map again
+        if self.path:
+            return (VocabIndex.load, (self.path,))
+        return (VocabIndex, (self.hashes, self.ids, self.arena, self.offsets, self.unk_idx))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @property
+    def nbytes(self):
+        return self.hashes.nbytes + self.ids.nbytes + self.arena.nbytes + self.offsets.nbytes
+
+    def lookup(self, tokens):
+        '''ids of a list of tokens (int64 array), unk_idx for the tokens out of the vocabulary'''
+        if len(tokens) == 0 or len(self.hashes) == 0:
+            return np.full(len(tokens), self.unk_idx, dtype=np.int64)
+        hashes = token_hashes(tokens)
+        # sorted queries: each binary search starts from the previous one, ~3x faster than in random order
+        order = np.argsort(hashes)
+        positions = np.empty(len(hashes), dtype=np.int64)
+        positions[order] = np.searchsorted(self.hashes, hashes[order])
+        positions = np.minimum(positions, len(self.hashes) - 1)
+        return np.where(self.hashes[positions] == hashes, self.ids[positions], self.unk_idx)
+
+    def __getitem__(self, token):
+        return int(self.lookup([token])[0])
+
+    def __contains__(self, token):
+        if len(self.hashes) == 0:
+            return False
+        hashes = token_hashes([token])
+        position = min(int(np.searchsorted(self.hashes, hashes)[0]), len(self.hashes) - 1)
+        return bool(self.hashes[position] == hashes[0])
+
+    def itos(self, idx):
+        return bytes(self.arena[self.offsets[idx]:self.offsets[idx + 1]]).decode('utf8')
+
+
+def numericalize(vocab_idx, tokenized):
+    '''
+    ids of a list of token lists, with a VocabIndex (one vectorized lookup for all the tokens)
+    or with a stoi dictionary
+    '''
+    if not isinstance(vocab_idx, VocabIndex):
+        return [[vocab_idx[token] for token in tokens] for tokens in tokenized]
+    ids = vocab_idx.lookup([token for tokens in tokenized for token in tokens]).tolist()
+    indexed = []
+    start = 0
+    for tokens in tokenized:
+        indexed.append(ids[start:start + len(tokens)])
+        start += len(tokens)
+    return indexed
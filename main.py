@@ -11,7 +11,6 @@ https://tayebiarasteh.com/
 from torch.nn import *
 import torch
 import torch.optim as optim
-import spacy
 
 # User Defined Modules
 from configs.serde import *
@@ -20,6 +19,11 @@ from data.data_handler import *
 from data.data_processing import *
 from models.biLSTM import *
 from models.CNN import *
+from utils.distributed import launch, barrier
+from utils.early_stopping import EarlyStopping
+from models.distillation import DistillationLoss
+from data.dataset_cache import soft_targets_file, load_soft_targets, save_soft_targets
+from utils.inference_bundle import bundle_path, bundle_is_current, export_bundle, vocab_itos
 
 #System Modules
 from itertools import product
@@ -51,6 +55,12 @@ def main_train():
     conv_out_ch = 200  # for the CNN model:
     filter_sizes = [3, 4, 5]  # for the CNN model:
     SPLIT_RATIO = 0.85 # ratio of the train set, 1.0 means 100% training, 0% valid data
+    MAX_TOKENS = None # token budget of a batch (variable number of tweets), None means BATCH_SIZE tweets per batch
+    MIXED_PRECISION = False # bfloat16 autocast on the cpu (float16 on GPU), weights stay float32
+    SPARSE_EMBEDDING = False # sparse gradients of the embedding table, updated by SparseAdam (the rest by OPTIMIZER)
+    PATIENCE = None # opt-in early stopping after PATIENCE epochs without improvement of MONITOR by MIN_DELTA; None: all the NUM_EPOCH epochs
+    MIN_DELTA = 1e-4
+    MONITOR = 'valid_loss' # 'valid_loss' or 'valid_F1'
     EXPERIMENT_NAME = "Adam_lr" + str(lr) + "_max_vocab_size" + str(MAX_VOCAB_SIZE)
 
     if RESUME == True:
@@ -61,24 +71,29 @@ def main_train():
 
     # Prepare data
     data_handler = data_provider_V2(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=SPLIT_RATIO,
-                                    max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode=MODEL_MODE)
+                                    max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode=MODEL_MODE,
+                                    max_tokens=MAX_TOKENS)
     train_iterator, valid_iterator, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, classes = data_handler.data_loader()
 
     print(f'\nSummary:\n----------------------------------------------------')
-    print(f'Total # of Training tweets: {BATCH_SIZE * len(train_iterator):,}')
+    print(f'Total # of Training tweets: {len(train_iterator.dataset):,}')
     if SPLIT_RATIO == 1:
         print(f'Total # of Valid. tweets:   {0}')
     else:
-        print(f'Total # of Valid. tweets:   {BATCH_SIZE * len(valid_iterator):,}')
+        print(f'Total # of Valid. tweets:   {len(valid_iterator.dataset):,}')
 
     # Initialize trainer
-    trainer = Training(cfg_path, num_epochs=NUM_EPOCH, RESUME=RESUME, model_mode=MODEL_MODE)
+    trainer = Training(cfg_path, num_epochs=NUM_EPOCH, RESUME=RESUME, model_mode=MODEL_MODE,
+                       mixed_precision=MIXED_PRECISION,
+                       early_stopping=EarlyStopping(PATIENCE, MIN_DELTA, MONITOR) if PATIENCE else None)
     if MODEL_MODE == 'RNN':
         MODEL = biLSTM(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=EMBEDDING_DIM,
-                       hidden_dim=HIDDEN_DIM, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX)
+                       hidden_dim=HIDDEN_DIM, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
+                       sparse=SPARSE_EMBEDDING)
     elif MODEL_MODE == 'CNN':
         MODEL = CNN1d(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=EMBEDDING_DIM,
-                       conv_out_ch=conv_out_ch, filter_sizes=filter_sizes, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX)
+                       conv_out_ch=conv_out_ch, filter_sizes=filter_sizes, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
+                       sparse=SPARSE_EMBEDDING)
 
     if RESUME == True:
         trainer.load_checkpoint(model=MODEL, optimiser=OPTIMIZER,
@@ -86,6 +101,21 @@ def main_train():
     else:
         trainer.setup_model(model=MODEL, optimiser=OPTIMIZER,
                         optimiser_params=optimiser_params, loss_function=LOSS_FUNCTION, weight=weights)
+        # writes the params to config file
+        params = read_config(cfg_path)
+        params['Network']['vocab_size'] = vocab_size
+        params['Network']['PAD_IDX'] = PAD_IDX
+        params['Network']['UNK_IDX'] = UNK_IDX
+        params['Network']['classes'] = classes
+        params['Network']['SPLIT_RATIO'] = SPLIT_RATIO
+        params['Network']['MAX_VOCAB_SIZE'] = MAX_VOCAB_SIZE
+        params['Network']['HIDDEN_DIM'] = HIDDEN_DIM
+        params['Network']['EMBEDDING_DIM'] = EMBEDDING_DIM
+        params['Network']['OUTPUT_DIM'] = OUTPUT_DIM
+        params['Network']['conv_out_ch'] = conv_out_ch
+        params['Network']['filter_sizes'] = filter_sizes
+        params['Network']['MODEL_MODE'] = MODEL_MODE
+        write_config(params, cfg_path, sort_keys=True)
     trainer.execute_training(train_loader=train_iterator, valid_loader=valid_iterator, batch_size=BATCH_SIZE)
 
 
@@ -116,6 +146,89 @@ def main_test():
 
 
 
+def main_export_bundle(EXPERIMENT_NAME='Adam_lr0.0001_max_vocab_size50000', prediction_mode='Manualpart1', EPOCH=None):
+    '''
+    Exports the inference bundle of a trained model (see utils/inference_bundle.py) next to its trained models.
+    Only this export builds the vocabulary from the training data (and loads the pretrained vectors);
+    main_manual_predict and main_reply_predict then load the bundle in about a second.
+    The architecture, the vocabulary size, the split and the embedding backend are the ones of the training,
+    read from params['Network'] of the experiment config (written by the training functions).
+    :prediction_mode: 'Manualpart1' (model of the tweets, part 1) or 'Manualpart2' (model of the replies, part 2)
+    :EPOCH: the epoch of the model to export (epoch{EPOCH}_ model file), None: the best model of the training
+    '''
+    params = open_experiment(EXPERIMENT_NAME)
+    cfg_path = params['cfg_path']
+    network = params['Network']
+    required = ['MODEL_MODE', 'MAX_VOCAB_SIZE', 'SPLIT_RATIO', 'EMBEDDING_DIM', 'OUTPUT_DIM']
+    if network.get('MODEL_MODE') == 'CNN':
+        required += ['conv_out_ch', 'filter_sizes']
+    elif network.get('MODEL_MODE') == 'RNN':
+        required += ['HIDDEN_DIM']
+    missing = [key for key in required if key not in network]
+    if missing:
+        raise KeyError(f'the config of the experiment {EXPERIMENT_NAME} has no {", ".join(missing)} in "Network": '
+                       f'add the values of its training to {cfg_path}')
+    # Hyper-parameters of the training
+    MODEL_MODE = network['MODEL_MODE']
+    MAX_VOCAB_SIZE = network['MAX_VOCAB_SIZE']
+    SPLIT_RATIO = network['SPLIT_RATIO']
+    hyperparameters = {'embedding_dim': network['EMBEDDING_DIM'],
+                       'output_dim': network['OUTPUT_DIM'],
+                       'embedding_backend': network.get('EMBEDDING_BACKEND', 'dense'),
+                       'num_buckets': network.get('NUM_BUCKETS')}
+    if MODEL_MODE == 'RNN':
+        MODEL = biLSTM
+        hyperparameters['hidden_dim'] = network['HIDDEN_DIM']
+    elif MODEL_MODE == 'CNN':
+        MODEL = CNN1d
+        hyperparameters['conv_out_ch'] = network['conv_out_ch']
+        hyperparameters['filter_sizes'] = network['filter_sizes']
+    else:
+        raise ValueError(f'unknown MODEL_MODE {MODEL_MODE} of the experiment {EXPERIMENT_NAME}')
+
+    # the vocabulary of the training
+    if prediction_mode == 'Manualpart1':
+        data_handler_test = data_provider_V2(cfg_path=cfg_path, split_ratio=SPLIT_RATIO,
+                                                    max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.PREDICTION, model_mode=MODEL_MODE)
+    elif prediction_mode == 'Manualpart2':
+        data_handler_test = data_provider_PostReply(cfg_path=cfg_path, split_ratio=SPLIT_RATIO,
+                                                    max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.PREDICTION, model_mode=MODEL_MODE)
+    labels, vocab_idx, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, classes = data_handler_test.data_loader()
+    if vocab_size != network.get('vocab_size', vocab_size):
+        raise ValueError(f'the vocabulary ({vocab_size:,} tokens) differs from the one of the training of '
+                         f'{EXPERIMENT_NAME} ({network["vocab_size"]:,} tokens)')
+
+    predictor = Prediction(cfg_path, model_mode=MODEL_MODE, classes=classes)
+    predictor.setup_model(model=MODEL, vocab_size=vocab_size, embeddings=pretrained_embeddings,
+                          embedding_dim=hyperparameters['embedding_dim'], hidden_dim=hyperparameters.get('hidden_dim'),
+                          pad_idx=PAD_IDX, unk_idx=UNK_IDX, epoch=EPOCH,
+                          conv_out_ch=hyperparameters.get('conv_out_ch'), filter_sizes=hyperparameters.get('filter_sizes'),
+                          embedding_backend=hyperparameters['embedding_backend'],
+                          num_buckets=hyperparameters['num_buckets'])
+    export_bundle(bundle_path(params), predictor.model_p, MODEL_MODE, vocab_itos(vocab_idx, vocab_size), labels,
+                  PAD_IDX, UNK_IDX, hyperparameters=hyperparameters)
+    print(f'Inference bundle written to {bundle_path(params)}')
+
+
+
+def load_predictor(EXPERIMENT_NAME, prediction_mode='Manualpart1'):
+    '''
+    Predictor of the inference bundle of the experiment (Prediction.from_bundle). The bundle is exported
+    (main_export_bundle) when it is missing, older than the best model of the experiment or not loadable
+    (an older bundle version, or a vocabulary which does not match the model).
+    '''
+    params = open_experiment(EXPERIMENT_NAME)
+    model_file = os.path.join(params['network_output_path'], params['trained_model_name'])
+    if bundle_is_current(bundle_path(params), model_file):
+        try:
+            return Prediction.from_bundle(bundle_path(params))
+        except ValueError as error:
+            print(f'Exporting the inference bundle again: {error}')
+    main_export_bundle(EXPERIMENT_NAME, prediction_mode)
+    return Prediction.from_bundle(bundle_path(params))
+
+
+
 def main_manual_predict(PHRASE=None, prediction_mode='Manualpart1'):
     '''
     Manually predicts the polarity of the given sentence.
@@ -123,6 +236,8 @@ def main_manual_predict(PHRASE=None, prediction_mode='Manualpart1'):
         'Manualpart1' predicts the sentiment of the tweet (part 1 pf the project)
         'Manualpart2' predicts the semtiment of the potential reply of the tweet (part 2)
         Note that for each part you should give the correct experiment name to load the correct model for it.
+    The model and its vocabulary are loaded from the inference bundle of the experiment,
+    which is exported by main_export_bundle the first time (see load_predictor).
     '''
     if PHRASE == None:
         # Enter your phrase below here:
@@ -135,30 +250,10 @@ def main_manual_predict(PHRASE=None, prediction_mode='Manualpart1'):
     elif prediction_mode == 'Manualpart2':
         EXPERIMENT_NAME = 'POSTREPLY_Adam_lr9e-05_max_vocab_size100000'
 
-    # Hyper-parameters
-    params = open_experiment(EXPERIMENT_NAME)
-    cfg_path = params['cfg_path']
-    MODEL_MODE = 'RNN' # 'RNN' or 'CNN'
-    EMBEDDING_DIM = 200
-    HIDDEN_DIM = 256
-    MAX_VOCAB_SIZE = 50000  # use the same "max_vocab_size" as in training
-    SPLIT_RATIO = 0.8 # use the same as in training.
-    # Prepare the network parameters
-    if prediction_mode == 'Manualpart1':
-        data_handler_test = data_provider_V2(cfg_path=cfg_path, split_ratio=SPLIT_RATIO,
-                                                    max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.PREDICTION, model_mode=MODEL_MODE)
-    elif prediction_mode == 'Manualpart2':
-        data_handler_test = data_provider_PostReply(cfg_path=cfg_path, split_ratio=SPLIT_RATIO,
-                                                    max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.PREDICTION, model_mode=MODEL_MODE)
-
-    labels, vocab_idx, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, classes = data_handler_test.data_loader()
-
     # Initialize prediction
-    predictor = Prediction(cfg_path, model_mode=MODEL_MODE)
-    predictor.setup_model(model=biLSTM, vocab_size=vocab_size, embedding_dim=EMBEDDING_DIM, hidden_dim=HIDDEN_DIM,
-                          embeddings=pretrained_embeddings, pad_idx=PAD_IDX, unk_idx=UNK_IDX)
+    predictor = load_predictor(EXPERIMENT_NAME, prediction_mode)
     # Execute Prediction
-    predictor.manual_predict(labels=labels, vocab_idx=vocab_idx,
+    predictor.manual_predict(labels=predictor.classes, vocab_idx=predictor.vocab_idx,
                              phrase=PHRASE, mode=Mode.PREDICTION, prediction_mode=prediction_mode)
     # Duration
     end_time = time.time()
@@ -172,17 +267,13 @@ def main_reply_predict(DATA_MODE = 'getoldtweet'):
     Manually predicts the polarity of the given replies,
     which will be regarded as the labels for the corresponding tweets
     and creates a labeled dataset of only tweets and corresponding labels.
+    The model and its vocabulary are loaded from the inference bundle of the experiment (see main_export_bundle).
     :DATA_MODE: 'getoldtweet' or 'philipp'
     '''
     start_time = time.time()
     EXPERIMENT_NAME = 'Adam_lr0.0001_max_vocab_size50000'
     params = open_experiment(EXPERIMENT_NAME)
-    cfg_path = params['cfg_path']
-    # Hyper-parameters
-    EMBEDDING_DIM = 200
-    HIDDEN_DIM = 256
-    MAX_VOCAB_SIZE = 50000  # use the same "max_vocab_size" as in training
-    MODEL_MODE = 'RNN' # 'RNN' or 'CNN'
+    BATCH_SIZE = 256
 
     if DATA_MODE == 'getoldtweet':
         original_data = params['reply_file_name']
@@ -193,25 +284,14 @@ def main_reply_predict(DATA_MODE = 'getoldtweet'):
         predicted_data = params['philipp_with_label_file_name']
         final_data = params['philipp_final_post_reply_file_name']
 
-    # Prepare the network parameters
-    data_handler_test = data_provider_V2(cfg_path=cfg_path, max_vocab_size=MAX_VOCAB_SIZE,
-                                         mode=Mode.PREDICTION, model_mode=MODEL_MODE)
-    labels, vocab_idx, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, classes = data_handler_test.data_loader()
-
     # Initialize prediction
-    predictor = Prediction(cfg_path, model_mode=MODEL_MODE, classes=classes)
-    predictor.setup_model(model=biLSTM, vocab_size=vocab_size, embeddings=pretrained_embeddings,
-                          embedding_dim=EMBEDDING_DIM, hidden_dim=HIDDEN_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX)
+    predictor = load_predictor(EXPERIMENT_NAME, prediction_mode='Manualpart1')
 
     data = pd.read_csv(os.path.join(params['postreply_data_path'], original_data))
     data = data.reindex(columns=['label', 'tweet', 'id', 'user', 'reply'])
-    # Execute Prediction
-    nlp = spacy.load('en')
-    for idx, item in enumerate(data['reply']):
-        print(idx)
-        PHRASE = str(item)
-        data['label'][idx] = predictor.manual_predict(labels=labels, vocab_idx=vocab_idx, phrase=PHRASE,
-                                                             tokenizer=nlp, mode=Mode.REPLYPREDICTION)
+    # Execute Prediction: all the replies at once, in batches
+    reply_labels, _ = predictor.predict_texts(data['reply'].tolist(), batch_size=BATCH_SIZE)
+    data['label'] = reply_labels
     data.to_csv(os.path.join(params['postreply_data_path'], predicted_data), index=False)
 
     # Removing the repetitions
@@ -225,14 +305,15 @@ def main_reply_predict(DATA_MODE = 'getoldtweet'):
 
 
 
-def main_train_postreply():
+def main_train_postreply(rank=0, world_size=1, RESUME=False):
     '''
     Main function for training + validation of the second part of the project:
     Sentiment analysis of the Post-Replies.
+    :rank, world_size: distributed data parallel training on several processes, started with
+        launch(main_train_postreply, NUM_PROCESSES) (see utils/distributed.py); each process trains on its shard.
+    :RESUME: resumes the training of the experiment from its checkpoint, within an epoch from the batch
+        where it stopped (checkpoint_step_freq of the config)
     '''
-    # if we are resuming training on a model
-    RESUME = False
-
     # Hyper-parameters
     NUM_EPOCH = 500
     LOSS_FUNCTION = CrossEntropyLoss
@@ -248,37 +329,54 @@ def main_train_postreply():
     conv_out_ch = 200  # for the CNN model:
     filter_sizes = [3, 4, 5]  # for the CNN model:
     SPLIT_RATIO = 0.9 # ratio of the train set, 1.0 means 100% training, 0% valid data
+    STREAMING = False # True: reads the corpus lazily from shards on disk, for corpora larger than the memory
+    MAX_TOKENS = None # token budget of a batch (variable number of tweets), None means BATCH_SIZE tweets per batch
+    MIXED_PRECISION = False # bfloat16 autocast on the cpu (float16 on GPU), weights stay float32
+    SPARSE_EMBEDDING = False # sparse gradients of the embedding table, updated by SparseAdam (the rest by OPTIMIZER)
+    PATIENCE = None # opt-in early stopping after PATIENCE epochs without improvement of MONITOR by MIN_DELTA; None: all the NUM_EPOCH epochs
+    MIN_DELTA = 1e-4
+    MONITOR = 'valid_loss' # 'valid_loss' or 'valid_F1'
+    EMBEDDING_BACKEND = 'dense' # 'dense', 'hashed' (NUM_BUCKETS rows), 'int8' or 'float16' (frozen quantized table)
+    NUM_BUCKETS = 100000 # for the 'hashed' embedding
     EXPERIMENT_NAME = "new_october_CNN"
 
-    if RESUME == True:
-        params = open_experiment(EXPERIMENT_NAME)
-    else:
-        params = create_experiment(EXPERIMENT_NAME)
+    if RESUME == False and rank == 0:
+        create_experiment(EXPERIMENT_NAME)
+    # the other processes open the experiment created by the process of rank 0
+    barrier()
+    params = open_experiment(EXPERIMENT_NAME)
     cfg_path = params["cfg_path"]
 
     # Prepare data
     data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=SPLIT_RATIO,
-                                           max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode=MODEL_MODE)
+                                           max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode=MODEL_MODE,
+                                           streaming=STREAMING, max_tokens=MAX_TOKENS,
+                                           rank=rank, world_size=world_size)
     train_iterator, valid_iterator, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, classes = data_handler.data_loader()
 
     if SPLIT_RATIO == 1:
         total_valid_tweets = 0
     else:
-        total_valid_tweets = BATCH_SIZE * len(valid_iterator)
-    total_train_tweets = BATCH_SIZE * len(train_iterator)
-    print(f'\nSummary:\n----------------------------------------------------')
-    print(f'Total # of Training tweets: {total_train_tweets:,}')
-    print(f'Total # of Valid. tweets:   {total_valid_tweets:,}')
+        total_valid_tweets = len(valid_iterator.dataset)
+    total_train_tweets = len(train_iterator.dataset)
+    if rank == 0:
+        print(f'\nSummary:\n----------------------------------------------------')
+        print(f'Total # of Training tweets: {total_train_tweets:,}' + (' (per process)' if world_size > 1 else ''))
+        print(f'Total # of Valid. tweets:   {total_valid_tweets:,}' + (' (per process)' if world_size > 1 else ''))
 
     # Initialize trainer
-    trainer = Training(cfg_path, num_epochs=NUM_EPOCH, RESUME=RESUME, model_mode=MODEL_MODE)
+    trainer = Training(cfg_path, num_epochs=NUM_EPOCH, RESUME=RESUME, model_mode=MODEL_MODE,
+                       mixed_precision=MIXED_PRECISION, rank=rank, world_size=world_size,
+                       early_stopping=EarlyStopping(PATIENCE, MIN_DELTA, MONITOR) if PATIENCE else None)
 
     if MODEL_MODE == "RNN":
         MODEL = biLSTM(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=EMBEDDING_DIM,
-                       hidden_dim=HIDDEN_DIM, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX)
+                       hidden_dim=HIDDEN_DIM, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
+                       sparse=SPARSE_EMBEDDING, embedding_backend=EMBEDDING_BACKEND, num_buckets=NUM_BUCKETS)
     elif MODEL_MODE == "CNN":
         MODEL = CNN1d(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=EMBEDDING_DIM,
-                       conv_out_ch=conv_out_ch, filter_sizes=filter_sizes, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX)
+                       conv_out_ch=conv_out_ch, filter_sizes=filter_sizes, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
+                       sparse=SPARSE_EMBEDDING, embedding_backend=EMBEDDING_BACKEND, num_buckets=NUM_BUCKETS)
 
     if RESUME == True:
         trainer.load_checkpoint(model=MODEL, optimiser=OPTIMIZER,
@@ -296,11 +394,17 @@ def main_train_postreply():
         params['Network']['MAX_VOCAB_SIZE'] = MAX_VOCAB_SIZE
         params['Network']['HIDDEN_DIM'] = HIDDEN_DIM
         params['Network']['EMBEDDING_DIM'] = EMBEDDING_DIM
+        params['Network']['OUTPUT_DIM'] = OUTPUT_DIM
         params['Network']['conv_out_ch'] = conv_out_ch
+        params['Network']['filter_sizes'] = filter_sizes
         params['Network']['MODEL_MODE'] = MODEL_MODE
+        params['Network']['EMBEDDING_BACKEND'] = EMBEDDING_BACKEND
+        params['Network']['NUM_BUCKETS'] = NUM_BUCKETS
         params['total_train_tweets'] = total_train_tweets
         params['total_valid_tweets'] = total_valid_tweets
-        write_config(params, cfg_path, sort_keys=True)
+        if rank == 0:
+            write_config(params, cfg_path, sort_keys=True)
+    barrier()
 
     trainer.execute_training(train_loader=train_iterator, valid_loader=valid_iterator, batch_size=BATCH_SIZE)
 
@@ -325,6 +429,8 @@ def main_test_postreply():
     HIDDEN_DIM = params['Network']['HIDDEN_DIM']
     conv_out_ch = params['Network']['conv_out_ch']
     MODEL_MODE = params['Network']['MODEL_MODE']
+    EMBEDDING_BACKEND = params['Network'].get('EMBEDDING_BACKEND', 'dense')
+    NUM_BUCKETS = params['Network'].get('NUM_BUCKETS')
     pretrained_embeddings = torch.zeros((vocab_size, EMBEDDING_DIM))
 
     # Prepare data
@@ -341,7 +447,8 @@ def main_test_postreply():
 
     predictor.setup_model(model=MODEL, vocab_size=vocab_size, embeddings=pretrained_embeddings,
                           embedding_dim=EMBEDDING_DIM, hidden_dim=HIDDEN_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
-                          conv_out_ch=conv_out_ch, filter_sizes=[3, 4, 5])
+                          conv_out_ch=conv_out_ch, filter_sizes=[3, 4, 5],
+                          embedding_backend=EMBEDDING_BACKEND, num_buckets=NUM_BUCKETS)
     predictor.predict(test_iterator, batch_size=BATCH_SIZE)
 
 
@@ -369,13 +476,10 @@ def main_ensemble_test_postreply():
     MODEL_MODE = 'ensemble'
     pretrained_embeddings = torch.zeros((vocab_size, EMBEDDING_DIM))
 
-    # Prepare data
-    data_handler_test_RNN = data_provider_PostReply(cfg_path=cfg_path_RNN, batch_size=BATCH_SIZE, split_ratio=SPLIT_RATIO,
-                                         max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TEST, model_mode='RNN')
-    data_handler_test_CNN = data_provider_PostReply(cfg_path=cfg_path_CNN, batch_size=BATCH_SIZE, split_ratio=SPLIT_RATIO,
-                                         max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TEST, model_mode="CNN")
-    test_iterator_RNN = data_handler_test_RNN.data_loader()
-    test_iterator_CNN = data_handler_test_CNN.data_loader()
+    # Prepare data: one dataset build for both models
+    data_handler_test = data_provider_PostReply(cfg_path=cfg_path_RNN, batch_size=BATCH_SIZE, split_ratio=SPLIT_RATIO,
+                                         max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TEST, model_mode=MODEL_MODE)
+    test_iterator = data_handler_test.data_loader()
     # Initialize predictor
     predictor = Prediction(cfg_path=params_RNN['cfg_path'], model_mode=MODEL_MODE, classes=classes,
                            cfg_path_RNN=cfg_path_RNN, cfg_path_CNN=cfg_path_CNN)
@@ -383,7 +487,184 @@ def main_ensemble_test_postreply():
     predictor.setup_model(model=biLSTM, vocab_size=vocab_size, embeddings=pretrained_embeddings,
                           embedding_dim=EMBEDDING_DIM, hidden_dim=HIDDEN_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
                           conv_out_ch=conv_out_ch, filter_sizes=[3, 4, 5], model_c =CNN1d, model_r=biLSTM)
-    predictor.predict_ensemble(test_iterator_RNN, test_iterator_CNN, batch_size=BATCH_SIZE)
+    predictor.predict_ensemble(test_iterator, batch_size=BATCH_SIZE)
+
+
+def main_distill_postreply(RESUME=False):
+    '''
+    Distillation of the CNN + biLSTM ensemble (see main_ensemble_test_postreply) into a single smaller CNN:
+    the ensemble runs once over the training set and its logits (the soft targets) are cached on disk
+    (dataset_cache_path of the config); the student is trained on a blend of the hard labels and of the
+    soft targets, see models/distillation.py. The student uses the data (vocabulary, split) of its teachers.
+    :RESUME: resumes the training of the student from its checkpoint
+    '''
+    EXPERIMENT_NAME_RNN = 'new_october'
+    EXPERIMENT_NAME_CNN = 'new_october_CNN'
+    # Hyper-parameters
+    NUM_EPOCH = 500
+    LOSS_FUNCTION = CrossEntropyLoss
+    OPTIMIZER = optim.Adam
+    BATCH_SIZE = 256
+    lr = 9e-5
+    optimiser_params = {'lr': lr, 'weight_decay': 1e-4}
+    OUTPUT_DIM = 3
+    conv_out_ch = 100  # the student: half of the kernels of the CNN of the ensemble
+    filter_sizes = [3, 4, 5]
+    ALPHA = 0.5 # weight of the loss on the hard labels, 1 - ALPHA: weight of the loss on the soft targets
+    TEMPERATURE = 2. # softens the distributions of the teacher and of the student
+    PATIENCE = None # opt-in early stopping after PATIENCE epochs without improvement of MONITOR by MIN_DELTA; None: all the NUM_EPOCH epochs
+    MIN_DELTA = 1e-4
+    MONITOR = 'valid_loss' # 'valid_loss' or 'valid_F1'
+    EXPERIMENT_NAME = "new_october_CNN_distilled"
+
+    params_RNN = open_experiment(EXPERIMENT_NAME_RNN)
+    params_CNN = open_experiment(EXPERIMENT_NAME_CNN)
+    MAX_VOCAB_SIZE = params_RNN['Network']['MAX_VOCAB_SIZE']
+    SPLIT_RATIO = params_RNN['Network']['SPLIT_RATIO']
+    EMBEDDING_DIM = params_RNN['Network']['EMBEDDING_DIM']
+    HIDDEN_DIM = params_RNN['Network']['HIDDEN_DIM']
+
+    if RESUME == False:
+        create_experiment(EXPERIMENT_NAME)
+    params = open_experiment(EXPERIMENT_NAME)
+    cfg_path = params["cfg_path"]
+
+    # Prepare data: the training batches carry the index of their examples, the key of the soft targets
+    data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=SPLIT_RATIO,
+                                           max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN, model_mode='CNN',
+                                           with_index=True)
+    train_iterator, valid_iterator, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, classes = data_handler.data_loader()
+    if vocab_size != params_RNN['Network']['vocab_size']:
+        raise ValueError('the vocabulary of the student differs from the one of the teachers')
+
+    # Soft targets: the ensemble runs only once over the training set (per version of the teacher models)
+    teacher = Prediction(cfg_path=params_RNN['cfg_path'], model_mode='ensemble', classes=classes,
+                         cfg_path_RNN=params_RNN['cfg_path'], cfg_path_CNN=params_CNN['cfg_path'])
+    soft_targets_path = soft_targets_file(data_handler.cache_path, data_handler.cache_key(),
+                                          teacher.ensemble_model_files())
+    soft_targets = load_soft_targets(soft_targets_path)
+    if soft_targets is None:
+        # the same examples in the layout of the ensemble
+        teacher_data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=SPLIT_RATIO,
+                                                       max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TRAIN,
+                                                       model_mode='ensemble', with_index=True)
+        teacher_iterator = teacher_data_handler.data_loader()[0]
+        teacher.setup_model(model=biLSTM, vocab_size=vocab_size, embeddings=torch.zeros((vocab_size, EMBEDDING_DIM)),
+                            embedding_dim=EMBEDDING_DIM, hidden_dim=HIDDEN_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
+                            conv_out_ch=params_CNN['Network']['conv_out_ch'], filter_sizes=[3, 4, 5],
+                            model_c=CNN1d, model_r=biLSTM)
+        soft_targets = teacher.ensemble_logits(teacher_iterator)
+        save_soft_targets(soft_targets_path, soft_targets)
+
+    total_train_tweets = len(train_iterator.dataset)
+    total_valid_tweets = 0 if SPLIT_RATIO == 1 else len(valid_iterator.dataset)
+    print(f'\nSummary:\n----------------------------------------------------')
+    print(f'Total # of Training tweets: {total_train_tweets:,}')
+    print(f'Total # of Valid. tweets:   {total_valid_tweets:,}')
+
+    # Initialize trainer
+    trainer = Training(cfg_path, num_epochs=NUM_EPOCH, RESUME=RESUME, model_mode='CNN',
+                       early_stopping=EarlyStopping(PATIENCE, MIN_DELTA, MONITOR) if PATIENCE else None,
+                       distillation=DistillationLoss(soft_targets, alpha=ALPHA, temperature=TEMPERATURE))
+    MODEL = CNN1d(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=EMBEDDING_DIM,
+                  conv_out_ch=conv_out_ch, filter_sizes=filter_sizes, output_dim=OUTPUT_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX)
+
+    if RESUME == True:
+        trainer.load_checkpoint(model=MODEL, optimiser=OPTIMIZER,
+                        optimiser_params=optimiser_params, loss_function=LOSS_FUNCTION, weight=weights)
+    else:
+        trainer.setup_model(model=MODEL, optimiser=OPTIMIZER,
+                        optimiser_params=optimiser_params, loss_function=LOSS_FUNCTION, weight=weights)
+        # writes the params to config file
+        params = read_config(cfg_path)
+        params['Network']['vocab_size'] = vocab_size
+        params['Network']['PAD_IDX'] = PAD_IDX
+        params['Network']['UNK_IDX'] = UNK_IDX
+        params['Network']['classes'] = classes
+        params['Network']['SPLIT_RATIO'] = SPLIT_RATIO
+        params['Network']['MAX_VOCAB_SIZE'] = MAX_VOCAB_SIZE
+        params['Network']['HIDDEN_DIM'] = HIDDEN_DIM
+        params['Network']['EMBEDDING_DIM'] = EMBEDDING_DIM
+        params['Network']['conv_out_ch'] = conv_out_ch
+        params['Network']['OUTPUT_DIM'] = OUTPUT_DIM
+        params['Network']['filter_sizes'] = filter_sizes
+        params['Network']['MODEL_MODE'] = 'CNN'
+        params['Network']['TEACHERS'] = [EXPERIMENT_NAME_RNN, EXPERIMENT_NAME_CNN]
+        params['total_train_tweets'] = total_train_tweets
+        params['total_valid_tweets'] = total_valid_tweets
+        write_config(params, cfg_path, sort_keys=True)
+
+    trainer.execute_training(train_loader=train_iterator, valid_loader=valid_iterator, batch_size=BATCH_SIZE)
+
+
+
+def main_distill_report(EPOCH=19):
+    '''
+    Compares the distilled student (main_distill_postreply) with the ensemble of its teachers
+    on the test set (final_test_post_reply.csv): accuracy, F1 score, number of parameters
+    and latency (milliseconds per tweet over the whole test set, data pipeline included).
+    The report is written to distillation_report.csv in the output_data_path of the student.
+    :EPOCH: the epoch of the student model to evaluate
+    '''
+    EXPERIMENT_NAME = 'new_october_CNN_distilled'
+    BATCH_SIZE = 256
+
+    params = open_experiment(EXPERIMENT_NAME)
+    cfg_path = params['cfg_path']
+    vocab_size = params['Network']['vocab_size']
+    PAD_IDX = params['Network']['PAD_IDX']
+    UNK_IDX = params['Network']['UNK_IDX']
+    classes = params['Network']['classes']
+    MAX_VOCAB_SIZE = params['Network']['MAX_VOCAB_SIZE']
+    SPLIT_RATIO = params['Network']['SPLIT_RATIO']
+    EMBEDDING_DIM = params['Network']['EMBEDDING_DIM']
+    HIDDEN_DIM = params['Network']['HIDDEN_DIM']
+    conv_out_ch = params['Network']['conv_out_ch']
+    filter_sizes = params['Network']['filter_sizes']
+    EXPERIMENT_NAME_RNN, EXPERIMENT_NAME_CNN = params['Network']['TEACHERS']
+    params_RNN = open_experiment(EXPERIMENT_NAME_RNN)
+    params_CNN = open_experiment(EXPERIMENT_NAME_CNN)
+    pretrained_embeddings = torch.zeros((vocab_size, EMBEDDING_DIM))
+    results = []
+
+    # Student
+    data_handler_test = data_provider_PostReply(cfg_path=cfg_path, batch_size=BATCH_SIZE, split_ratio=SPLIT_RATIO,
+                                         max_vocab_size=MAX_VOCAB_SIZE, mode=Mode.TEST, model_mode='CNN')
+    test_iterator = data_handler_test.data_loader()
+    num_tweets = len(test_iterator.dataset)
+    predictor = Prediction(cfg_path, model_mode='CNN', classes=classes)
+    predictor.setup_model(model=CNN1d, vocab_size=vocab_size, embeddings=pretrained_embeddings,
+                          embedding_dim=EMBEDDING_DIM, hidden_dim=HIDDEN_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
+                          epoch=EPOCH, conv_out_ch=conv_out_ch, filter_sizes=filter_sizes)
+    start_time = time.perf_counter()
+    acc, F1 = predictor.predict(test_iterator, batch_size=BATCH_SIZE)
+    test_time = time.perf_counter() - start_time
+    num_params = sum(p.numel() for p in predictor.model_p.parameters())
+    results.append(['student (' + EXPERIMENT_NAME + ')', acc, F1, num_params, 1000 * test_time / num_tweets])
+
+    # Ensemble of the teachers
+    data_handler_test = data_provider_PostReply(cfg_path=params_RNN['cfg_path'], batch_size=BATCH_SIZE,
+                                         split_ratio=SPLIT_RATIO, max_vocab_size=MAX_VOCAB_SIZE,
+                                         mode=Mode.TEST, model_mode='ensemble')
+    test_iterator = data_handler_test.data_loader()
+    predictor = Prediction(cfg_path=params_RNN['cfg_path'], model_mode='ensemble', classes=classes,
+                           cfg_path_RNN=params_RNN['cfg_path'], cfg_path_CNN=params_CNN['cfg_path'])
+    predictor.setup_model(model=biLSTM, vocab_size=vocab_size, embeddings=pretrained_embeddings,
+                          embedding_dim=EMBEDDING_DIM, hidden_dim=params_RNN['Network']['HIDDEN_DIM'],
+                          pad_idx=PAD_IDX, unk_idx=UNK_IDX, conv_out_ch=params_CNN['Network']['conv_out_ch'],
+                          filter_sizes=[3, 4, 5], model_c=CNN1d, model_r=biLSTM)
+    start_time = time.perf_counter()
+    acc, F1 = predictor.predict_ensemble(test_iterator, batch_size=BATCH_SIZE)
+    test_time = time.perf_counter() - start_time
+    num_params = sum(p.numel() for model in [predictor.model_cnn, predictor.model_rnn] for p in model.parameters())
+    results.append(['ensemble (' + EXPERIMENT_NAME_RNN + ' + ' + EXPERIMENT_NAME_CNN + ')', acc, F1, num_params,
+                    1000 * test_time / num_tweets])
+
+    report = pd.DataFrame(results, columns=['model', 'accuracy', 'F1', 'parameters', 'ms_per_tweet'])
+    report['speedup'] = report['ms_per_tweet'].iloc[1] / report['ms_per_tweet']
+    report.to_csv(os.path.join(params['output_data_path'], 'distillation_report.csv'), index=False)
+    print(f'\nDistillation report ({num_tweets:,} test tweets):')
+    print(report.to_string(index=False))
 
 
 def test_every_epoch():
@@ -402,6 +683,8 @@ def test_every_epoch():
     HIDDEN_DIM = params['Network']['HIDDEN_DIM']
     conv_out_ch = params['Network']['conv_out_ch']
     MODEL_MODE = params['Network']['MODEL_MODE']
+    EMBEDDING_BACKEND = params['Network'].get('EMBEDDING_BACKEND', 'dense')
+    NUM_BUCKETS = params['Network'].get('NUM_BUCKETS')
     pretrained_embeddings = torch.zeros((vocab_size, EMBEDDING_DIM))
 
     # Prepare data
@@ -424,7 +707,8 @@ def test_every_epoch():
 
         predictor.setup_model(model=MODEL, vocab_size=vocab_size, embeddings=pretrained_embeddings,
                               embedding_dim=EMBEDDING_DIM, hidden_dim=HIDDEN_DIM, pad_idx=PAD_IDX, unk_idx=UNK_IDX,
-                              epoch=EPOCH, conv_out_ch=conv_out_ch, filter_sizes=[3,4,5])
+                              epoch=EPOCH, conv_out_ch=conv_out_ch, filter_sizes=[3,4,5],
+                              embedding_backend=EMBEDDING_BACKEND, num_buckets=NUM_BUCKETS)
         acc, F1 = predictor.predict(test_iterator, batch_size=BATCH_SIZE)
 
         test_acc = test_acc.append(pd.DataFrame([[EPOCH, acc]], columns=['epoch', 'accuracy']))
@@ -436,14 +720,6 @@ def test_every_epoch():
 
 
 
-def prediction_time(start_time, end_time):
-    elapsed_time = end_time - start_time
-    elapsed_mins = int(elapsed_time / 60)
-    elapsed_secs = int(elapsed_time - (elapsed_mins * 60))
-    return elapsed_mins, elapsed_secs
-
-
-
 if __name__ == '__main__':
     # delete_experiment("new_october_CNN")
     # main_train()
@@ -451,6 +727,10 @@ if __name__ == '__main__':
     # main_manual_predict(prediction_mode='Manualpart2')
     # main_reply_predict('philipp')
     # main_train_postreply()
+    # main_train_postreply(RESUME=True)
+    # launch(main_train_postreply, 4) # distributed data parallel training on 4 processes
     # main_test_postreply()
     # test_every_epoch()
+    # main_distill_postreply()
+    # main_distill_report()
     main_ensemble_test_postreply()
\ No newline at end of file
@@ -9,24 +9,26 @@ https://tayebiarasteh.com/
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from models.embeddings import build_embedding
 import pdb
 
 
 class CNN1d(nn.Module):
     def __init__(self, vocab_size, embeddings, embedding_dim=200,
-                 conv_out_ch=200, filter_sizes=[3,4,5], output_dim=3, pad_idx=1, unk_idx=0):
+                 conv_out_ch=200, filter_sizes=[3,4,5], output_dim=3, pad_idx=1, unk_idx=0, sparse=False,
+                 embedding_backend='dense', num_buckets=None):
         '''
         :pad_idx: the index of the padding token <pad> in the vocabulary
+        :sparse: sparse gradients of the embedding table (only the rows of the batch), see models/optimisers.py;
+            not with the frozen 'int8' and 'float16' backends (ValueError)
+        :embedding_backend: 'dense', 'hashed' (num_buckets rows), 'int8' or 'float16' (frozen), see models/embeddings.py
         :conv_out_ch: number of the different kernels.
         :filter_sizes: a list of different kernel sizes we use here.
         '''
         super().__init__()
-        self.embedding = nn.Embedding(vocab_size, embedding_dim, padding_idx=pad_idx)
-        # replace the initial weights of the `embedding` layer with the pre-trained embeddings.
-        self.embedding.weight.data.copy_(embeddings)
-        # these are irrelevant for determining sentiment:
-        self.embedding.weight.data[pad_idx] = torch.zeros(embedding_dim)
-        self.embedding.weight.data[unk_idx] = torch.zeros(embedding_dim)
+        # the weights of the `embedding` layer are initialized with the pre-trained embeddings.
+        self.embedding = build_embedding(embedding_backend, vocab_size, embedding_dim, embeddings, pad_idx, unk_idx,
+                                         num_buckets=num_buckets, sparse=sparse)
 
         self.convs = nn.ModuleList([
             nn.Conv1d(in_channels=embedding_dim, out_channels=conv_out_ch,
@@ -0,0 +1,39 @@
+"""
+Knowledge distillation of the CNN + biLSTM ensemble into a single (student) model.
+The soft targets are the averaged logits of the ensemble for every training example, computed once
+(Prediction.ensemble_logits) and cached on disk (data/dataset_cache.py), keyed by the index of the example.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class DistillationLoss(nn.Module):
+    '''
+    Blend of the loss on the hard labels and of the loss on the soft targets of the teacher:
+        alpha * hard loss + (1 - alpha) * temperature^2 * KL(softmax(teacher / T) || softmax(student / T))
+    The temperature softens both distributions, so that the student also learns the relative probabilities
+    of the wrong classes; the factor temperature^2 keeps the gradients of the soft loss on the scale of the hard loss.
+    '''
+    def __init__(self, soft_targets, alpha=0.5, temperature=2.):
+        '''
+        :soft_targets: logits of the teacher [number of training examples, output dim], row i for the example of index i
+        :alpha: weight of the hard loss (1: no distillation, 0: only the soft targets)
+        '''
+        super().__init__()
+        self.register_buffer('soft_targets', soft_targets.float())
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def forward(self, output, hard_loss, index):
+        '''
+        :output: logits of the student [batch size, output dim]
+        :hard_loss: loss of the batch on the hard labels
+        :index: indices of the examples of the batch [batch size]
+        '''
+        teacher_output = self.soft_targets[index]
+        soft_loss = F.kl_div(F.log_softmax(output / self.temperature, dim=1),
+                             F.softmax(teacher_output / self.temperature, dim=1),
+                             reduction='batchmean') * self.temperature ** 2
+        return self.alpha * hard_loss + (1 - self.alpha) * soft_loss
@@ -0,0 +1,105 @@
+"""
+Compact alternatives to the dense float32 embedding table of the models.
+"""
+
+import torch
+import torch.nn as nn
+
+
+EMBEDDING_BACKENDS = ['dense', 'hashed', 'int8', 'float16']
+
+
+class HashedEmbedding(nn.Module):
+    '''
+    Hashing trick: the token ids share a table of `num_buckets` rows, bucket = hash(token id).
+    The special tokens (ids below `num_reserved`, e.g. <unk> and <pad>) keep rows of their own.
+    A bucket is initialized with the mean of the pretrained vectors of its tokens.
+    '''
+    def __init__(self, vocab_size, embedding_dim, num_buckets, embeddings=None, padding_idx=None, num_reserved=2,
+                 sparse=False):
+        super().__init__()
+        self.num_buckets = num_buckets
+        self.num_reserved = num_reserved
+        # the special tokens keep their ids
+        self.padding_idx = padding_idx
+        self.table = nn.Embedding(num_buckets, embedding_dim, padding_idx=padding_idx, sparse=sparse)
+        if embeddings is not None:
+            with torch.no_grad():
+                buckets = self.buckets(torch.arange(vocab_size))
+                counts = torch.zeros(num_buckets).index_add_(0, buckets, torch.ones(vocab_size))
+                self.table.weight.zero_()
+                self.table.weight.index_add_(0, buckets, embeddings.float())
+                self.table.weight.div_(counts.clamp(min=1).unsqueeze(1))
+
+    def buckets(self, ids):
+        # Knuth's multiplicative hashing
+        hashed = (ids * 2654435761) % 2 ** 32 % (self.num_buckets - self.num_reserved) + self.num_reserved
+        return torch.where(ids < self.num_reserved, ids, hashed)
+
+    def forward(self, ids):
+        return self.table(self.buckets(ids))
+
+
+class QuantizedEmbedding(nn.Module):
+    '''
+    Frozen embedding table stored row-quantized and dequantized to float32 on lookup:
+        'int8': int8 rows with a float32 scale per row (symmetric, scale = max |row| / 127)
+        'float16': half precision rows
+    The table is not trained (buffers, not parameters); the rest of the model is.
+    '''
+    def __init__(self, embeddings, dtype='int8', padding_idx=None):
+        super().__init__()
+        self.dtype = dtype
+        self.padding_idx = padding_idx
+        embeddings = embeddings.float()
+        if dtype == 'int8':
+            scale = embeddings.abs().max(dim=1)[0].clamp(min=1e-12) / 127
+            self.register_buffer('weight', torch.round(embeddings / scale.unsqueeze(1)).to(torch.int8))
+            self.register_buffer('scale', scale)
+        elif dtype == 'float16':
+            self.register_buffer('weight', embeddings.half())
+            self.scale = None
+        else:
+            raise ValueError(f'unknown dtype of the quantized embedding: {dtype}')
+
+    def forward(self, ids):
+        rows = self.weight[ids].float()
+        if self.scale is not None:
+            rows = rows * self.scale[ids].unsqueeze(-1)
+        return rows
+
+
+def build_embedding(backend, vocab_size, embedding_dim, embeddings, pad_idx, unk_idx, num_buckets=None, sparse=False):
+    '''
+    Embedding layer of the models, initialized with the pretrained embeddings (zero vectors for <pad> and <unk>).
+    :backend: 'dense' (nn.Embedding), 'hashed' (HashedEmbedding with num_buckets rows),
+        'int8' or 'float16' (QuantizedEmbedding, frozen)
+    :sparse: sparse gradients of the table ('dense' and 'hashed'; a frozen table has no gradients, ValueError)
+    '''
+    if sparse and backend in ['int8', 'float16']:
+        raise ValueError(f'sparse gradients need a trained embedding table, the {backend} backend is frozen')
+    # the pretrained table is copied once, into the weights of the layer; the <pad> and <unk> rows
+    # are zeroed there in place (these are irrelevant for determining sentiment)
+    if backend == 'dense':
+        embedding = nn.Embedding(vocab_size, embedding_dim, padding_idx=pad_idx, sparse=sparse)
+        embedding.weight.data.copy_(embeddings)
+        weight = embedding.weight.data
+    elif backend == 'hashed':
+        # the special tokens have buckets of their own
+        embedding = HashedEmbedding(vocab_size, embedding_dim, num_buckets, embeddings=embeddings, padding_idx=pad_idx,
+                                    num_reserved=max(pad_idx, unk_idx) + 1, sparse=sparse)
+        weight = embedding.table.weight.data
+    elif backend in ['int8', 'float16']:
+        embedding = QuantizedEmbedding(embeddings, dtype=backend, padding_idx=pad_idx)
+        weight = embedding.weight
+    else:
+        raise ValueError(f'unknown embedding backend: {backend}, possible backends: {EMBEDDING_BACKENDS}')
+    weight[pad_idx] = 0
+    weight[unk_idx] = 0
+    return embedding
+
+
+def embedding_size(embedding):
+    '''Bytes of the parameters and the buffers of an embedding layer'''
+    tensors = list(embedding.parameters()) + list(embedding.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
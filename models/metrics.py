@@ -0,0 +1,82 @@
+"""
+Streaming evaluation metrics, accumulated batch by batch on the device.
+"""
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+
+class MetricsAccumulator():
+    '''
+    Accumulates a confusion matrix and the (weighted) cross entropy loss over an epoch,
+    so that no per-example cache of logits, predictions and labels is needed.
+    The loss is the same as the weighted mean cross entropy over all the examples of the epoch:
+        sum(weight[label] * loss) / sum(weight[label])
+    '''
+    def __init__(self, num_classes=3, weight=None, device=None):
+        '''
+        :weight: class weights of the loss function (None: unweighted)
+        '''
+        self.num_classes = num_classes
+        self.weight = weight
+        self.confusion_matrix = torch.zeros((num_classes, num_classes), dtype=torch.long, device=device)
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.weight_sum = torch.zeros((), dtype=torch.float64, device=device)
+
+    def update(self, output, label):
+        '''
+        :output: logits [batch size, num_classes]
+        :label: [batch size]
+        '''
+        with torch.no_grad():
+            output = output.detach().float()
+            max_preds = output.argmax(dim=1)  # get the index of the max probability
+            self.confusion_matrix += torch.bincount(label * self.num_classes + max_preds,
+                                                    minlength=self.num_classes ** 2).view(self.num_classes, -1)
+            self.loss_sum += F.cross_entropy(output, label, weight=self.weight, reduction='sum').double()
+            if self.weight is None:
+                self.weight_sum += len(label)
+            else:
+                self.weight_sum += self.weight[label].sum().double()
+
+    def all_reduce(self):
+        '''Sums the metrics of all the processes of a distributed training; every process then has the totals'''
+        for tensor in [self.confusion_matrix, self.loss_sum, self.weight_sum]:
+            dist.all_reduce(tensor)
+
+    def state_dict(self):
+        return {'confusion_matrix': self.confusion_matrix.cpu(), 'loss_sum': self.loss_sum.cpu(),
+                'weight_sum': self.weight_sum.cpu()}
+
+    def load_state_dict(self, state_dict):
+        self.confusion_matrix.copy_(state_dict['confusion_matrix'])
+        self.loss_sum.copy_(state_dict['loss_sum'])
+        self.weight_sum.copy_(state_dict['weight_sum'])
+
+    def loss(self):
+        return (self.loss_sum / self.weight_sum).item()
+
+    def scores(self):
+        '''
+        Per-class precision, recall and F1 score (0 when undefined, like sklearn)
+        rows of the confusion matrix: true labels, columns: predicted labels
+        '''
+        confusion_matrix = self.confusion_matrix.double()
+        true_positives = confusion_matrix.diag()
+        precision = true_positives / confusion_matrix.sum(dim=0).clamp(min=1)
+        recall = true_positives / confusion_matrix.sum(dim=1).clamp(min=1)
+        f1_score = 2 * precision * recall / (precision + recall).clamp(min=1e-15)
+        return precision.cpu(), recall.cpu(), f1_score.cpu()
+
+    def compute(self):
+        '''
+        Returns loss, accuracy, f1_score, precision, recall
+        Like before, we only care about the average of positive class and negative class (classes 1 and 2).
+        '''
+        accuracy = (self.confusion_matrix.diag().sum().double() / self.confusion_matrix.sum().clamp(min=1)).item()
+        precision, recall, f1_score = self.scores()
+        f1_score = ((f1_score[1] + f1_score[2]) / 2).item()
+        precision = ((precision[1] + precision[2]) / 2).item()
+        recall = ((recall[1] + recall[2]) / 2).item()
+        return self.loss(), accuracy, f1_score, precision, recall
@@ -0,0 +1,70 @@
+"""
+Optimisers for the models with a sparse embedding table.
+"""
+
+import torch.nn as nn
+import torch.optim as optim
+
+
+class MultiOptimiser():
+    '''
+    Several optimisers over disjoint sets of parameters, used like one optimiser
+    (zero_grad, step, state_dict, load_state_dict, param_groups).
+    '''
+    def __init__(self, *optimisers):
+        self.optimisers = optimisers
+
+    @property
+    def param_groups(self):
+        return [group for optimiser in self.optimisers for group in optimiser.param_groups]
+
+    def zero_grad(self):
+        for optimiser in self.optimisers:
+            optimiser.zero_grad()
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+        for optimiser in self.optimisers:
+            optimiser.step()
+        return loss
+
+    def state_dict(self):
+        return {'optimisers': [optimiser.state_dict() for optimiser in self.optimisers]}
+
+    def load_state_dict(self, state_dict):
+        for optimiser, optimiser_state in zip(self.optimisers, state_dict['optimisers']):
+            optimiser.load_state_dict(optimiser_state)
+
+
+def scaler_step(scaler, optimiser):
+    '''
+    scaler.step(optimiser) for an optimiser or a MultiOptimiser: GradScaler only steps a torch.optim.Optimizer,
+    so each optimiser of a MultiOptimiser is unscaled and stepped on its own (skipped if its gradients are inf/NaN).
+    scaler.update() is then called once for all of them.
+    '''
+    for sub_optimiser in getattr(optimiser, 'optimisers', [optimiser]):
+        scaler.step(sub_optimiser)
+
+
+def sparse_parameters(model):
+    '''Weights of the embedding layers of the model with sparse gradients (nn.Embedding(..., sparse=True))'''
+    return [module.weight for module in model.modules() if isinstance(module, nn.Embedding) and module.sparse]
+
+
+def build_optimiser(model, optimiser, optimiser_params):
+    '''
+    optimiser(model.parameters(), **optimiser_params), except for a model with a sparse embedding:
+    then the embedding table is updated by SparseAdam (only the rows of the batch, with moment buffers
+    only for the rows seen so far) and the rest of the model by `optimiser`.
+    SparseAdam has no weight decay, so weight_decay of optimiser_params only applies to the rest of the model.
+    '''
+    sparse_params = sparse_parameters(model)
+    if not sparse_params:
+        return optimiser(model.parameters(), **optimiser_params)
+    sparse_ids = {id(param) for param in sparse_params}
+    dense_params = [param for param in model.parameters() if id(param) not in sparse_ids]
+    sparse_optimiser_params = {name: value for name, value in optimiser_params.items() if name in ['lr', 'betas', 'eps']}
+    return MultiOptimiser(optim.SparseAdam(sparse_params, **sparse_optimiser_params),
+                          optimiser(dense_params, **optimiser_params))
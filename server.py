@@ -0,0 +1,371 @@
+'''
+Local HTTP scoring service of the tweet-reply polarity (asyncio, no dependency beyond the standard library).
+The model is loaded once from the inference bundle of an experiment (see main_export_bundle in main.py);
+the concurrent requests are coalesced into micro-batches of at most MAX_BATCH_SIZE texts, waiting at most
+MAX_WAIT_MS for more requests, which are scored by one call of Prediction.predict_texts.
+Endpoints:
+    POST /predict   {"texts": ["...", ...]} (or {"text": "..."})
+                    -> {"labels": [...], "probabilities": [[...], ...], "classes": [...]}
+    GET  /metrics   latency percentiles (p50, p99), throughput and batching counters
+    GET  /health
+Bodies over MAX_BODY_BYTES are rejected with 413, malformed requests with 400.
+Start the server with the main block, and try it with load_test (or curl) on localhost.
+'''
+
+#System Modules
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+# largest request body accepted, in bytes
+MAX_BODY_BYTES = 1 << 20
+
+
+
+class ServerMetrics():
+    '''
+    Counters of the server since its start, and the latencies (seconds, from the arrival of the request to its answer)
+    of the last `window` requests, for the percentiles.
+    '''
+    def __init__(self, window=10000):
+        self.start_time = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_texts = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.model_time = 0.
+
+    def add_request(self, num_texts, latency):
+        self.num_requests += 1
+        self.num_texts += num_texts
+        self.latencies.append(latency)
+
+    def add_batch(self, model_time):
+        self.num_batches += 1
+        self.model_time += model_time
+
+    def percentile(self, q):
+        '''q-th percentile (nearest rank) of the latencies of the window, in milliseconds'''
+        if not self.latencies:
+            return 0.
+        latencies = sorted(self.latencies)
+        return 1000 * latencies[min(int(q / 100 * len(latencies)), len(latencies) - 1)]
+
+    def summary(self):
+        uptime = time.perf_counter() - self.start_time
+        return {'uptime_s': uptime,
+                'requests': self.num_requests,
+                'texts': self.num_texts,
+                'errors': self.num_errors,
+                'batches': self.num_batches,
+                'mean_batch_size': self.num_texts / max(self.num_batches, 1),
+                'latency_p50_ms': self.percentile(50),
+                'latency_p99_ms': self.percentile(99),
+                'requests_per_sec': self.num_requests / uptime,
+                'texts_per_sec': self.num_texts / uptime,
+                'model_time_s': self.model_time}
+
+
+
+class MicroBatcher():
+    '''
+    Collects the texts of the concurrent requests and scores them together:
+    a batch is closed when it has max_batch_size texts or max_wait_ms after its first request.
+    A request with more than max_batch_size texts is split into several batches.
+    The model runs in a worker thread, so the event loop keeps accepting requests meanwhile;
+    the batches are scored one after the other. The metrics are only updated on the event loop.
+    When a batch fails, its requests are scored again one by one: only the failing request gets the error.
+    '''
+    def __init__(self, predictor, max_batch_size=64, max_wait_ms=5, metrics=None):
+        '''
+        :predictor: Prediction with a model and a vocabulary (Prediction.from_bundle)
+        '''
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = metrics or ServerMetrics()
+        self.queue = None
+        # a request which did not fit in the previous batch, the first of the next one
+        self.pending = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+
+    def start(self):
+        # created in the event loop of the server
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown()
+
+    async def predict(self, texts):
+        '''Labels and probabilities of the texts of one request, in chunks of at most max_batch_size texts'''
+        loop = asyncio.get_running_loop()
+        futures = []
+        for start in range(0, len(texts), self.max_batch_size):
+            future = loop.create_future()
+            await self.queue.put((texts[start:start + self.max_batch_size], future))
+            futures.append(future)
+        labels, probabilities = [], []
+        for chunk_labels, chunk_probabilities in await asyncio.gather(*futures):
+            labels += chunk_labels
+            probabilities += chunk_probabilities
+        return labels, probabilities
+
+    async def next_batch(self):
+        '''Requests of the next batch, with at most max_batch_size texts together'''
+        if self.pending is not None:
+            requests, self.pending = [self.pending], None
+        else:
+            requests = [await self.queue.get()]
+        num_texts = len(requests[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while num_texts < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if num_texts + len(request[0]) > self.max_batch_size:
+                self.pending = request
+                break
+            requests.append(request)
+            num_texts += len(request[0])
+        return requests
+
+    def score(self, texts):
+        '''Runs in the worker thread; returns the labels, the probabilities and the time of the model'''
+        start_time = time.perf_counter()
+        labels, probabilities = self.predictor.predict_texts(texts, batch_size=max(len(texts), 1))
+        return labels, probabilities, time.perf_counter() - start_time
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.next_batch()
+            texts = [text for request_texts, _ in requests for text in request_texts]
+            try:
+                labels, probabilities, model_time = await loop.run_in_executor(self.executor, self.score, texts)
+            except Exception as error:
+                if len(requests) == 1:
+                    self.set_exception(requests[0][1], error)
+                    continue
+                # scored again one request at a time, so that only the request which fails gets the error
+                for request_texts, future in requests:
+                    try:
+                        result = await loop.run_in_executor(self.executor, self.score, request_texts)
+                    except Exception as request_error:
+                        self.set_exception(future, request_error)
+                        continue
+                    self.set_result([(request_texts, future)], *result)
+                continue
+            self.set_result(requests, labels, probabilities, model_time)
+
+    def set_result(self, requests, labels, probabilities, model_time):
+        '''the results of each request of a scored batch, in the order of its texts'''
+        self.metrics.add_batch(model_time)
+        start = 0
+        for request_texts, future in requests:
+            end = start + len(request_texts)
+            if not future.done():
+                future.set_result((labels[start:end], probabilities[start:end].tolist()))
+            start = end
+
+    @staticmethod
+    def set_exception(future, error):
+        if not future.done():
+            future.set_exception(error)
+
+
+
+class ScoringServer():
+    '''
+    Minimal HTTP/1.1 server (keep-alive, JSON bodies with Content-Length) in front of a MicroBatcher
+    '''
+    def __init__(self, predictor, host='127.0.0.1', port=8000, max_batch_size=64, max_wait_ms=5):
+        self.predictor = predictor
+        self.host = host
+        self.port = port
+        self.metrics = ServerMetrics()
+        self.batcher = MicroBatcher(predictor, max_batch_size, max_wait_ms, self.metrics)
+        self.server = None
+
+    async def start(self):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        # port 0: the port chosen by the system
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        print(f'Scoring server listening on http://{self.host}:{self.port} '
+              f'(max batch size: {self.batcher.max_batch_size}, max wait: {self.batcher.max_wait * 1000:g} ms)')
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    # the rest of the stream cannot be parsed: answer and close the connection
+                    self.metrics.num_errors += 1
+                    await self.respond(writer, 400, {'error': 'malformed request line'}, keep_alive=False)
+                    break
+                method, path, _ = parts
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                content_length = headers.get('content-length', '0')
+                if not content_length.isdigit():
+                    self.metrics.num_errors += 1
+                    await self.respond(writer, 400, {'error': 'invalid Content-Length'}, keep_alive=False)
+                    break
+                if int(content_length) > MAX_BODY_BYTES:
+                    self.metrics.num_errors += 1
+                    await self.respond(writer, 413, {'error': f'the body is limited to {MAX_BODY_BYTES:,} bytes'},
+                                       keep_alive=False)
+                    break
+                body = await reader.readexactly(int(content_length))
+
+                status, response = await self.route(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self.respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, response, keep_alive=True):
+        payload = json.dumps(response).encode()
+        writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                     f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+                     f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload)
+        await writer.drain()
+
+    async def route(self, method, path, body):
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            return await self.handle_predict(body)
+        if path == '/metrics':
+            return 200, self.metrics.summary()
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': 'unknown path ' + path}
+
+    async def handle_predict(self, body):
+        start_time = time.perf_counter()
+        try:
+            request = json.loads(body or b'{}')
+            texts = request['texts'] if 'texts' in request else [request['text']]
+            if not isinstance(texts, list):
+                raise TypeError
+            texts = [str(text) for text in texts]
+        except (ValueError, KeyError, TypeError):
+            self.metrics.num_errors += 1
+            return 400, {'error': 'expected a JSON body {"texts": ["...", ...]} or {"text": "..."}'}
+        if not texts:
+            return 200, {'labels': [], 'probabilities': [], 'classes': list(self.predictor.classes)}
+        try:
+            labels, probabilities = await self.batcher.predict(texts)
+        except Exception as error:
+            self.metrics.num_errors += 1
+            return 500, {'error': repr(error)}
+        self.metrics.add_request(len(texts), time.perf_counter() - start_time)
+        return 200, {'labels': labels, 'probabilities': probabilities, 'classes': list(self.predictor.classes)}
+
+
+
+async def request_json(host, port, method, path, body=None):
+    '''One request on its own connection; returns the status and the decoded JSON response'''
+    reader, writer = await asyncio.open_connection(host, port)
+    payload = json.dumps(body).encode() if body is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    response = json.loads(await reader.readexactly(int(headers['content-length'])))
+    writer.close()
+    return status, response
+
+
+async def load_test(host='127.0.0.1', port=8000, texts=None, num_requests=1000, concurrency=32):
+    '''
+    Sends num_requests single-text requests, `concurrency` of them at a time, and prints the client-side
+    throughput and the metrics of the server.
+    '''
+    texts = texts or ['I have to say that I got divorced', 'What a wonderful day!', 'This is the worst service ever']
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(idx):
+        async with semaphore:
+            status, _ = await request_json(host, port, 'POST', '/predict', {'text': texts[idx % len(texts)]})
+            return status
+
+    start_time = time.perf_counter()
+    statuses = await asyncio.gather(*[send(idx) for idx in range(num_requests)])
+    total_time = time.perf_counter() - start_time
+    print(f'{num_requests:,} requests ({concurrency} concurrent) in {total_time:.2f}s: '
+          f'{num_requests / total_time:,.0f} requests/s | errors: {sum(status != 200 for status in statuses)}')
+    _, metrics = await request_json(host, port, 'GET', '/metrics')
+    print(json.dumps(metrics, indent=2))
+    return metrics
+
+
+def serve(predictor, host='127.0.0.1', port=8000, max_batch_size=64, max_wait_ms=5):
+    server = ScoringServer(predictor, host, port, max_batch_size, max_wait_ms)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == '__main__':
+    EXPERIMENT_NAME = 'Adam_lr0.0001_max_vocab_size50000'
+    HOST = '127.0.0.1'
+    PORT = 8000
+    MAX_BATCH_SIZE = 64 # texts scored together at most
+    MAX_WAIT_MS = 5 # the longest a request waits for others to join its batch
+
+    # imported here: the clients (load_test) do not need the training stack
+    from main import load_predictor
+
+    # the bundle of the experiment, exported again if it is missing or out of date
+    serve(load_predictor(EXPERIMENT_NAME), HOST, PORT, MAX_BATCH_SIZE, MAX_WAIT_MS)
+    # in another shell: python -c "import asyncio, server; asyncio.run(server.load_test())"
@@ -0,0 +1,265 @@
+'''
+Hyper-parameter sweeps of the post-reply training.
+The trials run in parallel in a pool of processes, which share the cores of the machine;
+each trial is an experiment of its own (create_experiment), all of them share the dataset and the embedding caches.
+Set the search space and the fixed hyper-parameters in the main block.
+run_successive_halving only trains the most promising trials to the full number of epochs.
+'''
+
+# Deep Learning Modules
+from torch.nn import *
+import torch
+import torch.optim as optim
+
+# User Defined Modules
+from configs.serde import *
+from Train_Test_Valid import Training, Mode
+from data.data_handler import data_provider_PostReply
+from models.biLSTM import biLSTM
+from models.CNN import CNN1d
+from utils.early_stopping import EarlyStopping
+
+#System Modules
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+import multiprocessing
+import random
+import math
+import csv
+import os
+
+
+# fixed hyper-parameters of all the trials, like in main_train_postreply (overridden by the search space)
+DEFAULT_HYPERPARAMETERS = {'NUM_EPOCH': 10, 'BATCH_SIZE': 256, 'MAX_VOCAB_SIZE': 750000, 'lr': 9e-5,
+                           'weight_decay': 1e-4, 'EMBEDDING_DIM': 200, 'HIDDEN_DIM': 300, 'OUTPUT_DIM': 3,
+                           'MODEL_MODE': 'CNN', 'conv_out_ch': 200, 'filter_sizes': [3, 4, 5], 'SPLIT_RATIO': 0.9,
+                           'MAX_TOKENS': None, 'MIXED_PRECISION': False, 'SPARSE_EMBEDDING': False,
+                           'EMBEDDING_BACKEND': 'dense', 'NUM_BUCKETS': 100000, 'SEED': 1,
+                           'PATIENCE': 5, 'MIN_DELTA': 1e-4, 'MONITOR': 'valid_loss'}
+
+
+
+def grid_search(search_space):
+    '''All the combinations of the values of the search space {name: [values]}'''
+    names = list(search_space)
+    return [dict(zip(names, values)) for values in product(*[search_space[name] for name in names])]
+
+
+def random_search(search_space, num_trials, seed=1):
+    '''
+    `num_trials` random trials of the search space:
+        [values]: one of the values
+        (low, high) of ints: an integer in [low, high]
+        (low, high) of floats: log-uniform in [low, high] (learning rates, weight decays)
+    '''
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(num_trials):
+        trial = {}
+        for name, values in search_space.items():
+            if isinstance(values, list):
+                trial[name] = rng.choice(values)
+            elif all(isinstance(value, int) for value in values):
+                trial[name] = rng.randint(*values)
+            else:
+                trial[name] = math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+        trials.append(trial)
+    return trials
+
+
+
+def set_num_threads(num_threads):
+    '''Initializer of the worker processes: the cores are partitioned between the trials running in parallel'''
+    torch.set_num_threads(num_threads)
+
+
+def build_caches(trials, cache_path):
+    '''
+    Builds the dataset and the embedding caches of the trials once, before the parallel trials,
+    which then only load them (one build per distinct MAX_VOCAB_SIZE / SPLIT_RATIO / SEED).
+    '''
+    data_configs = {(trial['MAX_VOCAB_SIZE'], trial['SPLIT_RATIO'], trial['SEED']) for trial in trials}
+    for MAX_VOCAB_SIZE, SPLIT_RATIO, SEED in data_configs:
+        data_provider_PostReply(cfg_path=CONFIG_PATH, split_ratio=SPLIT_RATIO, max_vocab_size=MAX_VOCAB_SIZE,
+                                mode=Mode.TRAIN, seed=SEED, embedding_cache_path=cache_path).data_loader()
+
+
+def run_trial(EXPERIMENT_NAME, hyperparameters, embedding_cache_path, RESUME=False):
+    '''
+    Trains the model of one trial in its own experiment up to NUM_EPOCH epochs; returns the summary of execute_training.
+    :RESUME: continues the training of the experiment from its checkpoint (successive halving)
+    '''
+    h = hyperparameters
+    if RESUME:
+        params = open_experiment(EXPERIMENT_NAME)
+    else:
+        params = create_experiment(EXPERIMENT_NAME)
+    cfg_path = params['cfg_path']
+    torch.manual_seed(h['SEED'])
+
+    data_handler = data_provider_PostReply(cfg_path=cfg_path, batch_size=h['BATCH_SIZE'], split_ratio=h['SPLIT_RATIO'],
+                                           max_vocab_size=h['MAX_VOCAB_SIZE'], mode=Mode.TRAIN,
+                                           model_mode=h['MODEL_MODE'], seed=h['SEED'], max_tokens=h['MAX_TOKENS'],
+                                           embedding_cache_path=embedding_cache_path)
+    train_iterator, valid_iterator, vocab_size, PAD_IDX, UNK_IDX, pretrained_embeddings, weights, classes = data_handler.data_loader()
+
+    early_stopping = EarlyStopping(h['PATIENCE'], h['MIN_DELTA'], h['MONITOR']) if h['PATIENCE'] else None
+    trainer = Training(cfg_path, num_epochs=h['NUM_EPOCH'], RESUME=RESUME, model_mode=h['MODEL_MODE'],
+                       torch_seed=h['SEED'], mixed_precision=h['MIXED_PRECISION'], early_stopping=early_stopping)
+    if h['MODEL_MODE'] == "RNN":
+        MODEL = biLSTM(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=h['EMBEDDING_DIM'],
+                       hidden_dim=h['HIDDEN_DIM'], output_dim=h['OUTPUT_DIM'], pad_idx=PAD_IDX, unk_idx=UNK_IDX,
+                       sparse=h['SPARSE_EMBEDDING'], embedding_backend=h['EMBEDDING_BACKEND'],
+                       num_buckets=h['NUM_BUCKETS'])
+    elif h['MODEL_MODE'] == "CNN":
+        MODEL = CNN1d(vocab_size=vocab_size, embeddings=pretrained_embeddings, embedding_dim=h['EMBEDDING_DIM'],
+                      conv_out_ch=h['conv_out_ch'], filter_sizes=h['filter_sizes'], output_dim=h['OUTPUT_DIM'],
+                      pad_idx=PAD_IDX, unk_idx=UNK_IDX, sparse=h['SPARSE_EMBEDDING'],
+                      embedding_backend=h['EMBEDDING_BACKEND'], num_buckets=h['NUM_BUCKETS'])
+    optimiser_params = {'lr': h['lr'], 'weight_decay': h['weight_decay']}
+    if RESUME:
+        trainer.load_checkpoint(model=MODEL, optimiser=optim.Adam, optimiser_params=optimiser_params,
+                                loss_function=CrossEntropyLoss, weight=weights)
+    else:
+        trainer.setup_model(model=MODEL, optimiser=optim.Adam, optimiser_params=optimiser_params,
+                            loss_function=CrossEntropyLoss, weight=weights)
+
+        # writes the params to config file, like main_train_postreply
+        params = read_config(cfg_path)
+        params['Network'].update({'vocab_size': vocab_size, 'PAD_IDX': PAD_IDX, 'UNK_IDX': UNK_IDX, 'classes': classes,
+                                  'SPLIT_RATIO': h['SPLIT_RATIO'], 'MAX_VOCAB_SIZE': h['MAX_VOCAB_SIZE'],
+                                  'HIDDEN_DIM': h['HIDDEN_DIM'], 'EMBEDDING_DIM': h['EMBEDDING_DIM'],
+                                  'OUTPUT_DIM': h['OUTPUT_DIM'], 'conv_out_ch': h['conv_out_ch'],
+                                  'filter_sizes': h['filter_sizes'], 'MODEL_MODE': h['MODEL_MODE'],
+                                  'EMBEDDING_BACKEND': h['EMBEDDING_BACKEND'], 'NUM_BUCKETS': h['NUM_BUCKETS']})
+        params['sweep_hyperparameters'] = h
+        write_config(params, cfg_path, sort_keys=True)
+
+    return trainer.execute_training(train_loader=train_iterator, valid_loader=valid_iterator, batch_size=h['BATCH_SIZE'])
+
+
+
+def run_sweep(SWEEP_NAME, trials, num_workers=2, hyperparameters=DEFAULT_HYPERPARAMETERS):
+    '''
+    Runs the trials (list of {hyper-parameter: value}, see grid_search and random_search) in `num_workers`
+    parallel processes with cpu_count / num_workers threads each, and writes the summary table
+    (sorted by the validation F1) to output_data_path/SWEEP_NAME_summary.csv.
+    '''
+    params = read_config(CONFIG_PATH)
+    embedding_cache_path = os.path.join(params['dataset_cache_path'], 'embeddings')
+    os.makedirs(embedding_cache_path, exist_ok=True)
+    trials = [dict(hyperparameters, **trial) for trial in trials]
+    build_caches(trials, embedding_cache_path)
+
+    print(f'Sweep {SWEEP_NAME}: {len(trials)} trials, {num_workers} in parallel')
+    results = run_trials(SWEEP_NAME, dict(enumerate(trials)), num_workers, embedding_cache_path)
+
+    write_summary(results, os.path.join(params['output_data_path'], SWEEP_NAME + '_summary.csv'),
+                  varied=varied_hyperparameters(trials))
+    return results
+
+
+def run_trials(SWEEP_NAME, trials, num_workers, embedding_cache_path, RESUME=False):
+    '''
+    Runs the trials ({trial index: hyper-parameters}) in `num_workers` parallel processes
+    with cpu_count / num_workers threads each. Returns the rows of the summary table, one per trial.
+    '''
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    results = []
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=set_num_threads, initargs=(num_threads,)) as executor:
+        futures = {executor.submit(run_trial, '{}_trial{:03d}'.format(SWEEP_NAME, idx), trial, embedding_cache_path,
+                                   RESUME): (idx, trial) for idx, trial in trials.items()}
+        for future in as_completed(futures):
+            idx, trial = futures[future]
+            try:
+                summary = future.result()
+            except Exception as error:
+                print(f'Trial {idx:03d} failed: {error!r}')
+                summary = {}
+            results.append(dict({'trial': idx}, **trial, **summary))
+    return results
+
+
+def run_successive_halving(SWEEP_NAME, trials, min_epochs=5, max_epochs=80, reduction_factor=3, metric='valid_F1',
+                           num_workers=2, hyperparameters=DEFAULT_HYPERPARAMETERS):
+    '''
+    Successive halving: all the trials are trained for `min_epochs` epochs; the best 1 / reduction_factor of them
+    (on `metric` of the last epoch: '..._loss' lower is better, otherwise higher) are promoted and trained on
+    (resumed from their checkpoints) up to reduction_factor times more epochs, and so on until `max_epochs`.
+    A trial stopped early by its early stopping policy is ranked but not promoted.
+    The summary table has one row per trial, with the metrics of the last rung it reached.
+    '''
+    params = read_config(CONFIG_PATH)
+    embedding_cache_path = os.path.join(params['dataset_cache_path'], 'embeddings')
+    os.makedirs(embedding_cache_path, exist_ok=True)
+    trials = [dict(hyperparameters, **trial) for trial in trials]
+    build_caches(trials, embedding_cache_path)
+    lower_is_better = metric.endswith('loss')
+
+    rung_trials = dict(enumerate(trials))
+    final_results = {}
+    num_epochs = min_epochs
+    rung = 0
+    while rung_trials:
+        print(f'\nSuccessive halving {SWEEP_NAME}, rung {rung}: {len(rung_trials)} trials, {num_epochs} epochs')
+        rung_trials = {idx: dict(trial, NUM_EPOCH=num_epochs) for idx, trial in rung_trials.items()}
+        results = run_trials(SWEEP_NAME, rung_trials, num_workers, embedding_cache_path, RESUME=rung > 0)
+        for result in results:
+            result['rung'] = rung
+            final_results[result['trial']] = result
+        if num_epochs >= max_epochs:
+            break
+
+        candidates = [result for result in results if metric in result and not result.get('stopped_early')]
+        candidates.sort(key=lambda result: result[metric], reverse=not lower_is_better)
+        promoted = candidates[:max(1, len(rung_trials) // reduction_factor)] if candidates else []
+        rung_trials = {result['trial']: rung_trials[result['trial']] for result in promoted}
+        num_epochs = min(num_epochs * reduction_factor, max_epochs)
+        rung += 1
+
+    write_summary(list(final_results.values()), os.path.join(params['output_data_path'], SWEEP_NAME + '_summary.csv'),
+                  varied=['rung'] + varied_hyperparameters(trials))
+    return final_results
+
+
+def varied_hyperparameters(trials):
+    return sorted({name for trial in trials for name in trial if len({str(t[name]) for t in trials}) > 1})
+
+
+def write_summary(results, file_path, varied):
+    '''Prints the table of the trials (the hyper-parameters which vary and the metrics) and writes it as csv'''
+    results.sort(key=lambda result: result.get('valid_F1', result.get('train_F1', -1)), reverse=True)
+    metrics = ['epoch', 'train_loss', 'train_F1', 'valid_loss', 'valid_acc', 'valid_F1', 'total_time']
+    columns = ['trial'] + varied + metrics
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w', newline='') as f:
+        fieldnames = columns + sorted({name for result in results for name in result} - set(columns))
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(results)
+
+    print('\n' + ''.join(f'{column:>14}' for column in columns))
+    for result in results:
+        print(''.join(f'{format_value(result.get(column)):>14}' for column in columns))
+    print(f'\nSummary written to {file_path}')
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    return str(value)
+
+
+
+if __name__ == '__main__':
+    SWEEP_NAME = 'sweep_CNN'
+    SEARCH_SPACE = {'lr': [5e-5, 9e-5, 2e-4], 'conv_out_ch': [100, 200], 'filter_sizes': [[3, 4, 5], [2, 3, 4]]}
+    run_sweep(SWEEP_NAME, grid_search(SEARCH_SPACE), num_workers=2)
+    # run_sweep('sweep_RNN', random_search({'lr': (1e-5, 1e-3), 'HIDDEN_DIM': [256, 300, 512], 'MODEL_MODE': ['RNN']},
+    #                                      num_trials=8), num_workers=2)
+    # run_successive_halving('halving_CNN', random_search({'lr': (1e-5, 1e-3), 'conv_out_ch': [100, 200, 300]},
+    #                                                     num_trials=27), min_epochs=5, max_epochs=45)
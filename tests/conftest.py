@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the repository are imported from its root, as in main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
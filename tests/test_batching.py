@@ -0,0 +1,74 @@
+'''
+Token-budget batching (data/batching.py): the budget of the batches, the coverage of an epoch
+and the resume point of state_dict / load_state_dict, on which the resumed train_epoch relies.
+'''
+import random
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('torchtext')
+from data.batching import TokenBudgetIterator, data
+
+
+def build_dataset(num_examples=500, max_length=40, seed=0):
+    rng = random.Random(seed)
+    TEXT = data.Field()
+    LABEL = data.Field(sequential=False)
+    fields = [('label', LABEL), ('text', TEXT)]
+    # the first token of an example is its id
+    examples = [data.Example.fromlist([str(idx % 3), ['id%d' % idx] + ['tok'] * rng.randint(0, max_length - 1)], fields)
+                for idx in range(num_examples)]
+    dataset = data.Dataset(examples, fields)
+    TEXT.build_vocab(dataset)
+    LABEL.build_vocab(dataset)
+    return dataset
+
+
+def batch_ids(batch):
+    '''ids of the examples of a (time-major) batch'''
+    itos = batch.dataset.fields['text'].vocab.itos
+    return [int(itos[token][2:]) for token in batch.text[0].tolist()]
+
+
+def test_batches_within_token_budget():
+    dataset = build_dataset()
+    iterator = TokenBudgetIterator(dataset, max_tokens=200, max_batch_size=16)
+    lengths = [len(example.text) for example in dataset.examples]
+    for batch in iterator.batches:
+        padded_tokens = len(batch) * max(lengths[idx] for idx in batch)
+        assert padded_tokens <= 200 or len(batch) == 1
+        assert len(batch) <= 16
+    for batch in iterator:
+        text = batch.text
+        assert text.shape[0] * text.shape[1] <= 200
+
+
+def test_every_example_once_per_epoch():
+    dataset = build_dataset()
+    iterator = TokenBudgetIterator(dataset, max_tokens=300, seed=3)
+    epochs = [[idx for batch in iterator for idx in batch_ids(batch)] for _ in range(2)]
+    for epoch in epochs:
+        assert sorted(epoch) == list(range(len(dataset)))
+    # the order of the batches is shuffled every epoch
+    assert epochs[0] != epochs[1]
+
+
+def test_resume_lands_on_next_batch():
+    dataset = build_dataset()
+    iterator = TokenBudgetIterator(dataset, max_tokens=300, seed=5)
+    next(iter(iterator)) # an earlier epoch: the random state moves on
+    full_epoch = [batch.text.tolist() for batch in iterator]
+
+    interrupted = TokenBudgetIterator(dataset, max_tokens=300, seed=5)
+    next(iter(interrupted))
+    epoch = iter(interrupted)
+    done = [next(epoch).text.tolist() for _ in range(7)]
+    state = interrupted.state_dict()
+    assert state['iterations_this_epoch'] == 7
+
+    resumed = TokenBudgetIterator(dataset, max_tokens=300, seed=5)
+    resumed.load_state_dict(state)
+    rest = [batch.text.tolist() for batch in resumed]
+    assert done + rest == full_epoch
+    # the epoch after the resumed one starts from the first batch again
+    assert len(list(resumed)) == len(resumed)
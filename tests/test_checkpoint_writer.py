@@ -0,0 +1,73 @@
+'''
+CheckpointWriter (utils/checkpoint_writer.py): the grouped jobs, the bound on the snapshots and the retention policy.
+'''
+import os
+import threading
+import pytest
+
+torch = pytest.importorskip('torch')
+from utils.checkpoint_writer import CheckpointWriter, snapshot
+
+
+def test_snapshot_shares_copies():
+    weight = torch.ones(3)
+    copies = {}
+    # state_dict() detaches the parameters anew: the same memory, different tensor objects
+    first = snapshot({'model': {'weight': weight.detach()}}, copies)
+    second = snapshot({'weight': weight.detach()}, copies)
+    assert first['model']['weight'] is second['weight']
+    weight.add_(1)
+    assert first['model']['weight'].tolist() == [1., 1., 1.]
+
+
+@pytest.mark.parametrize('asynchronous', [True, False])
+def test_group_is_one_job(tmp_path, asynchronous):
+    writer = CheckpointWriter(asynchronous=asynchronous)
+    model = torch.nn.Linear(4, 2)
+    with writer.group():
+        writer.save(model.state_dict(), str(tmp_path / 'model.pt'))
+        writer.save({'model_state_dict': model.state_dict()}, str(tmp_path / 'checkpoint.tar'))
+        if asynchronous:
+            assert len(writer.copies) == 2
+    writer.close()
+    checkpoint = torch.load(str(tmp_path / 'checkpoint.tar'))
+    assert torch.equal(torch.load(str(tmp_path / 'model.pt'))['weight'], checkpoint['model_state_dict']['weight'])
+
+
+def test_slot_taken_before_the_snapshot(tmp_path):
+    writer = CheckpointWriter(max_pending=1)
+    started, release = threading.Event(), threading.Event()
+
+    def blocking_job():
+        started.set()
+        release.wait()
+
+    writer.submit(blocking_job)
+    started.wait()
+    saver = threading.Thread(target=writer.save, args=({'weight': torch.ones(2)}, str(tmp_path / 'model.pt')))
+    saver.start()
+    saver.join(timeout=0.2)
+    # waiting for the slot, without a snapshot in memory
+    assert saver.is_alive() and writer.copies is None
+    release.set()
+    saver.join()
+    writer.close()
+    assert os.path.isfile(tmp_path / 'model.pt')
+
+
+def test_retention(tmp_path):
+    writer = CheckpointWriter(keep_last=2, keep_best=True)
+    losses = [0.5, 0.1, 0.4, 0.3, 0.2]
+    for epoch, loss in enumerate(losses, 1):
+        writer.save_epoch_model({'epoch': epoch}, str(tmp_path / f'epoch{epoch}_model.pt'), epoch, loss)
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ['epoch2_model.pt', 'epoch4_model.pt', 'epoch5_model.pt']
+    assert writer.epoch_losses() == {2: 0.1, 4: 0.3, 5: 0.2}
+
+
+def test_error_raised_on_flush(tmp_path):
+    writer = CheckpointWriter()
+    writer.save({'weight': torch.ones(2)}, str(tmp_path / 'missing' / 'model.pt'))
+    with pytest.raises((OSError, RuntimeError)):
+        writer.flush()
+    writer.close()
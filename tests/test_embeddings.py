@@ -0,0 +1,36 @@
+'''
+build_embedding (models/embeddings.py): the backends and the sparse gradients.
+'''
+import pytest
+
+torch = pytest.importorskip('torch')
+from models.embeddings import build_embedding
+
+
+VOCAB_SIZE, EMBEDDING_DIM, PAD_IDX, UNK_IDX = 10, 4, 1, 0
+
+
+def pretrained():
+    return torch.randn(VOCAB_SIZE, EMBEDDING_DIM, generator=torch.Generator().manual_seed(0))
+
+
+@pytest.mark.parametrize('backend', ['dense', 'hashed', 'int8', 'float16'])
+def test_special_tokens_are_zero(backend):
+    embedding = build_embedding(backend, VOCAB_SIZE, EMBEDDING_DIM, pretrained(), PAD_IDX, UNK_IDX, num_buckets=6)
+    rows = embedding(torch.tensor([UNK_IDX, PAD_IDX, 5]))
+    assert rows.shape == (3, EMBEDDING_DIM)
+    assert not rows[:2].any()
+
+
+@pytest.mark.parametrize('backend', ['dense', 'hashed'])
+def test_sparse_gradients(backend):
+    embedding = build_embedding(backend, VOCAB_SIZE, EMBEDDING_DIM, pretrained(), PAD_IDX, UNK_IDX, num_buckets=6,
+                                sparse=True)
+    embedding(torch.tensor([2, 3])).sum().backward()
+    assert all(param.grad.is_sparse for param in embedding.parameters())
+
+
+@pytest.mark.parametrize('backend', ['int8', 'float16'])
+def test_sparse_frozen_backend_rejected(backend):
+    with pytest.raises(ValueError, match='frozen'):
+        build_embedding(backend, VOCAB_SIZE, EMBEDDING_DIM, pretrained(), PAD_IDX, UNK_IDX, sparse=True)
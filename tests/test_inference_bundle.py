@@ -0,0 +1,33 @@
+'''
+export_bundle and load_bundle (utils/inference_bundle.py).
+'''
+import pytest
+
+torch = pytest.importorskip('torch')
+from models.CNN import CNN1d
+from data.vocab_index import VocabIndex
+from utils.inference_bundle import bundle_itos, export_bundle, load_bundle, vocab_index_path
+
+
+ITOS = ['<unk>', '<pad>', 'good', 'bad', 'größer']
+HYPERPARAMETERS = {'embedding_dim': 8, 'conv_out_ch': 4, 'filter_sizes': [2, 3], 'output_dim': 3}
+
+
+def test_round_trip(tmp_path):
+    model = CNN1d(vocab_size=len(ITOS), embeddings=torch.randn(len(ITOS), 8), pad_idx=1, unk_idx=0, **HYPERPARAMETERS)
+    file_path = str(tmp_path / 'inference_bundle.pt')
+    export_bundle(file_path, model, 'CNN', ITOS, ['neutral', 'positive', 'negative'], 1, 0, HYPERPARAMETERS)
+    bundle = load_bundle(file_path)
+    assert bundle['vocab_size'] == len(ITOS)
+    assert bundle_itos(bundle) == ITOS
+    assert torch.equal(bundle['model_state_dict']['fc.weight'], model.state_dict()['fc.weight'])
+    assert VocabIndex.load(vocab_index_path(file_path)).lookup(['bad', 'unseen']).tolist() == [3, 0]
+
+
+def test_vocabulary_must_match_the_model(tmp_path):
+    model = CNN1d(vocab_size=len(ITOS) + 1, embeddings=torch.randn(len(ITOS) + 1, 8), pad_idx=1, unk_idx=0,
+                  **HYPERPARAMETERS)
+    file_path = str(tmp_path / 'inference_bundle.pt')
+    export_bundle(file_path, model, 'CNN', ITOS, ['neutral', 'positive', 'negative'], 1, 0, HYPERPARAMETERS)
+    with pytest.raises(ValueError, match='does not match'):
+        load_bundle(file_path)
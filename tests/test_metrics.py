@@ -0,0 +1,116 @@
+'''
+MetricsAccumulator (models/metrics.py) against sklearn.metrics on fixed predictions,
+and the totals through the state_dict round-trip and the distributed all-reduce.
+'''
+import os
+import socket
+import pytest
+
+torch = pytest.importorskip('torch')
+metrics = pytest.importorskip('sklearn.metrics')
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from models.metrics import MetricsAccumulator
+
+
+NUM_CLASSES = 3
+WEIGHT = torch.tensor([0.5, 2., 1.5])
+
+
+def fixed_batches(num_batches=6, batch_size=37, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    batches = []
+    for _ in range(num_batches):
+        output = torch.randn((batch_size, NUM_CLASSES), generator=generator)
+        label = torch.randint(NUM_CLASSES, (batch_size,), generator=generator)
+        batches.append((output, label))
+    return batches
+
+
+def accumulate(batches, weight=WEIGHT):
+    accumulator = MetricsAccumulator(NUM_CLASSES, weight=weight)
+    for output, label in batches:
+        accumulator.update(output, label)
+    return accumulator
+
+
+@pytest.mark.parametrize('weight', [None, WEIGHT])
+def test_matches_sklearn(weight):
+    batches = fixed_batches()
+    accumulator = accumulate(batches, weight)
+    output = torch.cat([output for output, _ in batches])
+    label = torch.cat([label for _, label in batches])
+    preds = output.argmax(dim=1)
+
+    loss, accuracy, f1_score, precision, recall = accumulator.compute()
+    assert loss == pytest.approx(F.cross_entropy(output, label, weight=weight).item(), rel=1e-6)
+    assert accuracy == pytest.approx(metrics.accuracy_score(label, preds))
+    # the average of the positive and the negative class (1 and 2)
+    for value, score in [(f1_score, metrics.f1_score), (precision, metrics.precision_score),
+                         (recall, metrics.recall_score)]:
+        per_class = score(label, preds, average=None)
+        assert value == pytest.approx((per_class[1] + per_class[2]) / 2)
+
+    class_precision, class_recall, class_f1 = accumulator.scores()
+    support = torch.bincount(label, minlength=NUM_CLASSES).double()
+    assert class_precision.tolist() == pytest.approx(metrics.precision_score(label, preds, average=None).tolist())
+    assert class_recall.tolist() == pytest.approx(metrics.recall_score(label, preds, average=None).tolist())
+    assert class_f1.mean().item() == pytest.approx(metrics.f1_score(label, preds, average='macro'))
+    assert (class_f1 * support).sum().item() / support.sum().item() == \
+        pytest.approx(metrics.f1_score(label, preds, average='weighted'))
+
+
+def test_class_never_predicted():
+    # class 2 is never predicted: its precision is 0 (undefined), like sklearn with zero_division=0
+    output = torch.tensor([[3., 0., 0.], [0., 3., 0.], [3., 0., 0.], [0., 3., 0.]])
+    label = torch.tensor([0, 1, 2, 2])
+    accumulator = MetricsAccumulator(NUM_CLASSES)
+    accumulator.update(output, label)
+    precision, recall, f1_score = accumulator.scores()
+    preds = output.argmax(dim=1)
+    assert precision.tolist() == pytest.approx(metrics.precision_score(label, preds, average=None, zero_division=0).tolist())
+    assert recall.tolist() == pytest.approx(metrics.recall_score(label, preds, average=None, zero_division=0).tolist())
+    assert f1_score.tolist() == pytest.approx(metrics.f1_score(label, preds, average=None, zero_division=0).tolist())
+
+
+def test_state_dict_round_trip():
+    batches = fixed_batches()
+    interrupted = accumulate(batches[:4])
+    resumed = MetricsAccumulator(NUM_CLASSES, weight=WEIGHT)
+    resumed.load_state_dict(interrupted.state_dict())
+    for output, label in batches[4:]:
+        resumed.update(output, label)
+    assert resumed.compute() == pytest.approx(accumulate(batches).compute())
+    assert torch.equal(resumed.confusion_matrix, accumulate(batches).confusion_matrix)
+
+
+def all_reduce_worker(rank, world_size, port, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        # every process accumulates its shard of the batches
+        accumulator = accumulate(fixed_batches()[rank::world_size])
+        accumulator.all_reduce()
+        results[rank] = (accumulator.compute(), accumulator.confusion_matrix.tolist())
+    finally:
+        dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.skipif(not dist.is_available(), reason='torch.distributed is not available')
+def test_all_reduce_totals():
+    world_size = 2
+    results = mp.Manager().dict()
+    mp.spawn(all_reduce_worker, args=(world_size, free_port(), results), nprocs=world_size)
+    expected = accumulate(fixed_batches())
+    for rank in range(world_size):
+        computed, confusion_matrix = results[rank]
+        assert computed == pytest.approx(expected.compute())
+        assert confusion_matrix == expected.confusion_matrix.tolist()
@@ -0,0 +1,88 @@
+'''
+build_optimiser (models/optimisers.py) for a model with a sparse embedding table:
+one step with and without the gradient scaler, and the state_dict round-trip of the checkpoints.
+'''
+import io
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from models.optimisers import MultiOptimiser, build_optimiser, scaler_step
+
+
+class SparseModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(20, 4, sparse=True)
+        self.fc = nn.Linear(4, 3)
+
+    def forward(self, text):
+        return self.fc(self.embedding(text).mean(dim=1))
+
+
+def train_step(model, optimiser, scaler=None):
+    text = torch.tensor([[1, 2, 3], [4, 5, 1]])
+    label = torch.tensor([0, 2])
+    optimiser.zero_grad()
+    loss = F.cross_entropy(model(text), label)
+    if scaler:
+        scaler.scale(loss).backward()
+        scaler_step(scaler, optimiser)
+        scaler.update()
+    else:
+        loss.backward()
+        optimiser.step()
+
+
+def save_load(state_dict):
+    '''through torch.save like the checkpoints (load_state_dict keeps the tensors it is given)'''
+    buffer = io.BytesIO()
+    torch.save(state_dict, buffer)
+    buffer.seek(0)
+    return torch.load(buffer)
+
+
+def build(seed=0):
+    torch.manual_seed(seed)
+    model = SparseModel()
+    return model, build_optimiser(model, optim.Adam, {'lr': 0.1, 'weight_decay': 0.})
+
+
+def test_sparse_model_gets_multi_optimiser():
+    model, optimiser = build()
+    assert isinstance(optimiser, MultiOptimiser)
+    before = model.embedding.weight.detach().clone()
+    train_step(model, optimiser)
+    after = model.embedding.weight.detach()
+    # only the rows of the batch are updated
+    assert not torch.equal(before[[1, 2, 3, 4, 5]], after[[1, 2, 3, 4, 5]])
+    assert torch.equal(before[6:], after[6:])
+
+
+def test_scaler_steps_every_optimiser():
+    model, optimiser = build()
+    scaler = torch.amp.GradScaler('cpu', init_scale=2.**8)
+    embedding, fc = model.embedding.weight.detach().clone(), model.fc.weight.detach().clone()
+    train_step(model, optimiser, scaler)
+    assert not torch.equal(embedding, model.embedding.weight)
+    assert not torch.equal(fc, model.fc.weight)
+    # the same step without the scaler: the gradients were unscaled before the step
+    reference_model, reference_optimiser = build()
+    train_step(reference_model, reference_optimiser)
+    for param, reference in zip(model.parameters(), reference_model.parameters()):
+        assert torch.allclose(param, reference, atol=1e-6)
+
+
+def test_state_dict_round_trip():
+    model, optimiser = build()
+    train_step(model, optimiser)
+    resumed_model, resumed_optimiser = build()
+    resumed_model.load_state_dict(save_load(model.state_dict()))
+    resumed_optimiser.load_state_dict(save_load(optimiser.state_dict()))
+    # the resumed run takes the same next step as the uninterrupted one
+    train_step(model, optimiser)
+    train_step(resumed_model, resumed_optimiser)
+    for param, resumed in zip(model.parameters(), resumed_model.parameters()):
+        assert torch.equal(param, resumed)
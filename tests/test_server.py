@@ -0,0 +1,108 @@
+'''
+MicroBatcher and ScoringServer (server.py) with a stub predictor: the chunking and the carry-over of the requests,
+the order of the results, the rejected requests and the errors limited to the request which caused them.
+'''
+import asyncio
+import pytest
+
+np = pytest.importorskip('numpy')
+import server
+
+
+class StubPredictor():
+    '''The label of a text is the text in upper case, its probabilities [length, 0, 0]; a text "boom" fails'''
+    classes = ['neutral', 'positive', 'negative']
+
+    def __init__(self):
+        self.batches = []
+
+    def predict_texts(self, texts, batch_size=256):
+        self.batches.append(list(texts))
+        if 'boom' in texts:
+            raise ValueError('cannot score boom')
+        return [text.upper() for text in texts], np.array([[len(text), 0., 0.] for text in texts])
+
+
+def run(coroutine_function, predictor, **kwargs):
+    '''Runs coroutine_function(server) against a ScoringServer of the predictor on a free port'''
+    async def main():
+        scoring_server = server.ScoringServer(predictor, port=0, **kwargs)
+        await scoring_server.start()
+        try:
+            return await coroutine_function(scoring_server)
+        finally:
+            await scoring_server.stop()
+    return asyncio.run(main())
+
+
+async def raw_request(port, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split()[1])
+
+
+def test_chunks_carry_over_and_order():
+    predictor = StubPredictor()
+    requests = [[f'r{idx}t{text}' for text in range(size)] for idx, size in enumerate([3, 3, 10, 1])]
+
+    async def scenario(scoring_server):
+        return await asyncio.gather(*[scoring_server.batcher.predict(texts) for texts in requests])
+
+    results = run(scenario, predictor, max_batch_size=4, max_wait_ms=50)
+    # every request gets its own results, in the order of its texts, also across the chunks of the long one
+    for texts, (labels, probabilities) in zip(requests, results):
+        assert labels == [text.upper() for text in texts]
+        assert [row[0] for row in probabilities] == [len(text) for text in texts]
+    assert all(len(batch) <= 4 for batch in predictor.batches)
+    # the second request does not fit next to the first one: it is carried over to the next batch, not dropped
+    assert predictor.batches[0] == requests[0]
+    assert predictor.batches[1][:3] == requests[1]
+    assert sorted(text for batch in predictor.batches for text in batch) == sorted(sum(requests, []))
+
+
+def test_http_results_and_rejected_requests():
+    predictor = StubPredictor()
+    texts = [f'text{idx}' for idx in range(10)]
+
+    async def scenario(scoring_server):
+        port = scoring_server.port
+        status, response = await server.request_json('127.0.0.1', port, 'POST', '/predict', {'texts': texts})
+        assert status == 200
+        assert response['labels'] == [text.upper() for text in texts]
+        assert response['classes'] == StubPredictor.classes
+        too_large = f'POST /predict HTTP/1.1\r\nContent-Length: {server.MAX_BODY_BYTES + 1}\r\n\r\n'.encode()
+        assert await raw_request(port, too_large) == 413
+        assert await raw_request(port, b'POST /predict HTTP/1.1\r\nContent-Length: 8\r\n'
+                                       b'Connection: close\r\n\r\nnot json') == 400
+        assert await raw_request(port, b'POST /predict HTTP/1.1\r\nContent-Length: 14\r\n'
+                                       b'Connection: close\r\n\r\n{"texts": "a"}') == 400
+        assert await raw_request(port, b'GARBAGE\r\n\r\n') == 400
+        return scoring_server.metrics.summary()
+
+    metrics = run(scenario, predictor, max_batch_size=4)
+    assert metrics['requests'] == 1 and metrics['errors'] == 4
+
+
+def test_errors_limited_to_the_request():
+    predictor = StubPredictor()
+
+    async def scenario(scoring_server):
+        port = scoring_server.port
+        bodies = [{'texts': ['good', 'fine']}, {'text': 'boom'}, {'texts': ['great']}]
+        results = await asyncio.gather(*[server.request_json('127.0.0.1', port, 'POST', '/predict', body)
+                                         for body in bodies])
+        # the server still scores after the error
+        results.append(await server.request_json('127.0.0.1', port, 'POST', '/predict', {'text': 'later'}))
+        return results
+
+    results = run(scenario, predictor, max_batch_size=8, max_wait_ms=50)
+    assert [status for status, _ in results] == [200, 500, 200, 200]
+    assert results[0][1]['labels'] == ['GOOD', 'FINE']
+    assert 'cannot score boom' in results[1][1]['error']
+    assert results[2][1]['labels'] == ['GREAT']
+    assert results[3][1]['labels'] == ['LATER']
+    # the failed batch held the three requests together
+    assert sorted(predictor.batches[0]) == ['boom', 'fine', 'good', 'great']
@@ -0,0 +1,61 @@
+'''
+VocabIndex (data/vocab_index.py): build/lookup, the unknown tokens, the hash collisions and the version of the files.
+'''
+import pickle
+import pytest
+
+np = pytest.importorskip('numpy')
+import data.vocab_index as vocab_index
+from data.vocab_index import VocabIndex, numericalize, token_hashes
+
+
+ITOS = ['<unk>', '<pad>', 'the', 'movie', 'was', 'größer', '😀', 'a' * 40, '']
+UNK_IDX = 0
+
+
+def fnv1a(token):
+    hashed = 0xcbf29ce484222325
+    for byte in token.encode('utf8'):
+        hashed = ((hashed ^ byte) * 0x100000001b3) % 2 ** 64
+    return hashed
+
+
+def test_token_hashes_are_fnv1a():
+    assert token_hashes(ITOS).tolist() == [fnv1a(token) for token in ITOS]
+
+
+def test_build_lookup_round_trip(tmp_path):
+    index = VocabIndex.build(ITOS, UNK_IDX)
+    assert len(index) == len(ITOS)
+    assert index.lookup(ITOS).tolist() == list(range(len(ITOS)))
+    assert [index.itos(idx) for idx in range(len(ITOS))] == ITOS
+    index.save(str(tmp_path))
+    loaded = VocabIndex.load(str(tmp_path))
+    assert loaded.lookup(ITOS[::-1]).tolist() == list(range(len(ITOS)))[::-1]
+    # a memory-mapped index is pickled as its path
+    assert pickle.loads(pickle.dumps(loaded))[ITOS[3]] == 3
+
+
+def test_unknown_tokens_map_to_unk():
+    index = VocabIndex.build(ITOS, UNK_IDX)
+    assert index.lookup(['movie', 'unseen', 'The', 'zzz' * 20]).tolist() == [3, UNK_IDX, UNK_IDX, UNK_IDX]
+    assert index['unseen'] == UNK_IDX
+    assert 'movie' in index and 'unseen' not in index
+    assert numericalize(index, [['the', 'unseen'], [], ['was']]) == [[2, UNK_IDX], [], [4]]
+    assert VocabIndex.build([], UNK_IDX).lookup(['the']).tolist() == [UNK_IDX]
+
+
+def test_hash_collision_rejected(monkeypatch):
+    # two tokens with the same hash
+    monkeypatch.setattr(vocab_index, 'token_hashes', lambda tokens: np.array([fnv1a(token) for token in tokens]
+                                                                             , dtype=np.uint64) % np.uint64(4))
+    with pytest.raises(ValueError, match='collision'):
+        VocabIndex.build(ITOS, UNK_IDX)
+
+
+def test_stale_version_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(vocab_index, 'INDEX_VERSION', vocab_index.INDEX_VERSION - 1)
+    VocabIndex.build(ITOS, UNK_IDX).save(str(tmp_path))
+    monkeypatch.undo()
+    with pytest.raises(ValueError, match='version'):
+        VocabIndex.load(str(tmp_path))
@@ -0,0 +1,227 @@
+"""
+Checkpoints written in a background thread, atomically, with a retention policy.
+"""
+
+import os
+import contextlib
+import random
+import re
+import threading
+import time
+from queue import Queue
+import numpy as np
+import torch
+
+from configs.serde import write_config
+
+
+def snapshot(obj, copies=None):
+    '''
+    Copy of (nested dicts, lists and tuples of) tensors on the cpu, so the training can go on
+    updating the originals while the copy is being serialized.
+    :copies: {key of a tensor: (tensor, copy)} shared by several snapshots, so that a tensor in several of them
+        (e.g. the weights of the model in the checkpoint and in the model file) is copied once
+    '''
+    if torch.is_tensor(obj):
+        if copies is None:
+            return obj.detach().to('cpu', copy=True)
+        # the same memory, not the same tensor object (state_dict() detaches the parameters anew);
+        # the original is kept with its copy so that its memory cannot be reused by another tensor meanwhile
+        key = (obj.device, obj.data_ptr(), obj.dtype, tuple(obj.shape), obj.stride())
+        if key not in copies:
+            copies[key] = (obj, obj.detach().to('cpu', copy=True))
+        return copies[key][1]
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value, copies)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value, copies) for value in obj)
+    return obj
+
+
+def rng_state():
+    '''State of the random generators of python, numpy and torch (cpu and GPUs)'''
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, file_path):
+    '''torch.save to a temporary file which is then renamed: a crash never leaves a truncated checkpoint'''
+    temp_path = file_path + '.tmp'
+    torch.save(obj, temp_path)
+    os.replace(temp_path, file_path)
+
+
+def atomic_write_config(params, cfg_path):
+    temp_path = cfg_path + '.tmp'
+    write_config(params, temp_path, sort_keys=True)
+    os.replace(temp_path, cfg_path)
+
+
+def remove_file(file_path):
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+
+
+def run_jobs(jobs):
+    for function, args in jobs:
+        function(*args)
+
+
+def find_epoch_files(output_path, model_name, last_epoch, epoch_losses):
+    '''(epoch, loss, file path) of the epoch{N}_<model_name> files of output_path with N <= last_epoch, sorted by epoch'''
+    if not os.path.isdir(output_path):
+        return []
+    pattern = re.compile(r'epoch(\d+)_' + re.escape(model_name) + '$')
+    epoch_files = []
+    for file_name in os.listdir(output_path):
+        match = pattern.match(file_name)
+        if match and int(match.group(1)) <= last_epoch:
+            epoch = int(match.group(1))
+            epoch_files.append((epoch, epoch_losses.get(epoch, float('inf')), os.path.join(output_path, file_name)))
+    return sorted(epoch_files)
+
+
+class CheckpointWriter():
+    '''
+    Writes the checkpoints of the training in a background thread.
+    save() snapshots the state on the cpu and queues it; only the snapshot (and waiting for a free slot when
+    `max_pending` jobs are already queued or being written) blocks the training. blocked_time: seconds the
+    training was blocked so far.
+    The saves within `with writer.group():` (e.g. the config, the model files and the checkpoint of an epoch)
+    are one job: they take one slot and a tensor in several of them is copied once.
+    A slot is taken before the snapshot and freed once the job is written, so at most max_pending snapshots
+    (each a copy of the model, and of the optimiser for a checkpoint) are in memory at once.
+    Retention of the epoch{N}_ model files: the last `keep_last` epochs (None: all of them)
+    and, with keep_best, the epoch of the lowest loss are kept, the others are deleted.
+    With asynchronous=False everything is written in the calling thread (atomically, without a snapshot).
+    '''
+    def __init__(self, keep_last=None, keep_best=True, asynchronous=True, max_pending=2,
+                 output_path=None, model_name=None, last_epoch=0, epoch_losses=None):
+        '''
+        :output_path, model_name: the epoch{N}_<model_name> files of the epochs up to `last_epoch` which are
+            already in output_path (written before a resume) are subject to the retention policy as well
+        :epoch_losses: loss of each of these epochs (see epoch_losses()); an epoch without a loss is never the best one
+        '''
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.asynchronous = asynchronous
+        self.blocked_time = 0.
+        self.epoch_files = []
+        if output_path is not None and model_name is not None:
+            self.epoch_files = find_epoch_files(output_path, model_name, last_epoch, epoch_losses or {})
+        self.error = None
+        # the jobs of the current group and the tensors copied for it
+        self.jobs = None
+        self.copies = None
+        if asynchronous:
+            self.slots = threading.BoundedSemaphore(max_pending)
+            self.queue = Queue()
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+
+    def worker(self):
+        while True:
+            jobs = self.queue.get()
+            try:
+                if jobs is None:
+                    return
+                run_jobs(jobs)
+            except Exception as error:
+                self.error = error
+            finally:
+                if jobs is not None:
+                    # the snapshots of the job are released with its slot
+                    jobs.clear()
+                    self.slots.release()
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    @contextlib.contextmanager
+    def group(self):
+        '''The saves within are written as one job of the queue (a group within a group is part of it)'''
+        if self.jobs is not None:
+            yield
+            return
+        start_time = time.perf_counter()
+        self.raise_error()
+        if self.asynchronous:
+            self.slots.acquire()
+        self.blocked_time += time.perf_counter() - start_time
+        self.jobs, self.copies = [], {}
+        try:
+            yield
+        finally:
+            jobs, self.jobs, self.copies = self.jobs, None, None
+            start_time = time.perf_counter()
+            if self.asynchronous:
+                self.queue.put(jobs)
+            else:
+                run_jobs(jobs)
+            self.blocked_time += time.perf_counter() - start_time
+
+    def submit(self, function, *args):
+        with self.group():
+            self.jobs.append((function, args))
+
+    def snapshot(self, obj):
+        if not self.asynchronous:
+            return obj
+        start_time = time.perf_counter()
+        obj = snapshot(obj, self.copies)
+        self.blocked_time += time.perf_counter() - start_time
+        return obj
+
+    def save(self, obj, file_path):
+        with self.group():
+            self.submit(atomic_save, self.snapshot(obj), file_path)
+
+    def write_config(self, params, cfg_path):
+        with self.group():
+            self.submit(atomic_write_config, self.snapshot(params), cfg_path)
+
+    def save_epoch_model(self, state_dict, file_path, epoch, loss):
+        '''Saves the model of an epoch and deletes the epoch files which are out of the retention policy'''
+        with self.group():
+            self.save(state_dict, file_path)
+            self.epoch_files.append((epoch, loss, file_path))
+            if self.keep_last is None:
+                return
+            keep = {file_path for _, _, file_path in self.epoch_files[-self.keep_last:]}
+            if self.keep_best:
+                keep.add(min(self.epoch_files, key=lambda epoch_file: epoch_file[1])[2])
+            for epoch_file in [epoch_file for epoch_file in self.epoch_files if epoch_file[2] not in keep]:
+                self.epoch_files.remove(epoch_file)
+                # queued after the writes, so a file is never deleted before it is written
+                self.submit(remove_file, epoch_file[2])
+
+    def epoch_losses(self):
+        '''Loss of each epoch whose model file is kept, for the checkpoint'''
+        return {epoch: loss for epoch, loss, _ in self.epoch_files}
+
+    def flush(self):
+        '''Waits until all the queued checkpoints are written'''
+        start_time = time.perf_counter()
+        if self.asynchronous:
+            self.queue.join()
+        self.blocked_time += time.perf_counter() - start_time
+        self.raise_error()
+
+    def close(self):
+        self.flush()
+        if self.asynchronous:
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,51 @@
+"""
+Multi-process data-parallel training (torch.distributed over gloo, for the cpu nodes).
+"""
+
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def init_process(rank, world_size, local_world_size=None, backend='gloo'):
+    '''
+    Joins the process group of the distributed training.
+    The cores of the machine are divided between its processes, instead of every process using all of them.
+    :local_world_size: number of processes on this machine (default: world_size, a single machine)
+    '''
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // (local_world_size or world_size)))
+
+
+def run_process(rank, function, world_size, local_world_size, args):
+    init_process(rank, world_size, local_world_size)
+    try:
+        function(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(function, num_processes, *args):
+    '''
+    Runs function(rank, world_size, *args) in `num_processes` processes on this machine.
+    Several machines: start the script once per machine with torchrun (or set RANK, WORLD_SIZE, LOCAL_WORLD_SIZE,
+    MASTER_ADDR and MASTER_PORT); the function then runs once, with the rank and world size of the environment.
+    '''
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        run_process(int(os.environ['RANK']), function, int(os.environ['WORLD_SIZE']),
+                    int(os.environ.get('LOCAL_WORLD_SIZE', num_processes)), args)
+        return
+    mp.spawn(run_process, args=(function, num_processes, num_processes, args), nprocs=num_processes, join=True)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def barrier():
+    '''Waits for all the processes; does nothing outside of a distributed training'''
+    if is_distributed():
+        dist.barrier()
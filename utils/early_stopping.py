@@ -0,0 +1,53 @@
+"""
+Early stopping of the training when the monitored metric stops improving.
+"""
+
+
+class EarlyStopping():
+    '''
+    Stops the training after `patience` epochs without an improvement of the monitored metric
+    by more than `min_delta`.
+    :monitor: a metric of the epoch summary of Training.execute_training:
+        'valid_loss' / 'train_loss' (lower is better), 'valid_F1', 'valid_acc', ... (higher is better)
+    '''
+    def __init__(self, patience=10, min_delta=0., monitor='valid_loss'):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.monitor = monitor
+        self.mode = 'min' if monitor.endswith('loss') else 'max'
+        self.best = None
+        self.best_epoch = 0
+        self.num_bad_epochs = 0
+
+    def improved(self, value):
+        if self.best is None:
+            return True
+        if self.mode == 'min':
+            return value < self.best - self.min_delta
+        return value > self.best + self.min_delta
+
+    def step(self, summary):
+        '''
+        :summary: metrics of the epoch ({'epoch': ..., 'valid_loss': ..., ...});
+            without a validation set the training metric is monitored instead
+        Returns True when the training should stop
+        '''
+        value = summary.get(self.monitor, summary.get(self.monitor.replace('valid', 'train')))
+        if value is None:
+            raise KeyError(f'early stopping: the monitored metric {self.monitor} is not in the epoch summary '
+                           f'(available: {", ".join(key for key in summary if key != "epoch")})')
+        if self.improved(value):
+            self.best = value
+            self.best_epoch = summary['epoch']
+            self.num_bad_epochs = 0
+        else:
+            self.num_bad_epochs += 1
+        return self.num_bad_epochs >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'best_epoch': self.best_epoch, 'num_bad_epochs': self.num_bad_epochs}
+
+    def load_state_dict(self, state_dict):
+        self.best = state_dict['best']
+        self.best_epoch = state_dict['best_epoch']
+        self.num_bad_epochs = state_dict['num_bad_epochs']
@@ -0,0 +1,113 @@
+"""
+Self-contained inference bundle of a trained model: the weights, the vocabulary, the label order,
+the special token indices and the hyper-parameters of the architecture, in one file.
+Prediction.from_bundle builds a ready predictor from it, without reading the training data,
+building the vocabulary or loading the pretrained vectors.
+"""
+
+import os
+import numpy as np
+import torch
+
+from utils.checkpoint_writer import atomic_save, snapshot
+from data.vocab_index import VocabIndex
+
+
+BUNDLE_VERSION = 3
+BUNDLE_FILE_NAME = 'inference_bundle.pt'
+
+
+class Stoi(dict):
+    '''
+    Token -> index of the vocabulary; unknown tokens map to <unk> (like the stoi of the torchtext Vocab),
+    without adding them to the dictionary.
+    '''
+    def __init__(self, itos, unk_idx):
+        super().__init__((token, idx) for idx, token in enumerate(itos))
+        self.unk_idx = unk_idx
+
+    def __missing__(self, token):
+        return self.unk_idx
+
+
+def bundle_path(params):
+    '''Path of the bundle of an experiment, next to its trained models'''
+    return os.path.join(params['network_output_path'], BUNDLE_FILE_NAME)
+
+
+def bundle_is_current(file_path, model_file):
+    '''The bundle exists and is not older than the model file it is exported from (if that file is there)'''
+    if not os.path.isfile(file_path):
+        return False
+    return not os.path.isfile(model_file) or os.path.getmtime(file_path) >= os.path.getmtime(model_file)
+
+
+def vocab_index_path(file_path):
+    '''Directory of the memory-mapped vocabulary index (see data/vocab_index.py) of the bundle'''
+    return os.path.splitext(file_path)[0] + '_vocab'
+
+
+def vocab_itos(stoi, vocab_size):
+    '''
+    itos of a stoi dictionary: the first token of each index
+    (the stoi of torchtext also collects the unknown tokens which were looked up, all mapped to <unk>)
+    '''
+    itos = [None] * vocab_size
+    for token, idx in stoi.items():
+        if itos[idx] is None:
+            itos[idx] = token
+    return itos
+
+
+def bundle_itos(bundle):
+    '''Tokens of the vocabulary of a bundle, in the order of the embedding table'''
+    data = bundle['vocab']['arena'].numpy().tobytes()
+    offsets = bundle['vocab']['offsets'].tolist()
+    return [data[start:end].decode('utf8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def export_bundle(file_path, model, model_mode, itos, labels, pad_idx, unk_idx, hyperparameters):
+    '''
+    :model: the trained model ('RNN': biLSTM, 'CNN': CNN1d)
+    :itos: tokens of the vocabulary, in the order of the embedding table
+    :labels: label of each output of the model (LABEL.vocab.itos)
+    :hyperparameters: keyword arguments of the constructor of the model, apart from vocab_size and embeddings
+        (embedding_dim, hidden_dim or conv_out_ch and filter_sizes, output_dim, embedding_backend, num_buckets)
+    The vocabulary is stored as the UTF-8 bytes of its tokens and their offsets (two tensors, not a list of
+    strings), so loading the bundle does not create a Python string per token (see bundle_itos).
+    '''
+    # the compact index used in place of the stoi dictionary at prediction time
+    vocab_index = VocabIndex.build(list(itos), unk_idx)
+    bundle = {'version': BUNDLE_VERSION,
+              'model_mode': model_mode,
+              'model_state_dict': snapshot(model.state_dict()),
+              'vocab_size': len(vocab_index),
+              'vocab': {'arena': torch.from_numpy(np.array(vocab_index.arena)),
+                        'offsets': torch.from_numpy(np.array(vocab_index.offsets))},
+              'labels': list(labels),
+              'PAD_IDX': pad_idx,
+              'UNK_IDX': unk_idx,
+              'hyperparameters': dict(hyperparameters)}
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    atomic_save(bundle, file_path)
+    vocab_index.save(vocab_index_path(file_path))
+
+
+def load_bundle(file_path):
+    '''
+    Raises ValueError for a bundle of another version, or whose vocabulary does not match the embedding table
+    of its model (the rows of the table, or num_buckets for the hashed embedding)
+    '''
+    bundle = torch.load(file_path, map_location='cpu')
+    if bundle.get('version') != BUNDLE_VERSION:
+        raise ValueError(f'unsupported inference bundle version {bundle.get("version")} of {file_path}')
+    hyperparameters = bundle['hyperparameters']
+    if hyperparameters.get('embedding_backend', 'dense') == 'hashed':
+        table_name, num_rows = 'embedding.table.weight', hyperparameters['num_buckets']
+    else:
+        table_name, num_rows = 'embedding.weight', bundle['vocab_size']
+    table = bundle['model_state_dict'].get(table_name)
+    if table is None or table.shape[0] != num_rows:
+        raise ValueError(f'the vocabulary of {file_path} ({bundle["vocab_size"]:,} tokens) does not match the embedding '
+                         f'table of its model ({None if table is None else table.shape[0]} rows of {table_name})')
+    return bundle
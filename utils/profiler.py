@@ -0,0 +1,110 @@
+"""
+Opt-in operator-level profiling (torch.profiler) of a window of training or prediction steps,
+configured by the "profiler" section of the experiment config:
+    "profiler": {"enabled": true, "skip_steps": 20, "warmup_steps": 2, "record_steps": 5,
+                 "profile_memory": false, "record_shapes": false, "with_stack": false, "row_limit": 30}
+The Chrome trace (chrome://tracing, https://ui.perfetto.dev) and the table of the top operators
+are written to the output_data_path of the experiment.
+"""
+
+import os
+import torch
+from torch.profiler import profile, schedule, ProfilerActivity
+
+
+class NullProfiler():
+    '''Profiling disabled: does nothing'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def start(self):
+        pass
+
+    def step(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class StepProfiler():
+    '''
+    Skips `skip_steps` steps, warms up for `warmup_steps` steps (recorded but discarded) and records `record_steps` steps;
+    step() is called after each batch. Outside of the window the profiler costs next to nothing.
+    At the end of the window (or at stop() if the run is shorter):
+        profile_<name>.json: Chrome trace
+        profile_<name>.txt: top `row_limit` operators by total time (and by memory with profile_memory)
+    '''
+    def __init__(self, output_path, name='train', skip_steps=20, warmup_steps=2, record_steps=5, profile_memory=False,
+                 record_shapes=False, with_stack=False, row_limit=30, device=None):
+        self.output_path = output_path
+        self.name = name
+        self.profile_memory = profile_memory
+        self.row_limit = row_limit
+        self.cuda = device is not None and torch.device(device).type == 'cuda'
+        activities = [ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(ProfilerActivity.CUDA)
+        self.profiler = profile(activities=activities,
+                                schedule=schedule(wait=skip_steps, warmup=warmup_steps, active=record_steps, repeat=1),
+                                on_trace_ready=self.export, record_shapes=record_shapes,
+                                profile_memory=profile_memory, with_stack=with_stack)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+    def start(self):
+        self.profiler.start()
+
+    def step(self):
+        self.profiler.step()
+
+    def stop(self):
+        self.profiler.stop()
+
+    def export(self, profiler):
+        os.makedirs(self.output_path, exist_ok=True)
+        trace_path = os.path.join(self.output_path, 'profile_' + self.name + '.json')
+        table_path = os.path.join(self.output_path, 'profile_' + self.name + '.txt')
+        profiler.export_chrome_trace(trace_path)
+
+        sort_by = 'cuda_time_total' if self.cuda else 'cpu_time_total'
+        key_averages = profiler.key_averages()
+        tables = ['Top operators by ' + sort_by,
+                  key_averages.table(sort_by=sort_by, row_limit=self.row_limit)]
+        if self.profile_memory:
+            sort_by = 'self_cuda_memory_usage' if self.cuda else 'self_cpu_memory_usage'
+            tables += ['Top operators by ' + sort_by,
+                       key_averages.table(sort_by=sort_by, row_limit=self.row_limit)]
+        with open(table_path, 'w') as f:
+            f.write('\n\n'.join(tables) + '\n')
+        print(f'Profile of the {self.name} steps written to {trace_path} and {table_path}')
+
+
+def build_profiler(params, name, device=None):
+    '''
+    StepProfiler of the "profiler" section of the config (params), writing to params['output_data_path'];
+    NULL_PROFILER if the section is missing or not enabled.
+    '''
+    config = params.get('profiler') or {}
+    if not config.get('enabled', False):
+        return NULL_PROFILER
+    return StepProfiler(params['output_data_path'], name=name,
+                        skip_steps=config.get('skip_steps', 20),
+                        warmup_steps=config.get('warmup_steps', 2),
+                        record_steps=config.get('record_steps', 5),
+                        profile_memory=config.get('profile_memory', False),
+                        record_shapes=config.get('record_shapes', False),
+                        with_stack=config.get('with_stack', False),
+                        row_limit=config.get('row_limit', 30), device=device)
@@ -0,0 +1,100 @@
+"""
+Low-overhead wall-clock timers of the phases of the training loop.
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+import torch
+
+
+class NullPhase():
+    '''The phase of a disabled timer: does nothing'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase():
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.synchronize:
+            torch.cuda.synchronize()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.timer.synchronize:
+            torch.cuda.synchronize()
+        self.timer.add(self.name, time.perf_counter() - self.start_time)
+        return False
+
+
+class PhaseTimer():
+    '''
+    Accumulates the time spent in each phase (with timer.phase('train/forward'): ...) and the number of tokens,
+    until reset(). Disabled, phase() returns a shared no-op context manager, so the instrumentation costs
+    next to nothing. On a GPU the device is synchronized around the phases, so that the asynchronous
+    kernels are attributed to the right phase.
+    '''
+    def __init__(self, enabled=True, device=None):
+        self.enabled = enabled
+        self.synchronize = enabled and device is not None and torch.device(device).type == 'cuda'
+        self.phases = {}
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.tokens = defaultdict(int)
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        if name not in self.phases:
+            self.phases[name] = Phase(self, name)
+        return self.phases[name]
+
+    def add(self, name, seconds, calls=1):
+        if self.enabled:
+            self.seconds[name] += seconds
+            self.calls[name] += calls
+
+    def add_tokens(self, name, num_tokens):
+        ''':num_tokens: int or (device) tensor; tensors are only summed, read once in summary()'''
+        if self.enabled:
+            self.tokens[name] += num_tokens
+
+    def summary(self):
+        '''
+        {'phase_ms': mean milliseconds per call of each phase, 'phase_total_s': seconds of each phase,
+         'tokens_per_sec': tokens of X / seconds of the phases X/..., for each X with counted tokens}
+        '''
+        summary = {'phase_ms': {name: 1000 * seconds / max(self.calls[name], 1) for name, seconds in self.seconds.items()},
+                   'phase_total_s': dict(self.seconds), 'tokens_per_sec': {}}
+        for prefix, num_tokens in self.tokens.items():
+            seconds = sum(value for name, value in self.seconds.items() if name.startswith(prefix + '/'))
+            summary['tokens_per_sec'][prefix] = int(num_tokens) / seconds if seconds else 0.
+        return summary
+
+    def write(self, writer, file_path, step):
+        '''Adds the summary to tensorboard (SummaryWriter) and appends it as a line of the JSONL file'''
+        if not self.enabled:
+            return
+        summary = self.summary()
+        for name, ms in summary['phase_ms'].items():
+            writer.add_scalar('Timing/' + name + '_ms', ms, step)
+        for name, tokens_per_sec in summary['tokens_per_sec'].items():
+            writer.add_scalar('Timing/' + name + '_tokens_per_sec', tokens_per_sec, step)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'a') as f:
+            f.write(json.dumps(dict({'epoch': step}, **summary)) + '\n')